@@ -0,0 +1,227 @@
+# batched datagram i/o for the sender and receiver. segments queued while the
+# protocol state is updated go out together in one sendmmsg call once the caller
+# lets go of its lock, and every datagram waiting on the socket is read with one
+# recvmmsg per wakeup. where libc has neither (not linux) the same calls fall
+# back to one sendmsg / recvfrom_into per datagram
+import sys
+import os
+import errno
+import select
+import socket
+import threading
+import collections
+import ctypes
+import ctypes.util
+
+BURST = 64 # datagrams per sendmmsg / recvmmsg call
+BURST_BYTES = 1024 * 1024 # large datagrams get fewer slots so the buffers stay this size
+
+# what the kernel charges a socket buffer for one datagram on top of its payload
+# (sk_buff and its headers), loopback datagrams of ~1KB cost a bit over 2KB each
+DATAGRAM_OVERHEAD = 1024
+
+MSG_DONTWAIT = 0x40
+MSG_WAITFORONE = 0x10000
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4), ("sin_zero", ctypes.c_ubyte * 8)]
+
+def load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = load_libc()
+
+def make_sockaddr(addr):
+    sa = sockaddr_in()
+    sa.sin_family = socket.AF_INET
+    sa.sin_port = socket.htons(addr[1])
+    sa.sin_addr[:] = socket.inet_aton(addr[0])
+    return sa
+
+def read_sockaddr(sa):
+    return (socket.inet_ntoa(bytes(sa.sin_addr)), socket.ntohs(sa.sin_port))
+
+# sets SO_SNDBUF and SO_RCVBUF so a whole window of datagrams fits, returns what the kernel
+# actually gave (it is capped by net.core.wmem_max / rmem_max and reported doubled on linux)
+def size_buffers(sock, datagrams, datagram_size):
+    want = datagrams * (datagram_size + DATAGRAM_OVERHEAD)
+    sizes = []
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, opt) < want:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, want)
+            except OSError:
+                pass
+        sizes.append(sock.getsockopt(socket.SOL_SOCKET, opt))
+    return tuple(sizes)
+
+# datagrams the kernel dropped because the receive buffer of sock was full,
+# the last column of its line in /proc/net/udp. None where that isnt available
+def receive_drops(sock):
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open("/proc/net/udp") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class BatchIO:
+    def __init__(self, sock, datagram_size, burst = BURST):
+        self.sock = sock
+        self.outbox = collections.deque() # (segment, addr), appends are thread safe
+        self.send_lock = threading.Lock() # the send buffers are shared by whoever flushes
+        self.addrs = {} # addr -> sockaddr_in, peers dont change so they are only built once
+        self.send_drops = 0 # datagrams the socket refused (full send buffer on a non blocking socket)
+        self.syscalls = 0
+        self.datagrams = 0
+        self.resize(datagram_size, burst)
+
+    # (re)makes the buffers for datagrams of up to datagram_size bytes
+    def resize(self, datagram_size, burst = BURST):
+        with self.send_lock:
+            self.make_buffers(datagram_size, burst)
+
+    def make_buffers(self, datagram_size, burst):
+        self.datagram_size = datagram_size
+        self.burst = max(1, min(burst, BURST_BYTES // datagram_size))
+        burst = self.burst
+
+        # one slot per datagram of a burst, for sends and for receives
+        self.send_bufs = [bytearray(datagram_size) for _ in range(burst)]
+        self.recv_bufs = [bytearray(datagram_size) for _ in range(burst)]
+        self.recv_views = [memoryview(buf) for buf in self.recv_bufs]
+        if libc != None:
+            self.send_msgs = self.make_msgs(self.send_bufs)
+            self.recv_msgs = self.make_msgs(self.recv_bufs)
+            self.recv_names = (sockaddr_in * burst)()
+            for i in range(burst):
+                self.recv_msgs[i].msg_hdr.msg_name = ctypes.addressof(self.recv_names[i])
+            self.send_iovs = [msg.msg_hdr.msg_iov[0] for msg in self.send_msgs]
+
+    def make_msgs(self, bufs):
+        msgs = (mmsghdr * len(bufs))()
+        iovs = (iovec * len(bufs))()
+        for i, buf in enumerate(bufs):
+            iovs[i].iov_base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+            iovs[i].iov_len = len(buf)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        msgs._iovs = iovs # keep the iovecs alive with the headers
+        return msgs
+
+    def sockaddr(self, addr):
+        sa = self.addrs.get(addr)
+        if sa == None:
+            sa = self.addrs[addr] = make_sockaddr(addr)
+        return sa
+
+    def queue(self, segment, addr):
+        self.outbox.append((segment, addr))
+
+    # sends everything queued so far, safe to call from any thread and without the protocol lock
+    def flush(self):
+        if len(self.outbox) == 0:
+            return
+        with self.send_lock:
+            while len(self.outbox) > 0:
+                burst = []
+                while len(burst) < self.burst and len(self.outbox) > 0:
+                    burst.append(self.outbox.popleft())
+                if libc != None:
+                    self.sendmmsg(burst)
+                else:
+                    for segment, addr in burst:
+                        self.sendmsg(segment, addr)
+
+    def sendmsg(self, segment, addr):
+        self.syscalls += 1
+        try:
+            self.sock.sendmsg(segment.buffers(), [], 0, addr)
+            self.datagrams += 1
+        except (BlockingIOError, socket.timeout):
+            self.send_drops += 1
+
+    def sendmmsg(self, burst):
+        for i, (segment, addr) in enumerate(burst):
+            hdr = self.send_msgs[i].msg_hdr
+            self.send_iovs[i].iov_len = segment.serialise_into(self.send_bufs[i])
+            sa = self.sockaddr(addr)
+            hdr.msg_name = ctypes.addressof(sa)
+            hdr.msg_namelen = ctypes.sizeof(sa)
+        sent = 0
+        while sent < len(burst):
+            self.syscalls += 1
+            n = libc.sendmmsg(self.sock.fileno(), ctypes.byref(self.send_msgs[sent]), len(burst) - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.ENOBUFS):
+                    self.send_drops += len(burst) - sent # like a full queue on the wire, the protocol recovers them
+                    return
+                raise OSError(err, os.strerror(err))
+            sent += n
+            self.datagrams += n
+
+    # every datagram waiting on the socket (empty after a spurious wakeup). (view, addr) pairs, the views
+    # are only valid until the next recv. raises socket.timeout like recvfrom would.
+    # ready is for callers that already know the socket is readable (from their own select)
+    def recv(self, ready = False):
+        if libc == None:
+            nbytes, addr = self.sock.recvfrom_into(self.recv_views[0])
+            self.syscalls += 1
+            self.datagrams += 1
+            return [(self.recv_views[0][:nbytes], addr)]
+
+        wait = self.sock.gettimeout()
+        if ready:
+            flags = MSG_DONTWAIT
+        elif wait == None: # blocking socket, wait for the first datagram and take whatever else is queued
+            flags = MSG_WAITFORONE
+        else: # python keeps sockets with a timeout non blocking, wait for them here
+            self.syscalls += 1
+            if len(select.select([self.sock], [], [], wait)[0]) == 0:
+                raise socket.timeout("timed out")
+            flags = MSG_DONTWAIT
+        for i in range(self.burst): # the kernel overwrites these with the length it filled in
+            self.recv_msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        while 1:
+            self.syscalls += 1
+            n = libc.recvmmsg(self.sock.fileno(), self.recv_msgs, self.burst, flags, None)
+            if n >= 0:
+                break
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err == errno.EAGAIN:
+                return []
+            raise OSError(err, os.strerror(err))
+        self.datagrams += n
+        return [(self.recv_views[i][:self.recv_msgs[i].msg_len], read_sockaddr(self.recv_names[i]))
+                for i in range(n)]
+
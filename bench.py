@@ -0,0 +1,288 @@
+# throughput benchmark for the sender and receiver over loopback. every run starts
+# receiver.py and sender.py as their own processes in a scratch directory, so cpu
+# time and peak rss come straight from the kernel (wait4) for each side
+#
+#   python bench.py --sizes 1000000,10000000 --max-win 10000,30000 --flp 0,0.05 -o results.json
+#   python bench.py ... -o new.json --compare results.json
+#
+# the results file is json: the settings the sweep ran with and one entry per
+# combination of parameters with the median of its repeats and the raw runs.
+# --compare matches entries on their parameters and flags any that got worse
+# than the baseline by more than --threshold, the exit status is 1 if one did.
+# it refuses a baseline that ran with other sender, receiver or impair options
+import sys
+import os
+import argparse
+import itertools
+import json
+import random
+import socket
+import statistics
+import subprocess
+import tempfile
+import shutil
+import time
+import filecmp
+import platform
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SENDER = os.path.join(HERE, "sender.py")
+RECEIVER = os.path.join(HERE, "receiver.py")
+RELAY = os.path.join(HERE, "impair.py")
+
+RUN_TIMEOUT = 300 # seconds before a run is killed and counted as failed
+RECEIVER_START = 0.3 # seconds the receiver gets to bind before the sender starts
+FILE_SEED = 1 # the file contents only depend on its size
+
+# metric -> true if a bigger value is better
+METRICS = {
+    "goodput": True, # bytes of file delivered per second
+    "time": False, # seconds from sender start until it exited
+    "retransmits": False,
+    "sender_cpu": False, # user + system seconds
+    "receiver_cpu": False,
+    "sender_rss": False, # peak resident set in KB
+    "receiver_rss": False
+}
+
+# sender log lines the counters are read from
+SENDER_STATS = {
+    "Retransmitted segments:": "retransmits",
+    "Data segments dropped:": "drop_data",
+    "Ack segments dropped:": "drop_ack",
+    "Socket buffer drops:": "sock_drops"
+}
+
+def parse_list(kind):
+    return lambda text: [kind(v) for v in text.split(",")]
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="STP loopback benchmark")
+    parser.add_argument('--sizes', type=parse_list(int), default=[1000000], help="file sizes in bytes")
+    parser.add_argument('--max-win', type=parse_list(int), default=[10000], help="max windows in bytes")
+    parser.add_argument('--rto', type=parse_list(int), default=[200], help="initial rtos in ms")
+    parser.add_argument('--flp', type=parse_list(float), default=[0.0], help="forward loss probabilities")
+    parser.add_argument('--rlp', type=parse_list(float), default=[0.0], help="reverse loss probabilities")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every combination, the median is kept")
+    parser.add_argument('--sender-args', default="", help="extra sender options, e.g. --sender-args=\"--cc cubic --sack\"")
+    parser.add_argument('--receiver-args', default="", help="extra receiver options")
+    parser.add_argument('--impair', default=None,
+                        help="run every transfer through impair.py with these options, e.g. --impair=\"--delay 20 --rate 50\"")
+    parser.add_argument('--port', type=int, default=0, help="first port to use, by default free ports are picked")
+    parser.add_argument('-o', '--output', default="bench.json", help="results file")
+    parser.add_argument('--compare', help="baseline results file to check the new results against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative change that counts as a regression")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directories of the runs")
+
+    return parser.parse_args(args[1:])
+
+# ports nothing is bound to, held together so they cant come out the same
+def free_ports(count):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(count)]
+    for sock in socks:
+        sock.bind(('127.0.0.1', 0))
+    ports = tuple(sock.getsockname()[1] for sock in socks)
+    for sock in socks:
+        sock.close()
+    return ports
+
+def make_file(path, size):
+    rng = random.Random(FILE_SEED)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            chunk = min(left, 1 << 20)
+            f.write(rng.randbytes(chunk))
+            left -= chunk
+
+# waits for a process and returns (exit status, cpu seconds, peak rss in KB)
+def reap(proc, deadline):
+    while 1:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if time.monotonic() > deadline:
+            proc.kill()
+            pid, status, usage = os.wait4(proc.pid, 0)
+            break
+        time.sleep(0.005)
+    proc.returncode = os.waitstatus_to_exitcode(status) # so Popen doesnt try to reap it again
+    return proc.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+def read_sender_stats(path):
+    stats = {}
+    if not os.path.exists(path):
+        return stats
+    with open(path) as f:
+        for line in f:
+            for label, key in SENDER_STATS.items():
+                if line.startswith(label):
+                    stats[key] = int(line[len(label):])
+    return stats
+
+# one transfer, returns the metrics of the run
+# with impair_args the sender talks to the relay and the receiver answers the relay
+def run_once(params, workdir, ports, sender_args, receiver_args, impair_args = None):
+    sender_port, receiver_port = ports[:2]
+    sends_to, answers_to = receiver_port, sender_port
+    if impair_args != None:
+        sends_to, answers_to = ports[2:]
+    sent = os.path.join(workdir, "send.bin")
+    rcvd = os.path.join(workdir, "rcvd.bin")
+    receiver_cmd = [sys.executable, RECEIVER, str(receiver_port), str(answers_to), rcvd,
+                    str(params["max_win"]), "--log", "summary"] + receiver_args
+    sender_cmd = [sys.executable, SENDER, str(sender_port), str(sends_to), sent,
+                  str(params["max_win"]), str(params["rto"]), str(params["flp"]), str(params["rlp"]),
+                  "--log", "summary"] + sender_args
+
+    receiver = subprocess.Popen(receiver_cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    relay = None
+    if impair_args != None:
+        relay_cmd = [sys.executable, RELAY, str(sends_to), str(receiver_port),
+                     "--back-port", str(answers_to)] + impair_args
+        relay = subprocess.Popen(relay_cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    time.sleep(RECEIVER_START)
+    start = time.monotonic()
+    sender = subprocess.Popen(sender_cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    sender_status, sender_cpu, sender_rss = reap(sender, start + RUN_TIMEOUT)
+    elapsed = time.monotonic() - start
+    # the receiver still sits out TIME_WAIT, that is not part of the transfer time
+    receiver_status, receiver_cpu, receiver_rss = reap(receiver, time.monotonic() + RUN_TIMEOUT)
+    if relay != None:
+        relay.terminate()
+        relay.wait()
+
+    ok = sender_status == 0 and receiver_status == 0 and os.path.exists(rcvd) \
+        and filecmp.cmp(sent, rcvd, shallow=False)
+    result = {
+        "ok": ok,
+        "goodput": params["size"] / elapsed if ok else 0.0,
+        "time": elapsed,
+        "sender_cpu": sender_cpu,
+        "receiver_cpu": receiver_cpu,
+        "sender_rss": sender_rss,
+        "receiver_rss": receiver_rss
+    }
+    result.update(read_sender_stats(os.path.join(workdir, "Sender_log.txt")))
+    return result
+
+def median_of(runs):
+    ok = [run for run in runs if run["ok"]]
+    summary = {"ok": len(ok), "failed": len(runs) - len(ok)}
+    for metric in METRICS:
+        values = [run[metric] for run in ok if metric in run]
+        summary[metric] = statistics.median(values) if len(values) > 0 else None
+    return summary
+
+def sweep(args):
+    combos = [dict(zip(("size", "max_win", "rto", "flp", "rlp"), values))
+              for values in itertools.product(args.sizes, args.max_win, args.rto, args.flp, args.rlp)]
+    sender_args = args.sender_args.split()
+    receiver_args = args.receiver_args.split()
+    impair_args = args.impair.split() if args.impair != None else None
+    scratch = tempfile.mkdtemp(prefix="stp-bench-")
+    files = {}
+
+    entries = []
+    port = args.port
+    for n, params in enumerate(combos):
+        runs = []
+        for r in range(args.repeat):
+            workdir = os.path.join(scratch, f"{n}-{r}")
+            os.mkdir(workdir)
+            if params["size"] not in files: # every run sends the same bytes for a size
+                files[params["size"]] = os.path.join(scratch, f"file-{params['size']}.bin")
+                make_file(files[params["size"]], params["size"])
+            os.link(files[params["size"]], os.path.join(workdir, "send.bin"))
+            if args.port > 0:
+                ports = tuple(range(port, port + 4))
+                port += 4
+            else:
+                ports = free_ports(4)
+            runs.append(run_once(params, workdir, ports, sender_args, receiver_args, impair_args))
+        entry = {"params": params, "median": median_of(runs), "runs": runs}
+        entries.append(entry)
+        print(format_entry(entry), flush=True)
+
+    if not args.keep:
+        shutil.rmtree(scratch)
+    return {
+        "settings": {
+            "repeat": args.repeat,
+            "sender_args": args.sender_args,
+            "receiver_args": args.receiver_args,
+            "impair": args.impair,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": entries
+    }
+
+def format_params(params):
+    return f'size {params["size"]} win {params["max_win"]} rto {params["rto"]} flp {params["flp"]} rlp {params["rlp"]}'
+
+def format_entry(entry):
+    m = entry["median"]
+    if m["ok"] == 0:
+        return f'{format_params(entry["params"])}: all {m["failed"]} runs failed'
+    line = (f'{format_params(entry["params"])}: {m["goodput"] / 1e6:.2f} MB/s, {m["time"]:.3f} s, '
+            f'{m["retransmits"]} retransmits, cpu {m["sender_cpu"]:.2f} / {m["receiver_cpu"]:.2f} s, '
+            f'rss {m["sender_rss"]} / {m["receiver_rss"]} KB')
+    if m["failed"] > 0:
+        line += f' ({m["failed"]} failed)'
+    return line
+
+# the options that change what a run measures, a baseline has to have run with the same
+COMPARED_SETTINGS = ("sender_args", "receiver_args", "impair")
+
+# settings of the baseline that dont match this sweep, as printable lines
+def mismatched_settings(args, baseline):
+    settings = baseline.get("settings", {})
+    return [f'{name}: {settings.get(name)!r} in the baseline, {getattr(args, name)!r} now'
+            for name in COMPARED_SETTINGS if settings.get(name) != getattr(args, name)]
+
+# relative change of every metric against the baseline, returns the regressions found
+def compare(results, baseline, threshold):
+    base = {json.dumps(entry["params"], sort_keys=True): entry["median"] for entry in baseline["results"]}
+    regressions = []
+    for entry in results["results"]:
+        old = base.get(json.dumps(entry["params"], sort_keys=True))
+        if old == None:
+            continue
+        new = entry["median"]
+        if new["failed"] > old["failed"]:
+            regressions.append(f'{format_params(entry["params"])}: {new["failed"]} failed runs, was {old["failed"]}')
+        for metric, higher_better in METRICS.items():
+            if old[metric] == None or new[metric] == None or old[metric] == 0:
+                continue
+            change = (new[metric] - old[metric]) / old[metric]
+            worse = -change if higher_better else change
+            if worse > threshold:
+                regressions.append(f'{format_params(entry["params"])}: {metric} {old[metric]:.4g} -> '
+                                   f'{new[metric]:.4g} ({change * 100:+.1f}%)')
+    return regressions
+
+def main():
+    args = parse_args(sys.argv)
+    if args.compare != None: # checked before the sweep, not after minutes of runs
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        mismatched = mismatched_settings(args, baseline)
+        if len(mismatched) > 0:
+            sys.exit(f"{args.compare} ran with other settings, not comparing:\n  " + "\n  ".join(mismatched))
+    results = sweep(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare != None:
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if len(regressions) > 0:
+            return 1
+        print(f"no regressions against {args.compare}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# payload compression, agreed in the SYN. the sender compresses the file as one
+# stream on a background thread ahead of the window and cuts the compressed stream
+# into whole segments like any other, so segments are full and the seqnos count
+# compressed bytes. the receiver puts the stream back in order, decompresses it and
+# hands the original bytes to the file writer at their offsets in the file
+import time
+import zlib
+import collections
+
+try:
+    import lzma
+except ImportError: # python built without liblzma
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# what a corrupt or truncated stream raises
+ERRORS = (zlib.error, ValueError, EOFError)
+if lzma != None:
+    ERRORS += (lzma.LZMAError,)
+if zstandard != None:
+    ERRORS += (zstandard.ZstdError,)
+
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+
+MAX_OUT = 256 * 1024 # decompressed bytes per call, one segment of a well compressed stream can hold megabytes
+MAX_BACKLOG = 4 * 1024 * 1024 # decompressed bytes queued on the writer before the rest of the input waits
+
+NAMES = {"zlib": ZLIB, "lzma": LZMA, "zstd": ZSTD}
+CODEC_NAMES = {codec: name for name, codec in NAMES.items()}
+
+def available():
+    codecs = [ZLIB]
+    if lzma != None:
+        codecs.append(LZMA)
+    if zstandard != None:
+        codecs.append(ZSTD)
+    return codecs
+
+# an object with compress(data) and flush() for the whole stream. fast levels,
+# the compressor has to keep ahead of the window (the ratio is most of what level 6 / 9 get)
+def compressor(codec):
+    if codec == LZMA:
+        return lzma.LZMACompressor(preset=1)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(1)
+
+# an object with decompress(data, max_length), flush() where the codec has one
+def decompressor(codec):
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    if codec == ZSTD:
+        return ZstdDecompressor()
+    return zlib.decompressobj()
+
+# zstandards decompressobj has no max_length, this one keeps what it decompressed
+# and hands it out max_length at a time, with needs_input and eof like lzma
+class ZstdDecompressor:
+    def __init__(self):
+        self.d = zstandard.ZstdDecompressor().decompressobj()
+        self.out = b""
+        self.needs_input = True
+        self.eof = False
+
+    def decompress(self, data, max_length):
+        if len(data) > 0:
+            self.out += self.d.decompress(data)
+        out = self.out[:max_length]
+        self.out = self.out[max_length:]
+        self.needs_input = len(self.out) == 0
+        return out
+
+# takes the compressed stream apart again. has the same write / close / error as a
+# FileWriter, like a framing.ObjectWriter it puts the stream in order on the receive
+# path, then passes what it decompressed to the real writer (with itself as the owner).
+# it decompresses MAX_OUT at a time and stops while the writer is MAX_BACKLOG behind,
+# the rest of the input waits for resume() (the receiver calls it when the writer got further)
+class Decompressor:
+    def __init__(self, codec, writer):
+        self.d = decompressor(codec)
+        self.writer = writer
+        self.pending = {} # stream offset -> data that arrived before the bytes in front of it
+        self.next = 0 # stream offset of the next in order byte
+        self.held = collections.deque() # in order input not given to the codec yet
+        self.taken = 0 # compressed bytes given to the codec and not in a span yet
+        self.more = False # the codec has output left for input it has already taken
+        self.out = 0 # file offset of the next decompressed byte
+        self.owner = None
+        # the owners counters are in compressed bytes, the real writers in decompressed ones.
+        # (decompressed end, compressed bytes) count as written once the writer got that far
+        self.spans = collections.deque()
+        self.queued = 0 # decompressed bytes handed to the writer
+        self.written = 0 # and written by it, only its thread changes this
+        self.seconds = 0 # spent decompressing
+        self.closed = False
+        self.error = None
+
+    def write(self, offset, data, owner):
+        self.owner = owner
+        owner.queued += len(data)
+        if self.writer.error != None: # the receiver checks for errors here, not in the real writer
+            self.error = self.writer.error
+        if offset != self.next:
+            self.pending[offset] = bytes(data)
+            return
+        self.held.append(data)
+        self.next += len(data)
+        while self.next in self.pending:
+            data = self.pending.pop(self.next)
+            self.held.append(data)
+            self.next += len(data)
+        self.resume()
+        if len(self.held) > 0: # data may point into a reused receive buffer
+            self.held = collections.deque(bytes(data) for data in self.held)
+
+    # decompresses the held input until it is all done or the writer is MAX_BACKLOG behind
+    def resume(self):
+        try:
+            while (len(self.held) > 0 or self.more) and self.queued - self.written < MAX_BACKLOG:
+                self.decompress()
+        except ERRORS as e:
+            self.error = e
+            self.held.clear()
+            self.more = False
+
+    def decompress(self):
+        if self.more:
+            data = b""
+        else:
+            data = self.held.popleft()
+            self.taken += len(data)
+        start = time.perf_counter()
+        out = self.d.decompress(data, MAX_OUT)
+        self.seconds += time.perf_counter() - start
+        tail = getattr(self.d, "unconsumed_tail", b"") # zlib hands back the input it didnt get to
+        if len(tail) > 0:
+            self.held.appendleft(tail)
+            self.taken -= len(tail)
+        self.more = hasattr(self.d, "needs_input") and not self.d.needs_input and not self.d.eof
+        size = 0
+        if len(tail) == 0 and not self.more: # the input taken so far is all out
+            size = self.taken
+            self.taken = 0
+        self.emit(out, size)
+
+    # a span that decompressed to nothing is counted as written with the next one that didnt,
+    # or with an empty write of its own when the writer has nothing left to write
+    def emit(self, out, size):
+        self.spans.append((self.queued + len(out), size))
+        if len(out) > 0 or self.written >= self.queued:
+            self.writer.write(self.out, out, self)
+            self.out += len(out)
+
+    # the real writer got further (on its thread), the compressed bytes behind it count as written.
+    # the owner hears about it too while input is held, so it can resume()
+    def on_written(self):
+        done = 0
+        while len(self.spans) > 0 and self.spans[0][0] <= self.written:
+            done += self.spans.popleft()[1]
+        if done > 0:
+            self.owner.written += done
+        if done > 0 or len(self.held) > 0 or self.more:
+            self.owner.on_written()
+
+    # the stream is over, whatever the codec still holds goes out and the writer is closed
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        while self.error == None and self.writer.error == None and (len(self.held) > 0 or self.more):
+            self.writer.flush() # room for the next MAX_BACKLOG
+            self.resume()
+        self.held.clear() # after an error, left unwritten like the rest
+        self.more = False
+        if self.error == None and hasattr(self.d, "flush"):
+            self.emit(self.d.flush(), self.taken)
+        self.writer.close()
+        if self.error == None:
+            self.error = self.writer.error
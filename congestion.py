@@ -0,0 +1,155 @@
+# congestion control for the stp sender, windows are counted in segments
+# and the sender never has more than min(cwnd, max_win) in flight
+import math
+
+INIT_CWND = 4 # rfc 3390 initial window for a 1000 byte mss
+MIN_SSTHRESH = 2
+
+# cubic constants (rfc 8312)
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+class CongestionControl:
+    # fixed window of max_win segments, what the sender did before congestion control
+    name = "none"
+
+    def __init__(self, max_win):
+        self.max_win = max_win
+        self.cwnd = max_win
+        self.ssthresh = max_win
+        self.in_recovery = False
+        self.recover = 0 # nxt when recovery started, recovery ends once that is acked
+
+    # how many segments may be in flight right now
+    def window(self):
+        return max(1, min(int(self.cwnd), self.max_win))
+
+    # how many segments may be in the pipe while SACK recovery resends holes, the
+    # window without what the dupacks inflated it by (rfc 6675 keeps cwnd at ssthresh)
+    def recovery_window(self):
+        if not self.in_recovery:
+            return self.window()
+        return max(1, min(int(self.ssthresh), self.max_win))
+
+    # new data acked, base is the new window base. returns true if this was a
+    # partial ack during recovery and the new oldest segment should be resent
+    def on_ack(self, acked, base, now, srtt):
+        return False
+
+    # a dupack that didnt trigger a fast retransmit
+    def on_dupack(self):
+        pass
+
+    # third dupack, the oldest segment is about to be fast retransmitted
+    def on_fast_retransmit(self, in_flight, nxt, now):
+        pass
+
+    def on_timeout(self, in_flight, now):
+        pass
+
+
+class Reno(CongestionControl):
+    name = "reno"
+
+    def __init__(self, max_win):
+        super().__init__(max_win)
+        self.cwnd = min(INIT_CWND, max_win)
+
+    def on_ack(self, acked, base, now, srtt):
+        if self.in_recovery: # the retransmit got through, deflate
+            self.in_recovery = False
+            self.cwnd = self.ssthresh
+            return False
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked # slow start
+        else:
+            self.grow(acked, now, srtt)
+        self.cwnd = min(self.cwnd, self.max_win) # no point growing past what can be used
+        return False
+
+    # congestion avoidance, one segment per rtt
+    def grow(self, acked, now, srtt):
+        self.cwnd += acked / self.cwnd
+
+    # new ssthresh after a loss
+    def reduce(self, in_flight):
+        return max(in_flight // 2, MIN_SSTHRESH)
+
+    def on_dupack(self):
+        if self.in_recovery:
+            self.cwnd += 1 # every dupack is a segment that left the network
+
+    def on_fast_retransmit(self, in_flight, nxt, now):
+        if self.in_recovery:
+            return
+        self.ssthresh = self.reduce(in_flight)
+        self.cwnd = self.ssthresh + 3
+        self.in_recovery = True
+        self.recover = nxt
+
+    def on_timeout(self, in_flight, now):
+        self.ssthresh = self.reduce(in_flight)
+        self.cwnd = 1
+        self.in_recovery = False
+
+
+class NewReno(Reno):
+    name = "newreno"
+
+    def on_ack(self, acked, base, now, srtt):
+        if self.in_recovery and base < self.recover:
+            # partial ack, another segment from the same window was lost
+            # so stay in recovery and resend the next hole straight away
+            self.cwnd = max(self.cwnd - acked + 1, 1)
+            return True
+        return super().on_ack(acked, base, now, srtt)
+
+
+class Cubic(NewReno):
+    name = "cubic"
+
+    def __init__(self, max_win):
+        super().__init__(max_win)
+        self.w_max = 0
+        self.k = 0
+        self.epoch_start = None
+        self.w_est = 0 # what reno would have by now, cubic never does worse
+
+    def grow(self, acked, now, srtt):
+        if self.epoch_start == None: # first ack since the last loss
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / CUBIC_C) ** (1 / 3)
+            else:
+                self.k = 0
+                self.w_max = self.cwnd
+            self.w_est = self.cwnd
+
+        t = now - self.epoch_start + (srtt if srtt != None else 0)
+        target = CUBIC_C * (t - self.k) ** 3 + self.w_max
+        self.w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked / self.cwnd
+        target = max(target, self.w_est)
+
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+
+    def reduce(self, in_flight):
+        self.epoch_start = None
+        if self.cwnd < self.w_max: # fast convergence, give up bandwidth to newer flows
+            self.w_max = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        return max(math.floor(self.cwnd * CUBIC_BETA), MIN_SSTHRESH)
+
+
+ALGORITHMS = {
+    CongestionControl.name: CongestionControl,
+    Reno.name: Reno,
+    NewReno.name: NewReno,
+    Cubic.name: Cubic
+}
+
+def make(name, max_win):
+    return ALGORITHMS[name](max_win)
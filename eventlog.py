@@ -0,0 +1,163 @@
+# event logs for the sender and receiver. the send / receive path only appends
+# a tuple to a queue, a background thread formats and writes them in batches
+#
+# a binary trace can be written instead of text, render it back into the
+# usual text log with: python eventlog.py Sender_trace.bin > Sender_log.txt
+import sys
+import struct
+import threading
+import collections
+import math
+
+# log levels
+LOG_OFF = 0
+LOG_SUMMARY = 1 # final stats only
+LOG_PACKET = 2 # every send, receive and drop
+
+LEVELS = {
+    "off": LOG_OFF,
+    "summary": LOG_SUMMARY,
+    "packet": LOG_PACKET
+}
+
+BATCH = 256 # records that wake the writer early
+MAX_PENDING = 64 * 1024 # records queued before logging calls wait for the writer
+FLUSH_INTERVAL = 0.05 # seconds
+
+# binary trace layout: header, then packet and text records
+TRACE_MAGIC = b"STPT"
+TRACE_HEADER = struct.Struct('<4sBBH') # magic, version, has rtt columns, length of type names
+TRACE_VERSION = 1
+PACKET = struct.Struct('<BdBIIdd') # action, time ms, seg type, seqno, bytes, rtt ms, rto ms
+TEXT = struct.Struct('<BI') # TEXT_RECORD, length of the utf-8 text after it
+TEXT_RECORD = 0xFF
+
+ACTIONS = ["snd", "rcv", "drp"]
+ACTION_CODES = {name: i for i, name in enumerate(ACTIONS)}
+
+# one log line in the text layout, rtt and rto columns only on the sender log
+def format_line(action, t, seg_type, seqno, size, rtt, rto, type_names, rtt_columns):
+    time_str = f"{t:.2f}"
+    line = f'{action.ljust(5)} {time_str.ljust(10)} {type_names.get(seg_type, "Unknown").ljust(5)} {str(seqno).ljust(5)} {str(size).ljust(5)}'
+    if rtt_columns:
+        rtt_str = f"{rtt:.2f}" if rtt != None else "-"
+        line += f' {rtt_str.ljust(8)} {f"{rto:.2f}".ljust(8)}'
+    return line + '\n'
+
+class EventLog:
+    def __init__(self, path, type_names, level = LOG_PACKET, binary = False, rtt_columns = False):
+        self.path = path
+        self.type_names = type_names
+        self.level = level
+        self.binary = binary
+        self.rtt_columns = rtt_columns
+
+        self.pending = collections.deque() # deque appends are thread safe and lock free
+        self.wake = threading.Event()
+        self.drained = threading.Event()
+        self.closed = False
+        self.writer = None
+        if level == LOG_OFF:
+            return
+
+        self.f = open(path, "wb" if binary else "w")
+        if binary:
+            names = ",".join(f"{k}={v}" for k, v in type_names.items()).encode()
+            self.f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, rtt_columns, len(names)) + names)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # one send / receive / drop, t is ms since the connection started
+    def packet(self, action, t, seg_type, seqno, size, rtt = None, rto = None):
+        if self.level < LOG_PACKET:
+            return
+        self.pending.append((action, t, seg_type, seqno, size, rtt, rto))
+        if len(self.pending) >= BATCH:
+            self.wake.set()
+            if len(self.pending) >= MAX_PENDING: # writer is behind, wait for it
+                self.drained.clear()
+                self.drained.wait()
+
+    # free text such as the final stats
+    def summary(self, text):
+        if self.level < LOG_SUMMARY:
+            return
+        self.pending.append(text)
+        self.wake.set()
+
+    def write_loop(self):
+        while 1:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            closing = self.closed
+            self.write_batch()
+            self.drained.set()
+            if closing:
+                return
+
+    def write_batch(self):
+        out = []
+        while len(self.pending) > 0:
+            rec = self.pending.popleft()
+            if self.binary:
+                out.append(self.encode(rec))
+            elif isinstance(rec, str):
+                out.append(rec)
+            else:
+                out.append(format_line(*rec, self.type_names, self.rtt_columns))
+        if len(out) > 0:
+            self.f.write((b"" if self.binary else "").join(out))
+            self.f.flush()
+
+    def encode(self, rec):
+        if isinstance(rec, str):
+            text = rec.encode()
+            return TEXT.pack(TEXT_RECORD, len(text)) + text
+        action, t, seg_type, seqno, size, rtt, rto = rec
+        return PACKET.pack(ACTION_CODES[action], t, seg_type, seqno, size,
+                           math.nan if rtt == None else rtt, math.nan if rto == None else rto)
+
+    # writes out everything still queued
+    def close(self):
+        if self.writer == None:
+            return
+        self.closed = True
+        self.wake.set()
+        self.writer.join()
+        self.f.close()
+        self.writer = None
+
+
+# turns a binary trace back into the text log layout
+def render(trace, out):
+    data = trace.read()
+    magic, version, rtt_columns, names_len = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        sys.exit("not an stp trace")
+    i = TRACE_HEADER.size
+    type_names = {}
+    for entry in data[i:i + names_len].decode().split(","):
+        code, name = entry.split("=")
+        type_names[int(code)] = name
+    i += names_len
+
+    while i < len(data):
+        if data[i] == TEXT_RECORD:
+            _, size = TEXT.unpack_from(data, i)
+            i += TEXT.size
+            out.write(data[i:i + size].decode())
+            i += size
+        else:
+            action, t, seg_type, seqno, size, rtt, rto = PACKET.unpack_from(data, i)
+            i += PACKET.size
+            rtt = None if math.isnan(rtt) else rtt
+            out.write(format_line(ACTIONS[action], t, seg_type, seqno, size, rtt, rto, type_names, rtt_columns))
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("usage: python eventlog.py TRACE_FILE")
+    with open(sys.argv[1], "rb") as trace:
+        render(trace, sys.stdout)
+
+if __name__ == '__main__':
+    sys.exit(main())
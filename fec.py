@@ -0,0 +1,113 @@
+# forward error correction for the data segments. segments are taken in groups of
+# k by their index (offset / mss), after the last segment of a group the sender sends
+# one parity segment with the xor of their payloads (zero padded to the mss). the
+# receiver xors together whatever of the group it got, once only one segment is
+# missing and the parity is in, the xor of the two is the missing payload
+import math
+import struct
+
+GROUP = struct.Struct('!I') # bytes of data in the group, ahead of the xor in a parity payload
+MIN_K = 2 # a group of one would only be a copy of the segment
+MAX_K = 64 # the sender waits for up to k - 1 dupacks before a fast retransmit (see Sender.dupthresh)
+
+# little endian so a short payload is the same as one zero padded at the end
+def as_int(data):
+    return int.from_bytes(data, 'little')
+
+# sender side, sees every segment once when it is first sent, in order
+class Encoder:
+    def __init__(self, k, mss):
+        assert MIN_K <= k <= MAX_K and mss > 0
+        self.k = k
+        self.mss = mss
+        self.first = 0 # index of the first segment in the group
+        self.count = 0
+        self.size = 0
+        self.acc = 0
+
+    # adds segment i, returns (first index, parity payload) once its group is complete
+    def add(self, i, data):
+        if self.count == 0:
+            self.first = i
+        self.acc ^= as_int(data)
+        self.count += 1
+        self.size += len(data)
+        if self.count == self.k:
+            return self.flush()
+        return None
+
+    # parity of the group so far, for the short group at the end of the stream
+    def flush(self):
+        if self.count == 0:
+            return None
+        parity = (self.first, GROUP.pack(self.size) + self.acc.to_bytes(self.mss, 'little'))
+        self.count = self.size = self.acc = 0
+        return parity
+
+class Group:
+    __slots__ = ('acc', 'mask', 'count', 'size', 'parity', 'total')
+
+    def __init__(self):
+        self.acc = 0 # xor of the payloads received
+        self.mask = 0 # bit j set when segment j of the group was received
+        self.count = 0
+        self.size = 0 # bytes received
+        self.parity = None # xor of all of them, once the parity segment is in
+        self.total = 0 # bytes in the whole group, from the parity
+
+# receiver side, offsets are stream offsets (from the first data byte)
+class Decoder:
+    def __init__(self, k, mss):
+        assert MIN_K <= k <= MAX_K and mss > 0 # a group spans k * mss bytes of the stream
+        self.k = k
+        self.mss = mss
+        self.span = k * mss # stream bytes per group
+        self.groups = {} # group index -> Group, only groups with something missing
+        self.low = 0 # groups below this are behind the cumulative point
+
+    def group(self, g):
+        group = self.groups.get(g)
+        if group == None:
+            group = self.groups[g] = Group()
+        return group
+
+    # a data segment that was not a duplicate, returns (offset, payload) of a segment it lets be rebuilt
+    def add(self, offset, data):
+        g = offset // self.span
+        if g < self.low:
+            return None
+        group = self.group(g)
+        group.acc ^= as_int(data)
+        group.mask |= 1 << ((offset % self.span) // self.mss)
+        group.count += 1
+        group.size += len(data)
+        if group.count == self.k: # nothing to rebuild
+            del self.groups[g]
+            return None
+        return self.rebuild(g, group)
+
+    # a parity segment for the group starting at offset, same return as add
+    def parity(self, offset, payload):
+        g = offset // self.span
+        if g < self.low or len(payload) < GROUP.size:
+            return None
+        group = self.group(g)
+        group.total = GROUP.unpack_from(payload)[0]
+        group.parity = as_int(payload[GROUP.size:])
+        return self.rebuild(g, group)
+
+    def rebuild(self, g, group):
+        if group.parity == None or group.count != math.ceil(group.total / self.mss) - 1:
+            return None
+        missing = 0
+        while group.mask & 1 << missing:
+            missing += 1
+        data = (group.parity ^ group.acc).to_bytes(self.mss, 'little')[:group.total - group.size]
+        return g * self.span + missing * self.mss, data
+
+    # forgets the groups that end at or before the cumulative point
+    def release(self, rcv_nxt):
+        low = rcv_nxt // self.span
+        while self.low < low:
+            self.groups.pop(self.low, None)
+            self.low += 1
@@ -0,0 +1,133 @@
+# background writer for the receivers output files. the receive loop only queues
+# (fd, offset, data, owner) and goes back to the socket, one thread writes the data of
+# every connection out with one pwritev per run of contiguous segments. every write is
+# charged to the connection it came from, what a connection has queued but not yet
+# written counts against its receive window, so a slow disk closes the window instead
+# of overflowing buffers
+import os
+import threading
+import collections
+import time
+import metrics
+
+MAX_IOV = 1024 # buffers per pwritev, IOV_MAX on linux
+MAX_WRITE = 64 * 1024 # bytes per pwritev, the owners hear about the progress after every write
+
+# the one writer thread of a receiver or server, started with the first write
+class WriterThread:
+    def __init__(self):
+        self.pending = collections.deque() # (fd, offset, data, owner), appends are thread safe and lock free
+        self.files = {} # fd -> FileWriter, where an error on the fd is reported
+        self.wake = threading.Event()
+        self.cond = threading.Condition() # FileWriter.close waits on it for its writes
+        self.waiting = 0
+        self.closed = False
+        self.write_times = metrics.Histogram() # seconds per pwritev, only the writer thread observes it
+        self.thread = None
+
+    # queues data for offset in the file, the owner gets queued and written
+    # counters (each only ever changed by one thread) and on_written() calls
+    def write(self, fd, offset, data, owner):
+        self.pending.append((fd, offset, bytes(data), owner)) # data may point into a reused receive buffer
+        owner.queued += len(data)
+        if self.thread == None:
+            self.thread = threading.Thread(target=self.write_loop, daemon=True)
+            self.thread.start()
+        if not self.wake.is_set():
+            self.wake.set()
+
+    def write_loop(self):
+        while 1:
+            self.wake.wait()
+            self.wake.clear()
+            closing = self.closed
+            self.write_batch()
+            if closing:
+                return
+
+    # writes everything queued, runs of one owners segments that follow each other go out together
+    def write_batch(self):
+        while len(self.pending) > 0:
+            fd, offset, data, owner = self.pending.popleft()
+            bufs = [data]
+            end = offset + len(data)
+            while len(self.pending) > 0 and len(bufs) < MAX_IOV and end - offset < MAX_WRITE:
+                next_fd, next_offset, next_data, next_owner = self.pending[0]
+                if next_fd != fd or next_offset != end or next_owner is not owner:
+                    break
+                self.pending.popleft()
+                bufs.append(next_data)
+                end += len(next_data)
+            file = self.files[fd]
+            if file.error == None: # after an error the rest of the files data is dropped
+                start = time.perf_counter()
+                try:
+                    self.write_all(fd, bufs, offset, end - offset)
+                except OSError as e: # only this file, the other connections carry on
+                    file.error = e
+                self.write_times.observe(time.perf_counter() - start)
+            file.done += len(bufs)
+            if file.error == None:
+                owner.written += end - offset
+                owner.on_written()
+            if self.waiting > 0:
+                with self.cond:
+                    self.cond.notify_all()
+
+    def write_all(self, fd, bufs, offset, size):
+        if len(bufs) == 1:
+            done = os.pwrite(fd, bufs[0], offset)
+        elif hasattr(os, "pwritev"):
+            done = os.pwritev(fd, bufs, offset)
+        else:
+            bufs = [b"".join(bufs)]
+            done = os.pwrite(fd, bufs[0], offset)
+        if done < size: # short write, the rest goes out on its own
+            data = b"".join(bufs)
+            while done < size:
+                done += os.pwrite(fd, data[done:], offset + done)
+
+    # waits until everything queued for file has been written
+    def wait_for(self, file):
+        with self.cond:
+            self.waiting += 1
+            while file.done < file.sent:
+                self.wake.set()
+                self.cond.wait()
+            self.waiting -= 1
+
+    # writes out everything still queued and stops the thread
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread != None:
+            self.wake.set()
+            self.thread.join()
+
+# one output file on a WriterThread, what the receiver hands its data to
+class FileWriter:
+    def __init__(self, file, writes):
+        self.fd = file.fileno()
+        self.writes = writes
+        self.sent = 0 # segments handed to the thread
+        self.done = 0 # and written (or dropped after an error), only the writer thread changes this
+        self.error = None # OSError the writes to this file stopped on
+        self.closed = False
+        writes.files[self.fd] = self
+
+    def write(self, offset, data, owner):
+        self.sent += 1
+        self.writes.write(self.fd, offset, data, owner)
+
+    # waits until everything queued has been written
+    def flush(self):
+        self.writes.wait_for(self)
+
+    # writes out everything still queued, the file itself stays open
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        del self.writes.files[self.fd]
@@ -0,0 +1,164 @@
+# objects framed in the byte stream of one connection, so many files share one
+# handshake and one teardown. every object is a header (kind, name length, size)
+# then its name (utf-8) and its data. a zero byte where a header would start is
+# padding, the sender pads the stream to a whole segment when it has nothing else
+# to send rather than sending a short segment it would have to grow later
+import os
+import queue
+import struct
+import collections
+
+FRAME = struct.Struct('!BHQ') # kind, name length, data length
+PAD = 0
+OBJECT = 1
+
+Received = collections.namedtuple("Received", "name data")
+
+def header(name, size):
+    name = name.encode()
+    if len(name) > 0xFFFF:
+        raise ValueError("object name too long")
+    return FRAME.pack(OBJECT, len(name), size) + name
+
+# takes the in order byte stream apart again. has the same write / close / error
+# as a FileWriter so the receiver hands it data the same way, but parses on the
+# receive path and gives each object to a sink (begin, data, end, close)
+class ObjectWriter:
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = {} # stream offset -> data that arrived before the bytes in front of it
+        self.next = 0 # stream offset of the next in order byte
+        self.head = bytearray() # frame header read so far
+        self.left = None # data bytes of the current object still to come, None between objects
+        self.objects = 0 # complete ones
+        self.incomplete = False # the stream ended inside an object
+        self.closed = False
+        self.error = None
+
+    # the owner counts queued and written bytes like with a FileWriter, in order
+    # data counts as written once it has been parsed and handed to the sink
+    def write(self, offset, data, owner):
+        owner.queued += len(data)
+        if offset != self.next:
+            self.pending[offset] = bytes(data)
+            return
+        try:
+            self.parse(data, owner)
+            while self.next in self.pending:
+                self.parse(self.pending.pop(self.next), owner)
+        except (ValueError, OSError) as e:
+            self.error = e
+        owner.on_written()
+
+    def parse(self, data, owner):
+        view = memoryview(data)
+        self.next += len(view)
+        i = 0
+        while i < len(view):
+            if self.left != None: # inside an object
+                n = min(self.left, len(view) - i)
+                self.sink.data(view[i:i + n])
+                self.left -= n
+                i += n
+                if self.left == 0:
+                    self.end()
+            elif len(self.head) == 0 and view[i] == PAD:
+                i = len(view) - len(bytes(view[i:]).lstrip(b"\0"))
+            else:
+                i = self.parse_header(view, i)
+        owner.written += len(view)
+
+    # adds to the frame header from view[i:], returns where it stopped
+    def parse_header(self, view, i):
+        need = FRAME.size
+        if len(self.head) >= FRAME.size:
+            need += FRAME.unpack_from(self.head)[1]
+        take = min(need - len(self.head), len(view) - i)
+        self.head += view[i:i + take]
+        i += take
+        if len(self.head) < FRAME.size:
+            return i
+        kind, name_len, size = FRAME.unpack_from(self.head)
+        if kind != OBJECT:
+            raise ValueError(f"bad frame kind {kind}")
+        if len(self.head) < FRAME.size + name_len: # the name is still to come
+            return i
+        name = bytes(self.head[FRAME.size:]).decode()
+        self.head.clear()
+        self.sink.begin(name, size)
+        self.left = size
+        if size == 0:
+            self.end()
+        return i
+
+    def end(self):
+        self.sink.end()
+        self.left = None
+        self.objects += 1
+
+    # the stream is over (the senders FIN), anything half received is dropped
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.incomplete = self.left != None or len(self.head) > 0
+        self.sink.close()
+
+# writes every object to a file of its own in path, named after the object
+class DirectorySink:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.f = None
+        self.name = None # file of the current object
+        self.n = 0
+
+    def begin(self, name, size):
+        self.n += 1
+        name = os.path.basename(name)
+        if name in ("", ".", ".."): # the sender only names objects, it never picks directories
+            name = f"object_{self.n}"
+        self.name = os.path.join(self.path, name)
+        self.f = open(self.name, 'wb')
+
+    def data(self, view):
+        self.f.write(view)
+
+    def end(self):
+        self.f.close()
+        self.f = None
+
+    def close(self):
+        if self.f != None: # only part of it arrived
+            self.f.close()
+            self.f = None
+            os.remove(self.name)
+
+# objects as Received(name, data) for a consumer on another thread, iterating
+# over the sink yields them as they complete and stops once the stream is over
+class QueueSink:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.name = None
+        self.buf = None
+
+    def begin(self, name, size):
+        self.name = name
+        self.buf = bytearray()
+
+    def data(self, view):
+        self.buf += view
+
+    def end(self):
+        self.queue.put(Received(self.name, bytes(self.buf)))
+        self.buf = None
+
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while 1:
+            obj = self.queue.get()
+            if obj == None:
+                return
+            yield obj
@@ -0,0 +1,237 @@
+# udp relay that sits between the sender and the receiver and makes loopback
+# behave like a real path: one way delay with jitter, bursty (gilbert-elliott)
+# loss, reordering, duplication and a token bucket bandwidth limit with a
+# bounded queue behind it. every impairment applies to both directions unless
+# --forward-only / --reverse-only say otherwise
+#
+#   python receiver.py 6000 6001 out.txt 30000
+#   python impair.py 5001 6000 --back-port 6001 --delay 20 --jitter 2 --rate 10 --loss 0.01
+#   python sender.py 5000 5001 in.txt 30000 200 0 0
+#
+# the sender sends to listen_port, the relay forwards from back-port (what the
+# receiver takes as sender_port) to receiver_port and sends the acks back to
+# wherever the sender sent from. senders after the first get a back socket on a
+# free port, which a --multi receiver answers like any other sender.
+# one thread, datagrams wait in a heap until they are due and every socket is
+# drained with one recvmmsg per wakeup, so the relay keeps up with the sender
+import sys
+import argparse
+import heapq
+import random
+import select
+import time
+import signal
+import socket
+import batchio
+
+DATAGRAM_SIZE = 65507 # largest udp payload, the relay doesnt know the mss in use
+BURST = 16
+QUEUE_DATAGRAMS = 1024 # socket buffers of the relay hold this many datagrams
+
+# parse in args
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="udp impairment relay for STP")
+    parser.add_argument('listen_port', type=int, help="port the sender sends to")
+    parser.add_argument('receiver_port', type=int)
+    parser.add_argument('--back-port', type=int, default=0,
+                        help="port the first sender is relayed from, give it to the receiver as sender_port")
+    parser.add_argument('--delay', type=float, default=0, help="one way delay in ms")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="delay varies uniformly by up to this many ms either way, which can reorder")
+    parser.add_argument('--loss', type=float, default=0, help="loss probability (in the good state)")
+    parser.add_argument('--ge-p', type=float, default=0, help="gilbert-elliott good to bad transition probability")
+    parser.add_argument('--ge-r', type=float, default=1, help="gilbert-elliott bad to good transition probability")
+    parser.add_argument('--ge-loss', type=float, default=1, help="loss probability in the bad state")
+    parser.add_argument('--reorder', type=float, default=0,
+                        help="probability a datagram is held back by --reorder-gap")
+    parser.add_argument('--reorder-gap', type=float, default=1, help="extra delay of a reordered datagram in ms")
+    parser.add_argument('--duplicate', type=float, default=0, help="probability a datagram is sent twice")
+    parser.add_argument('--rate', type=float, default=0, help="bandwidth limit in Mbit/s (0 is unlimited)")
+    parser.add_argument('--burst', type=int, default=16 * 1024, help="token bucket size in bytes")
+    parser.add_argument('--queue', type=int, default=256 * 1024,
+                        help="bytes that may wait behind the rate limit before datagrams are dropped")
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument('--forward-only', action='store_true', help="only impair sender to receiver")
+    direction.add_argument('--reverse-only', action='store_true', help="only impair receiver to sender")
+    parser.add_argument('--seed', type=int, help="seed for the random choices, to replay the same impairments")
+
+    return parser.parse_args(args[1:])
+
+
+# raw bytes with what BatchIO needs to send them
+class Datagram:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def buffers(self):
+        return [self.data]
+
+    def serialise_into(self, buf, offset = 0):
+        buf[offset:offset + len(self.data)] = self.data
+        return len(self.data)
+
+
+# what happens to the datagrams going one way
+class Path:
+    def __init__(self, args, rng, impaired = True):
+        self.rng = rng
+        self.impaired = impaired
+        self.delay = args.delay / 1000
+        self.jitter = args.jitter / 1000
+        self.loss = args.loss
+        self.ge_p = args.ge_p
+        self.ge_r = args.ge_r
+        self.ge_loss = args.ge_loss
+        self.bad = False # gilbert-elliott state
+        self.reorder = args.reorder
+        self.reorder_gap = args.reorder_gap / 1000
+        self.duplicate = args.duplicate
+
+        # token bucket, tokens go negative while datagrams queue up behind the limit
+        self.rate = args.rate * 1e6 / 8 # bytes per second
+        self.burst = args.burst
+        self.queue = args.queue
+        self.tokens = args.burst
+        self.refilled_at = time.monotonic()
+
+        # stats
+        self.forwarded = 0
+        self.lost = 0
+        self.queue_drops = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def lose(self):
+        if self.bad:
+            self.bad = self.rng.random() >= self.ge_r
+        else:
+            self.bad = self.rng.random() < self.ge_p
+        return self.rng.random() < (self.ge_loss if self.bad else self.loss)
+
+    # when a datagram of size bytes arriving now may leave the rate limit, None if the queue is full
+    def shape(self, size, now):
+        if self.rate <= 0:
+            return now
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if size - self.tokens > self.queue:
+            return None
+        self.tokens -= size
+        return now + max(0, -self.tokens) / self.rate
+
+    # release times for a datagram of size bytes, empty if it is dropped
+    def schedule(self, size, now):
+        if not self.impaired:
+            self.forwarded += 1
+            return [now]
+        if self.lose():
+            self.lost += 1
+            return []
+        copies = 1
+        if self.rng.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+        times = []
+        for _ in range(copies):
+            depart = self.shape(size, now)
+            if depart == None:
+                self.queue_drops += 1
+                continue
+            t = depart + max(0, self.delay + self.rng.uniform(-self.jitter, self.jitter))
+            if self.rng.random() < self.reorder:
+                self.reordered += 1
+                t += self.reorder_gap
+            times.append(t)
+        self.forwarded += len(times)
+        return times
+
+    def stats(self, name):
+        return (f'{name}: {self.forwarded} forwarded, {self.lost} lost, {self.queue_drops} dropped by the '
+                f'rate limit queue, {self.duplicated} duplicated, {self.reordered} reordered')
+
+
+class Relay:
+    def __init__(self, listen_port, receiver_port, back_port, forward, reverse):
+        self.receiver_addr = ('127.0.0.1', receiver_port)
+        self.back_port = back_port
+        self.forward = forward # Path sender -> receiver
+        self.reverse = reverse # Path receiver -> sender
+
+        self.front = self.open_socket(listen_port)
+        self.io = {self.front: batchio.BatchIO(self.front, DATAGRAM_SIZE, BURST)}
+        self.backs = {} # sender address -> back socket
+        self.senders = {} # back socket -> sender address
+
+        self.pending = [] # heap of (release time, n, socket, Datagram, address)
+        self.n = 0 # tie breaker so the heap never compares sockets, keeps arrival order
+
+    def open_socket(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', port))
+        sock.setblocking(False)
+        batchio.size_buffers(sock, QUEUE_DATAGRAMS, 1500)
+        return sock
+
+    # the socket that relays for a sender, the first one gets back_port
+    def back_for(self, addr):
+        sock = self.backs.get(addr)
+        if sock == None:
+            sock = self.open_socket(self.back_port if len(self.backs) == 0 else 0)
+            self.backs[addr] = sock
+            self.senders[sock] = addr
+            self.io[sock] = batchio.BatchIO(sock, DATAGRAM_SIZE, BURST)
+        return sock
+
+    def enqueue(self, path, data, sock, addr, now):
+        for t in path.schedule(len(data), now):
+            heapq.heappush(self.pending, (t, self.n, sock, Datagram(data), addr))
+            self.n += 1
+
+    def receive(self, sock, now):
+        for view, addr in self.io[sock].recv(ready=True):
+            data = bytes(view) # the view is reused by the next recv, the datagram may wait longer
+            if sock is self.front:
+                self.enqueue(self.forward, data, self.back_for(addr), self.receiver_addr, now)
+            else:
+                self.enqueue(self.reverse, data, self.front, self.senders[sock], now)
+
+    # sends everything that is due, one burst per socket
+    def release(self, now):
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            _, _, sock, datagram, addr = heapq.heappop(self.pending)
+            self.io[sock].queue(datagram, addr)
+        for io in self.io.values():
+            io.flush()
+
+    def run(self):
+        while 1:
+            now = time.monotonic()
+            self.release(now)
+            wait = max(0, self.pending[0][0] - now) if len(self.pending) > 0 else None
+            readable, _, _ = select.select(list(self.io), [], [], wait)
+            now = time.monotonic()
+            for sock in readable:
+                self.receive(sock, now)
+
+    def stats(self):
+        return self.forward.stats("sender -> receiver") + "\n" + self.reverse.stats("receiver -> sender")
+
+
+def main():
+    args = parse_args(sys.argv)
+    rng = random.Random(args.seed)
+    relay = Relay(args.listen_port, args.receiver_port, args.back_port,
+                  Path(args, rng, impaired=not args.reverse_only),
+                  Path(args, rng, impaired=not args.forward_only))
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # print the stats when killed too
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+    print(relay.stats())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
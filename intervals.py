@@ -0,0 +1,61 @@
+import bisect
+
+# sorted, non overlapping [start, end) byte ranges, adjacent ranges are merged
+# so the number kept is bounded by the number of holes, not the number of segments
+class IntervalSet:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        i = bisect.bisect_left(self.ends, start) # first range ending at or after start
+        j = bisect.bisect_right(self.starts, end) # ranges from i to j-1 touch [start, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    # true if [start, end) has already been added
+    def covers(self, start, end):
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    # the parts of [start, end) that havent been added yet
+    def gaps(self, start, end):
+        missing = []
+        i = bisect.bisect_right(self.ends, start) # first range ending past start
+        while start < end:
+            if i == len(self.starts) or self.starts[i] >= end:
+                missing.append((start, end))
+                break
+            if self.starts[i] > start:
+                missing.append((start, self.starts[i]))
+            start = self.ends[i]
+            i += 1
+        return missing
+
+    # removes the ranges that start at or before start and returns where the
+    # contiguous run ends, so a cumulative point can jump over it in one step
+    def pop_from(self, start):
+        while len(self.starts) > 0 and self.starts[0] <= start:
+            start = max(self.ends[0], start)
+            del self.starts[0]
+            del self.ends[0]
+        return start
+
+    # total bytes held
+    def size(self):
+        return sum(end - start for start, end in self)
+
+    def clear(self):
+        self.starts.clear()
+        self.ends.clear()
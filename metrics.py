@@ -0,0 +1,244 @@
+# live metrics for the sender and receiver. the send / receive path only bumps
+# counters and histograms, everything else (bytes acked, windows, buffers) is read
+# straight off the connection by a collect function when a snapshot is taken. a
+# background thread takes one every interval and writes it out as a json line or in
+# prometheus text format, and passes it to any hooks registered from python
+import os
+import json
+import time
+import math
+import bisect
+import socket
+import threading
+import collections
+
+INTERVAL = 1.0 # seconds between snapshots
+
+FORMATS = ["json", "prometheus"]
+
+# histogram bucket bounds in seconds, doubling from 10us to about 20s
+TIME_BUCKETS = [0.00001 * 2**i for i in range(22)]
+
+# counts of observations per bucket, like a prometheus histogram. observe is one
+# bisect and two adds, every histogram is only observed by one thread at a time
+# (the rtt with the senders lock held, lock waits once the lock is taken, writes on the writer thread)
+class Histogram:
+    def __init__(self, bounds = TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last one is everything past the largest bound
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket the q quantile falls in, None before the first observation
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    # (bound, observations up to it) pairs, the last bound is inf
+    def cumulative(self):
+        seen = 0
+        buckets = []
+        for bound, count in zip(self.bounds + [math.inf], list(self.counts)):
+            seen += count
+            buckets.append((bound, seen))
+        return buckets
+
+# json has no infinity, the open ended bucket is written like prometheus writes it
+def json_bound(bound):
+    return "+Inf" if bound == math.inf else bound
+
+# a lock that records how long it was waited for. an uncontended acquire is a
+# plain non blocking acquire, the clock is only read when someone else holds it
+class TimedLock:
+    def __init__(self, waits):
+        self.lock = threading.Lock()
+        self.waits = waits # Histogram of the seconds waited, 0 when it was free
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.waits.observe(time.perf_counter() - start)
+        else:
+            self.waits.observe(0)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+# where snapshots go: a file (json lines are appended, prometheus text replaces the
+# file each time like a node exporter textfile) or udp:HOST:PORT, one datagram per snapshot
+class Sink:
+    def __init__(self, dest, fmt):
+        self.dest = dest
+        self.fmt = fmt
+        self.sock = None
+        self.f = None
+        if dest.startswith("udp:"):
+            host, port = dest[4:].rsplit(":", 1)
+            self.addr = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif fmt == "json":
+            self.f = open(dest, "w")
+
+    def write(self, text):
+        if self.sock != None:
+            try:
+                self.sock.sendto(text.encode(), self.addr)
+            except OSError:
+                pass # nobody listening, the next snapshot tries again
+        elif self.f != None:
+            self.f.write(text)
+            self.f.flush()
+        else: # a scraper never sees half a file
+            tmp = self.dest + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(text)
+            os.replace(tmp, self.dest)
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+        if self.f != None:
+            self.f.close()
+
+# counters and histograms for one sender or receiver. names ending in _total are
+# counters, everything else a collect function returns is a gauge. labels go on
+# every line (e.g. the role and the peer) so several exports can share a scraper
+class Metrics:
+    def __init__(self, prefix, labels = None):
+        self.prefix = prefix
+        self.labels = labels if labels != None else {}
+        self.counters = collections.Counter() # counted on the send / receive path
+        self.histograms = {} # name -> Histogram
+        self.collectors = [] # functions returning {name: value}, called for every snapshot
+        self.last = {} # name -> (time, total) of the last rate()
+        self.hooks = [] # called with every snapshot dict
+        self.sinks = []
+        self.interval = INTERVAL
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+
+    def count(self, name, n = 1):
+        self.counters[name] += n
+
+    def histogram(self, name, bounds = TIME_BUCKETS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    # per second change of a total since the last snapshot, for collect functions
+    def rate(self, name, total):
+        now = time.monotonic()
+        last_time, last_total = self.last.get(name, (None, 0))
+        self.last[name] = (now, total)
+        if last_time == None or now == last_time:
+            return None
+        return (total - last_total) / (now - last_time)
+
+    def collect(self, fn):
+        self.collectors.append(fn)
+
+    # fn(snapshot) after every snapshot, on the exporter thread
+    def add_hook(self, fn):
+        self.hooks.append(fn)
+
+    def export_to(self, dest, fmt = "json"):
+        self.sinks.append(Sink(dest, fmt))
+
+    # everything as one dict. gauges are read without the connections lock,
+    # so they may be a few segments apart from each other
+    def snapshot(self):
+        values = dict(self.counters)
+        for fn in self.collectors:
+            values.update(fn())
+        histograms = {}
+        for name, hist in list(self.histograms.items()):
+            histograms[name] = {
+                "count": hist.count,
+                "sum": hist.sum,
+                "p50": json_bound(hist.quantile(0.5)),
+                "p99": json_bound(hist.quantile(0.99)),
+                "buckets": [[json_bound(bound), seen] for bound, seen in hist.cumulative()]
+            }
+        return {"time": time.time(), "labels": self.labels,
+                "values": {k: v for k, v in values.items() if v != None}, "histograms": histograms}
+
+    def to_json(self, snap):
+        return json.dumps(snap) + "\n"
+
+    def to_prometheus(self, snap):
+        labels = ",".join(f'{k}="{v}"' for k, v in snap["labels"].items())
+        lines = []
+        for name, value in sorted(snap["values"].items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{full}{{{labels}}} {value}" if labels else f"{full} {value}")
+        sep = "," if labels else ""
+        for name, hist in sorted(snap["histograms"].items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} histogram")
+            for bound, seen in hist["buckets"]:
+                lines.append(f'{full}_bucket{{{labels}{sep}le="{bound}"}} {seen}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{full}_sum{suffix} {hist['sum']}")
+            lines.append(f"{full}_count{suffix} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        snap = self.snapshot()
+        for sink in self.sinks:
+            sink.write(self.to_json(snap) if sink.fmt == "json" else self.to_prometheus(snap))
+        for fn in self.hooks:
+            fn(snap)
+
+    # exports every interval seconds on a background thread until close()
+    def start(self, interval = INTERVAL):
+        self.interval = interval
+        self.thread = threading.Thread(target=self.export_loop, daemon=True)
+        self.thread.start()
+
+    def export_loop(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.export() # close() wakes it for the final snapshot
+
+    # takes a last snapshot, so the final counts are always exported
+    def close(self):
+        if self.thread == None:
+            return
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+        for sink in self.sinks:
+            sink.close()
+
+def add_arguments(parser):
+    parser.add_argument('--metrics', default=None,
+                        help="export live metrics to this file, or to udp:HOST:PORT")
+    parser.add_argument('--metrics-format', choices=FORMATS, default="json",
+                        help="json lines, or prometheus text (the file is replaced with every snapshot)")
+    parser.add_argument('--metrics-interval', type=float, default=INTERVAL * 1000,
+                        help="ms between metrics snapshots")
+
+# exports what the command line asked for, if anything
+def start_from_args(metrics, args, dest = None):
+    dest = dest if dest != None else args.metrics
+    if dest == None:
+        return
+    metrics.export_to(dest, args.metrics_format)
+    metrics.start(args.metrics_interval / 1000)
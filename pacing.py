@@ -0,0 +1,58 @@
+# pacing for the sender, new segments leave at a rate instead of a whole window
+# back to back whenever an ack opens it. a token bucket fills at the rate, a segment
+# goes once there are tokens for it, otherwise the sender sleeps until there will be.
+# the rate is fixed or follows the congestion window, cwnd / srtt times a gain (like
+# linux: twice that in slow start so the window can still double every rtt, 1.2 after).
+# tokens build up while the sender sleeps, but the bucket only holds a quantum of the
+# rate (at least MIN_BURST segments), so an idle sender starts again with a short burst,
+# not a window. the quantum is about how late a wakeup usually is, so such a wakeup
+# sends a little more and the average rate holds. tokens past the cap are lost, a
+# wakeup later than that leaves the rate a little short
+MIN_BURST = 2 # segments the bucket always holds
+QUANTUM = 0.0002 # seconds of the rate in the bucket, about how late a thread wakes from a timed wait
+ASYNC_QUANTUM = 0.002 # the asyncio loop sleeps in whole ms (epoll) and wakes up to a ms late on top
+GAIN_SLOW_START = 2.0
+GAIN = 1.2
+MIN_RTT = 0.00001 # seconds, keeps a loopback srtt from dividing by next to nothing
+
+# rate from the command line: "auto" follows the window, anything else is Mbit/s
+def parse_rate(value):
+    if value == "auto":
+        return None
+    mbps = float(value)
+    if mbps <= 0:
+        raise ValueError(value)
+    return mbps * 1e6 / 8
+
+class Pacer:
+    def __init__(self, rate = None, quantum = QUANTUM):
+        self.rate = rate # bytes per second, None to follow the window
+        self.quantum = quantum
+        self.tokens = None # a full bucket to start with
+        self.refilled_at = 0
+        self.waits = 0 # times a segment was held back
+
+    # rate for a window of cwnd bytes over srtt, None before the first rtt sample
+    def window_rate(self, cwnd, srtt, slow_start):
+        if self.rate != None:
+            return self.rate
+        if srtt == None:
+            return None
+        return (GAIN_SLOW_START if slow_start else GAIN) * cwnd / max(srtt, MIN_RTT)
+
+    # takes size bytes from the bucket and returns 0 if they may go now,
+    # otherwise the seconds until they may (and takes nothing)
+    def take(self, size, rate, now, mss):
+        if rate == None:
+            return 0
+        cap = max(MIN_BURST * mss, rate * self.quantum)
+        if self.tokens == None:
+            self.tokens = cap
+        else:
+            self.tokens = min(cap, self.tokens + (now - self.refilled_at) * rate)
+        self.refilled_at = now
+        if self.tokens >= size:
+            self.tokens -= size
+            return 0
+        self.waits += 1
+        return (size - self.tokens) / rate
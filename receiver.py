@@ -2,10 +2,23 @@
 
 import sys
 from socket import *
-from stp import STPSegment
+from stp import STPSegment, MAX_HEADER_SIZE, MAX_OPTIONS_SIZE, OPT_SACK_PERMITTED, OPT_SACK, OPT_STRIPE, OPT_MSS, OPT_WIDE, OPT_WINDOW, OPT_OBJECTS, OPT_FEC, OPT_COMPRESS, STRIPE, FEC, COMPRESS, WINDOW, pack_sack
+import stp
 import time
 import math
+import os
+import argparse
+import eventlog
+import metrics
+import batchio
+import filewriter
+import framing
+import fec
+import compress
+import timers
+import asyncio
 import threading
+from intervals import IntervalSet
 
 NUM_ARGS = 4
 
@@ -14,6 +27,7 @@ DATA = 0
 ACK = 1
 SYN = 2
 FIN = 3
+PARITY = 4
 
 # states
 CLOSED = 0
@@ -25,42 +39,150 @@ constant_map = {
     DATA: "DATA",
     ACK: "ACK",
     SYN: "SYN",
-    FIN: "FIN"
+    FIN: "FIN",
+    PARITY: "PAR"
 }
 
-MSS = 1000
 MSL = 1 # second
+TIME_WAIT_POLL = 0.1 # how often the threaded loop checks if TIME_WAIT is over
+ACK_EVERY = 2 # in order segments per ack (rfc 5681 acks at least every second one)
+ACK_DELAY = 0.005 # seconds an in order segment may wait for its ack, short next to the senders MIN_RTO
+
+MALFORMED_LOGGED = 100 # malformed datagrams logged one by one, after that they are only counted
+
+LOG_FILE = "Receiver_log.txt"
+TRACE_FILE = "Receiver_trace.bin"
+
+# a datagram that isnt a segment is dropped, the first few are logged
+def log_malformed(log, count, addr, data, error):
+    if count <= MALFORMED_LOGGED:
+        log.summary(f'Dropped a malformed datagram of {len(data)} bytes from {addr[0]}:{addr[1]} ({error})\n')
 
 # parse in args
 def parse_args(args):
-    receiver_port = int(args[1])
-    sender_port = int(args[2])
-    txt_file_rcvd = args[3]
-    max_win = int(args[4])
-
-    return receiver_port, sender_port, txt_file_rcvd, max_win
+    parser = argparse.ArgumentParser(description="STP receiver")
+    parser.add_argument('receiver_port', type=int)
+    parser.add_argument('sender_port', type=int)
+    parser.add_argument('txt_file_rcvd')
+    parser.add_argument('max_win', type=int, help="max window in bytes")
+    parser.add_argument('--log', choices=eventlog.LEVELS, default="packet", help="what goes in the log")
+    parser.add_argument('--trace', action='store_true',
+                        help=f"write a binary trace to {TRACE_FILE} instead of the text log")
+    parser.add_argument('--engine', choices=["thread", "asyncio"], default="thread",
+                        help="run with a blocking receive loop and a timer thread, or in one asyncio event loop")
+    parser.add_argument('--timer-resolution', type=float, default=timers.RESOLUTION * 1000,
+                        help="timer resolution in ms")
+    parser.add_argument('--ack-every', type=int, default=ACK_EVERY,
+                        help="ack every this many in order segments, a burst read off the socket together is acked once")
+    parser.add_argument('--ack-delay', type=float, default=ACK_DELAY * 1000,
+                        help="ms an in order segment waits for its ack at most")
+    parser.add_argument('--mss', type=int, default=stp.DEFAULT_MSS,
+                        help=f"largest segment payload to accept, a sender asking for more gets this ({stp.MIN_MSS} to {stp.MAX_MSS})")
+    parser.add_argument('--multi', action='store_true',
+                        help="serve many senders on receiver_port, replies go to each senders own address "
+                             "(sender_port is ignored) and txt_file_rcvd is a pattern for the output files, "
+                             "e.g. out_{n}.txt with {n} the connection number, {host} and {port} the sender")
+    parser.add_argument('--connections', type=int, default=0,
+                        help="with --multi, exit after this many transfers have finished, a striped one counting once (0 runs until interrupted)")
+    parser.add_argument('--objects', action='store_true',
+                        help="take a stream of objects from a sender run with --objects, txt_file_rcvd is the "
+                             "directory they are written to (with --multi every connection that sends objects gets "
+                             "a directory named by the pattern)")
+    metrics.add_arguments(parser)
+
+    return parser.parse_args(args[1:])
+
+
+# socket buffers for window bytes of data, counted in segments of the smallest
+# size a sender is likely to use since every datagram costs extra buffer space
+def size_buffers(sock, window, mss):
+    mss = min(mss, stp.DEFAULT_MSS)
+    batchio.size_buffers(sock, math.ceil(window / mss), mss + MAX_HEADER_SIZE)
 
 
 class Receiver:
-    def __init__(self, receiver_port, sender_port, txt_file_rcvd, max_win, state = CLOSED):
+    def __init__(self, receiver_port, sender_port, txt_file_rcvd, max_win, state = CLOSED,
+                 log_level = eventlog.LOG_PACKET, trace = False, timer_resolution = timers.RESOLUTION,
+                 server = None, peer = None, mss = stp.DEFAULT_MSS, ack_every = ACK_EVERY, ack_delay = ACK_DELAY):
 
         self.sender_port = sender_port
         self.receiver_port = receiver_port
         self.txt_file_rcvd =  txt_file_rcvd
-        self.max_win = math.ceil(max_win /  MSS)
+        self.max_win = max_win # bytes that may be held past the cumulative point
+        self.write_buffer = max_win # and how far the writer may fall behind before the window starts to close
         self.state = state
-
-        self.sock = socket(AF_INET, SOCK_DGRAM) # create socket
+        self.mss = max(1, min(mss, max_win, stp.MAX_MSS)) # the most that is agreed to, a segment never exceeds max_win
+        self.shared = server != None
+
+        self.sender_addr = peer if peer != None else ('127.0.0.1', self.sender_port)
+        if server == None:
+            self.sock = socket(AF_INET, SOCK_DGRAM) # create socket
+            self.transport = None # set when an asyncio loop owns the socket
+            self.io = batchio.BatchIO(self.sock, self.mss + MAX_HEADER_SIZE + MAX_OPTIONS_SIZE) # bursts of segments and acks
+            size_buffers(self.sock, max_win, self.mss)
+            self.timers = timers.TimerWheel(timer_resolution)
+            self.log = eventlog.EventLog(TRACE_FILE if trace else LOG_FILE, constant_map, log_level, binary=trace)
+            self.metrics = metrics.Metrics("stp_receiver", {"port": receiver_port})
+            self.metrics.collect(self.collect_metrics)
+            # the receive loop, the delayed ack timer and window updates
+            self.lock = metrics.TimedLock(self.metrics.histogram("lock_wait_seconds"))
+            self.notify = None # call_soon_threadsafe of the event loop, for window updates from the writer thread
+            self.writes = filewriter.WriterThread() # started by the first write, if there is one
+        else:
+            # one of many connections on a server, the socket, timers and log are shared
+            self.sock = server.sock
+            self.transport = server.transport
+            self.io = server.io
+            self.timers = server.timers
+            self.log = server.log
+            self.metrics = server.metrics
+            self.lock = server.lock
+            self.notify = server.notify
+            self.writes = server.writes
+        self.file = None # output file, None for objects
+        self.writer = None # FileWriter for the output file, only with flow control or compression (see negotiate)
+        self.framed = False # the stream carries objects, the writer is a framing.ObjectWriter and there is no file
+        self.codec = None # the stream is compressed with this, the writer is a compress.Decompressor
+        self.stripe = None # (transfer id, index, count, offset) when this connection carries one stripe of a file
+        self.base_offset = 0 # where the stream starts in the output file
         self.time_start = 0
-        self.timer = threading.Timer(2 * MSL, self.to_closed_state)
+        self.timer = None
         self.close_started = False
+        self.on_closed = None # called once TIME_WAIT is over
+        self.on_failed = None # called instead when the connection had to be dropped, with the lock held
+        self.error = None # why it was dropped
         self.first = False # indicates if the very first has been sent
 
-        self.received_seqnos = set()
-
-        # buffer variables
-        self.buffer = []
-        self.expected = 0
+        self.sack_ok = False # sender asked for SACK blocks in the SYN
+        self.seq = stp.NARROW # 32 bit seqnos once the sender offered them
+        self.fec = None # fec.Decoder once the sender asked for parity segments
+        self.rebuilt = set() # stream offsets of segments rebuilt from parity
+
+        # reassembly, data is written straight to its offset in the file and
+        # held records which ranges past the cumulative point have arrived
+        self.held = IntervalSet()
+        self.rcv_nxt = 0 # file offset of the next in order byte
+        self.expected = 0 # and its seqno
+
+        # delayed acks, in order data is acked every ack_every segments or after ack_delay.
+        # out of order data, duplicates and anything that fills a hole are acked straight
+        # away, and whatever is owed after a burst goes out as one cumulative ack
+        self.ack_every = max(1, ack_every)
+        self.ack_delay = ack_delay
+        self.unacked = 0 # in order segments since the last ack
+        self.unacked_since = 0 # time.monotonic() the first of them arrived
+        self.ack_delays = self.metrics.histogram("ack_delay_seconds") # how long in order data waited for its ack
+        self.ack_owed = False # an ack is due at the end of the burst
+        self.ack_timer = None
+        self.ack_gen = 0 # tells a stale ack timer from the current one
+
+        # flow control, once the sender asked for it every ack advertises the
+        # room left. the edge is where the window ends as a file offset, it only moves
+        # forward so data sent into a window the receiver advertised is never refused
+        self.flow = False
+        self.edge = 0
+        self.queued = 0 # bytes handed to the writer, only the receive path changes this
+        self.written = 0 # and written out, only the writer changes this
 
         # log
         self.last_fin_seqno = 0
@@ -68,157 +190,796 @@ class Receiver:
         self.segs_log = 0
         self.dupdata_log = 0
         self.dupacks_log = 0
-    
+        self.acks_log = 0
+        self.probes_log = 0
+        self.malformed_log = 0
+        self.parity_log = 0
+        self.rebuilt_log = 0
+        self.rebuilt_dups_log = 0 # rebuilt segments the sender resent anyway
+        self.sock_drops = None # datagrams lost in the socket buffers, when known
+
+    # on the socket the ack is only queued, the receive loop flushes the acks
+    # for everything it took off the socket in one burst
     def send_segment(self, segment):
-        seg_bytes = segment.serialise()
-        self.sock.sendto(seg_bytes, ('localhost', self.sender_port))
+        if self.transport != None:
+            self.transport.sendto(segment.serialise(), self.sender_addr)
+        else:
+            self.io.queue(segment, self.sender_addr)
         self.update_logs("snd", segment)
-    
-    def receive_segment(self):
+
+    # every segment waiting on the socket
+    def receive_segments(self):
         try:
-            seg_bytes, _ = self.sock.recvfrom(MSS + 4)
+            burst = self.io.recv()
+        except timeout:
+            raise
         except Exception as e:
             sys.exit(f"Failed to get segment")
-        rcvd_seg = STPSegment.deserialise(seg_bytes)
-        
-        return rcvd_seg
+
+        segs = []
+        for seg_bytes, addr in burst:
+            try:
+                segs.append(STPSegment.deserialise(seg_bytes))
+            except ValueError as e:
+                self.malformed_log += 1
+                log_malformed(self.log, self.malformed_log, addr, seg_bytes, e)
+        return segs
+
+    def count_drops(self):
+        drops = batchio.receive_drops(self.sock)
+        if drops != None:
+            self.sock_drops = drops + self.io.send_drops
     
-    # update the logs
+    # update the logs, the event log writes it out in the background
     def update_logs(self, action, segment):
-        seqno_str = str(segment.seqno)
-        seg_type = constant_map.get(segment.seg_type, "Unknown")
-        no_bytes = str(len(segment.data))
-
-        t = time.time()
-        t_take = (t - self.time_start) * 1000
-        time_str =  f"{t_take:.2f}"
-
-        log_str = f'{action.ljust(5)} {time_str.ljust(10)} {seg_type.ljust(5)} {seqno_str.ljust(5)} {no_bytes.ljust(5)}\n'
+        t = (time.time() - self.time_start) * 1000
+        self.log.packet(action, t, segment.seg_type, segment.seqno, len(segment.data))
+
+    # options to answer a SYN with, only what the sender asked for is agreed to
+    def negotiate(self, syn):
+        # a resent SYN is agreed to on its own, a sender that gave up on options resends it plain
+        self.sack_ok = False
+        self.seq = stp.NARROW
+        self.fec = None
+        self.flow = False
+        if self.codec != None:
+            self.writer = self.writer.writer
+            self.codec = None
+        options = {}
+        if syn.options and OPT_SACK_PERMITTED in syn.options:
+            self.sack_ok = True
+            options[OPT_SACK_PERMITTED] = b""
+        if syn.options and len(syn.options.get(OPT_WIDE, b"")) == stp.ISN.size: # otherwise the 16 bit seqnos
+            self.seq = stp.WIDE
+            options[OPT_WIDE] = b""
+        if syn.options and OPT_MSS in syn.options:
+            mss = min(stp.MSS.unpack(syn.options[OPT_MSS])[0], self.mss)
+            options[OPT_MSS] = stp.MSS.pack(mss)
+            if not self.shared: # only this connection uses the buffers, no need for more than it agreed to
+                self.io.resize(mss + MAX_HEADER_SIZE + MAX_OPTIONS_SIZE)
+        else:
+            mss = stp.DEFAULT_MSS
+        self.mss = min(mss, self.mss)
+        if syn.options and OPT_FEC in syn.options:
+            k = FEC.unpack(syn.options[OPT_FEC])[0]
+            if fec.MIN_K <= k <= fec.MAX_K: # otherwise no parity, the sender only sends it once this is echoed
+                self.fec = fec.Decoder(k, self.mss) # the sender pads parity to the agreed mss
+                options[OPT_FEC] = FEC.pack(k)
+        if syn.options and OPT_WINDOW in syn.options:
+            self.flow = True
+            options[OPT_WINDOW] = WINDOW.pack(self.window())
+        if self.stripe != None: # the server has a place to put this stripe
+            options[OPT_STRIPE] = STRIPE.pack(*self.stripe)
+        if self.framed:
+            if not syn.options or OPT_OBJECTS not in syn.options:
+                sys.exit("sender is not sending objects, run it with --objects")
+            options[OPT_OBJECTS] = b""
+        codec = None
+        if syn.options and OPT_COMPRESS in syn.options and self.stripe == None and not self.framed:
+            codec = COMPRESS.unpack(syn.options[OPT_COMPRESS])[0]
+            if codec in compress.available(): # otherwise the sender sends the file as it is
+                options[OPT_COMPRESS] = COMPRESS.pack(codec)
+            else:
+                codec = None
+        # a sender without flow control gets its writes done in step (receive_data),
+        # only the others go through the writer thread
+        if self.writer == None and self.file != None and (self.flow or codec != None):
+            self.writer = filewriter.FileWriter(self.file, self.writes)
+        if codec != None:
+            self.writer = compress.Decompressor(codec, self.writer)
+            self.codec = codec
+        return options
+
+    def unwritten(self):
+        return self.queued - self.written
+
+    # where the window could end now, the room left in max_win and the write buffer
+    def room(self):
+        return self.rcv_nxt + max(0, min(self.max_win, self.max_win + self.write_buffer - self.unwritten()))
+
+    # bytes the sender may send past the cumulative point
+    def window(self):
+        self.edge = max(self.edge, self.room())
+        return self.edge - self.rcv_nxt
+
+    # ack for seqno (the cumulative point), with the byte ranges held past
+    # it if SACK was agreed and the window if the sender does flow control.
+    # a dupack keeps the window where it was, an ack that opens it isnt a dupack to the sender
+    def make_ack(self, seqno, dup = False):
+        window = None
+        if self.flow:
+            window = self.edge - self.rcv_nxt if dup else self.window()
+        if not self.sack_ok or len(self.held) == 0:
+            return STPSegment(ACK, seqno, '', wide=self.seq.wide, window=window)
+        blocks = [(self.seq.add(self.first_ack, start), self.seq.add(self.first_ack, end))
+                  for start, end in self.held]
+        return STPSegment(ACK, seqno, '', {OPT_SACK: pack_sack(blocks)}, self.seq.wide, window)
+
+    # file offset of a seqno, None if it is behind the cumulative point
+    def offset_of(self, seqno):
+        delta = self.seq.diff(seqno, self.expected)
+        if delta >= self.seq.half:
+            return None
+        return self.rcv_nxt + delta
+
+    # hands a data segment to the writer for its offset in the file and acks it
+    def receive_data(self, file, data_seg):
+        size = len(data_seg.data)
+        if size == 0: # window probe, the answer has the current window
+            self.send_ack(self.make_ack(self.expected))
+            self.probes_log += 1
+            return
+        offset = self.offset_of(data_seg.seqno)
+
+        if offset == None or self.held.covers(offset, offset + size):
+            # a duplicate, send a dupack
+            if self.fec != None and self.stream_offset(data_seg.seqno) in self.rebuilt:
+                self.rebuilt_dups_log += 1
+            dup_ack = self.make_ack(self.expected, dup=True)
+            self.send_ack(dup_ack)
+            self.dupdata_log += 1
+            self.dupacks_log += 1
+            return
+        if offset + size > self.rcv_nxt + self.max_win or self.unwritten() + size > self.max_win + self.write_buffer:
+            return # past what can be held, only a sender without flow control gets here
+        if self.writer != None and self.writer.error != None:
+            self.fail(f"Failed to write {self.txt_file_rcvd}: {self.writer.error}")
+            return
+
+        if self.writer != None:
+            self.writer.write(self.base_offset + offset, data_seg.data, self)
+        else: # a sender that cant be told to slow down, keep the writes in step with it
+            try:
+                os.pwrite(file.fileno(), data_seg.data, self.base_offset + offset)
+            except OSError as e:
+                self.fail(f"Failed to write {self.txt_file_rcvd}: {e}")
+                return
+        self.segs_log += 1
+        if offset == self.rcv_nxt:
+            # in order, the cumulative point jumps over anything already held after it.
+            # while there are holes the sender is recovering, so no delay then
+            recovering = len(self.held) > 0
+            self.rcv_nxt = self.held.pop_from(offset + size)
+            self.expected = self.seq.add(self.first_ack, self.rcv_nxt)
+            self.delay_ack(recovering)
+        else:
+            # out of order, remember the range and dupack straight away so the sender learns about the hole
+            self.held.add(offset, offset + size)
+            self.send_ack(self.make_ack(self.expected, dup=True))
+            self.dupacks_log += 1
+        if self.fec != None:
+            rebuilt = self.fec.add(offset, data_seg.data)
+            self.fec.release(self.rcv_nxt)
+            if rebuilt != None:
+                self.rebuild(file, *rebuilt)
+
+    # stream offset of any seqno within half the sequence space of the cumulative point
+    def stream_offset(self, seqno):
+        delta = self.seq.diff(seqno, self.expected)
+        if delta >= self.seq.half:
+            return self.rcv_nxt - self.seq.diff(self.expected, seqno)
+        return self.rcv_nxt + delta
+
+    # the parity of a group, once all but one of its segments are in the missing one is rebuilt
+    def receive_parity(self, file, seg):
+        if self.fec == None:
+            return
+        self.parity_log += 1
+        rebuilt = self.fec.parity(self.stream_offset(seg.seqno), seg.data)
+        if rebuilt != None:
+            self.rebuild(file, *rebuilt)
+
+    # a rebuilt segment goes through receive_data as if it had arrived
+    def rebuild(self, file, offset, data):
+        self.rebuilt_log += 1
+        self.rebuilt.add(offset)
+        self.receive_data(file, STPSegment(DATA, self.seq.add(self.first_ack, offset), data, wide=self.seq.wide))
+
+    # counts an in order segment, the ack is owed once ack_every of them
+    # have arrived (or at once if now or the sender has used up the window),
+    # until then the ack timer covers them
+    def delay_ack(self, now):
+        if self.unacked == 0:
+            self.unacked_since = time.monotonic()
+        self.unacked += 1
+        if now or self.unacked >= self.ack_every or (self.flow and self.stalled()):
+            self.ack_owed = True
+        elif self.ack_timer == None:
+            self.ack_timer = self.timers.call_later(self.ack_delay, self.ack_timeout, self.ack_gen)
+
+    # sends the ack owed for the segments handled so far, the receive loops call this after every burst
+    def send_acks(self):
+        if self.ack_owed and self.state != CLOSED:
+            self.send_ack(self.make_ack(self.expected))
+
+    # every ack carries the cumulative point, so it acks whatever was waiting too
+    def send_ack(self, ack):
+        if self.unacked > 0:
+            self.ack_delays.observe(time.monotonic() - self.unacked_since)
+        self.unacked = 0
+        self.ack_owed = False
+        if self.ack_timer != None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+            self.ack_gen += 1
+        self.acks_log += 1
+        self.send_segment(ack)
 
-        f = open("Receiver_log.txt", "a+")
-        f.write(log_str)
-        f.close()
+    # the writer wrote some of this connections data (runs on its thread). a sender that
+    # is stuck at the edge of the window hears about the room straight away, not from its next probe.
+    # the edge is only read with the lock held, so window_update decides whether one is due
+    def on_written(self):
+        if self.flow or self.codec != None:
+            if self.notify != None:
+                self.notify(self.window_update)
+            else: # not on this thread, closing a connection waits for the writer with the lock held
+                self.timers.call_later(0, self.window_update)
+
+    # no whole segment fits in what was advertised
+    def stalled(self):
+        return self.edge - self.rcv_nxt < self.mss
+
+    # the window grew enough to tell the sender before more data comes in:
+    # by a segment if it cant send anything, otherwise by half of max_win
+    def update_due(self):
+        gain = self.room() - self.edge
+        return gain >= self.mss and (self.stalled() or gain >= self.max_win // 2)
+
+    def window_update(self):
+        with self.lock:
+            if self.codec != None: # input the decompressor held back until the writer got further
+                self.writer.resume()
+            if self.flow and self.state == EST and self.update_due():
+                self.send_ack(self.make_ack(self.expected))
+        self.io.flush()
+
+    # ack_delay is over and in order data is still unacked, runs on the timer thread (or the event loop)
+    def ack_timeout(self, gen):
+        with self.lock:
+            if gen != self.ack_gen:
+                return # acked while waiting for the lock
+            self.ack_timer = None
+            self.ack_gen += 1
+            if self.unacked > 0 and self.state == EST:
+                self.send_ack(self.make_ack(self.expected))
+        self.io.flush()
+
+    # runs one received segment through the LISTEN / EST / TIME_WAIT state machine
+    def handle_segment(self, seg, file):
+        # CONNECTION SETUP #
+        if self.state == LISTEN:
+            if not self.first:
+                self.time_start = time.time()
+                self.first = True
+            self.update_logs("rcv", seg)
+
+            if seg.seg_type == SYN:
+                options = self.negotiate(seg)
+                isn = seg.seqno
+                if self.seq.wide: # the header only has the low 16 bits
+                    isn = stp.ISN.unpack(seg.options[OPT_WIDE])[0]
+                new_seqno = self.seq.add(isn, 1)
+                connection_ack = STPSegment(ACK, new_seqno, '', options, self.seq.wide)
+                self.first_ack = new_seqno # for log
+                self.expected = new_seqno
+                self.send_segment(connection_ack)
+                self.state = EST
 
-    # add data seg to buffer
-    def buffer_data(self, seg):
-        if len(self.buffer) < self.max_win:
-            self.buffer.append(seg)
-            self.buffer.sort(key=lambda x: x.seqno, reverse=True)
-
-    # write data to file, update the next expected seqno, send ack
-    def write_and_send(self, file, data_seg):
-        file.write(data_seg.data)
-        self.received_seqnos.add(data_seg.seqno)
-        self.expected = (data_seg.seqno + len(data_seg.data)) % 2**16
-        ack = STPSegment(ACK, self.expected, '')
-        self.send_segment(ack)
-        self.segs_log += 1
+        # START RECEIVING AND WRITING DATA #
+        elif self.state == EST:
+            self.update_logs("rcv", seg)
+
+            if seg.seg_type == SYN: # if its a resend of syn
+                self.state = LISTEN
+            elif seg.seg_type == FIN:
+                self.last_fin_seqno = seg.seqno
+                if self.framed: # every object is in, whoever waits for them can stop
+                    self.writer.close()
+                self.state = TIME_WAIT
+                self.expected = self.seq.add(self.expected, 1)
+                self.start_time_wait()
+            elif seg.seg_type == DATA:
+                self.receive_data(file, seg)
+            elif seg.seg_type == PARITY:
+                self.receive_parity(file, seg)
 
-    # check if any packets in the buffer can be sent and send them
-    def check_buffer(self, file):
-        for i in range(len(self.buffer) - 1, -1, -1):
-            seg = self.buffer[i]
-            if seg.seqno == self.expected:
-                self.write_and_send(file, seg)
-                self.buffer.remove(seg)
+        # CONNECTION TEARDOWN #
+        elif self.state == TIME_WAIT:
+            self.update_logs("rcv", seg)
+            if seg.seg_type == FIN: # our ack for it got lost, the sender is still waiting
+                self.send_ack(STPSegment(ACK, self.expected, '', wide=self.seq.wide))
+
+    def start_time_wait(self):
+        if not self.close_started:
+            self.close_started = True
+            self.timer = self.timers.call_later(2 * MSL, self.to_closed_state)
+            finack = STPSegment(ACK, self.expected, '', wide=self.seq.wide)
+            self.send_ack(finack)
+
+    # the connection cant go on, only it is dropped (on a server the others carry on)
+    def fail(self, error):
+        self.error = error
+        self.state = CLOSED
+        if self.on_failed != None:
+            self.on_failed()
+        elif self.on_closed != None:
+            self.on_closed()
 
     def to_closed_state(self):
-        self.sock.close()
-        self.timer.cancel()
         self.state = CLOSED
-        # sys.exit(0)
+        if self.on_closed != None:
+            self.on_closed()
 
-    def final_stats(self, file):
-        final_data = self.last_fin_seqno - self.first_ack
+    def final_stats(self, title = None):
+        final_data = self.rcv_nxt
 
         data_rcv = f'Original data received: {str(final_data).rjust(10)}\n'
         segs_rcv = f'Original segments received: {str(self.segs_log).rjust(5)}\n'
         dup_data = f'Dup data segments received: {str(self.dupdata_log).rjust(5)}\n'
         dupack = f'Dup ack segments sent: {str(self.dupacks_log).rjust(10)}\n'
+        dupack += f'Ack segments sent: {str(self.acks_log).rjust(14)}\n'
+        if self.flow:
+            dupack += f'Window probes received: {str(self.probes_log).rjust(9)}\n'
+        if self.codec != None:
+            out = self.writer.out
+            ratio = f'{out / final_data:.2f}' if final_data > 0 else '-'
+            dupack += f'Data after decompression: {str(out).rjust(7)}\n'
+            dupack += f'Compression ratio: {ratio.rjust(14)} ({compress.CODEC_NAMES[self.codec]})\n'
+            dupack += f'Decompression time (s): {self.writer.seconds:.3f}\n'
+        if self.fec != None:
+            dupack += f'Parity segments received: {str(self.parity_log).rjust(7)}\n'
+            dupack += f'Segments rebuilt from parity: {str(self.rebuilt_log).rjust(3)}\n'
+            dupack += f'Retransmissions avoided: {str(self.rebuilt_log - self.rebuilt_dups_log).rjust(8)}\n'
+        if self.framed:
+            incomplete = " (the last one incomplete)" if self.writer.incomplete else ""
+            dupack += f'Objects received: {str(self.writer.objects).rjust(15)}{incomplete}\n'
+        if self.sock_drops != None:
+            dupack += f'Socket buffer drops: {str(self.sock_drops).rjust(12)}\n'
+        if self.malformed_log > 0:
+            dupack += f'Malformed datagrams dropped: {str(self.malformed_log).rjust(4)}\n'
+        if self.error != None:
+            dupack += f'{self.error}\n'
         
-        with open(file, 'a') as f:
-            f.write("\n" + data_rcv + segs_rcv + dup_data + dupack)
-
-
-def main():
-    receiver_port, sender_port, txt_file_rcvd, max_win = parse_args(sys.argv)
-    f_log = open("Receiver_log.txt", "w")
-    f_log.close()
+        header = f'\n{title}\n' if title != None else "\n"
+        self.log.summary(header + data_rcv + segs_rcv + dup_data + dupack)
+
+    # for use as a library: the objects of one connection as framing.Received(name, data)
+    # while they arrive. the receive loop runs on a thread of its own, the iteration ends
+    # with the senders FIN and the thread carries on through TIME_WAIT
+    def receive_objects(self):
+        sink = framing.QueueSink()
+        self.framed = True
+        self.writer = framing.ObjectWriter(sink)
+        threading.Thread(target=run, args=(self, None), daemon=True).start()
+        return iter(sink)
+
+    # gauges for a metrics snapshot, read without the lock on the exporter thread
+    def collect_metrics(self):
+        values = {
+            "bytes_received_total": self.rcv_nxt,
+            "segments_received_total": self.segs_log,
+            "dup_segments_total": self.dupdata_log,
+            "dupacks_total": self.dupacks_log,
+            "acks_total": self.acks_log,
+            "probes_total": self.probes_log,
+            "malformed_datagrams_total": self.malformed_log,
+            "parity_segments_total": self.parity_log,
+            "rebuilt_segments_total": self.rebuilt_log,
+            "decompressed_bytes_total": self.writer.out if self.codec != None else None,
+            "goodput_bytes_per_second": self.metrics.rate("goodput", self.rcv_nxt),
+            "state": self.state,
+            "held_bytes": self.held.size(),
+            "unwritten_bytes": self.unwritten(),
+            "queued_datagrams": len(self.io.outbox)
+        }
+        if self.flow:
+            values["window_bytes"] = self.edge - self.rcv_nxt
+        return values
+
+
+# the output file of a striped transfer, shared by the connections of its stripes
+class Transfer:
+    def __init__(self, name, stripes, writes):
+        self.name = name
+        self.file = open(name, 'wb')
+        self.writer = filewriter.FileWriter(self.file, writes) # one writer for all the stripes
+        self.stripes = stripes
+        self.indexes = set() # stripes that have connected
+        self.open_stripes = stripes # the file is closed once all of them have finished
+        self.bytes_rcvd = 0
+
+# many senders on one socket. connection state is keyed on the senders address,
+# every connection has its own Receiver (state machine, reassembly, stats) and
+# output file, and all of them share one receive loop, one timer wheel and one log.
+# the stripes of a striped transfer are separate connections writing into one file
+class ReceiverServer:
+    def __init__(self, receiver_port, txt_file_rcvd, max_win, max_conns = 0,
+                 log_level = eventlog.LOG_PACKET, trace = False, timer_resolution = timers.RESOLUTION,
+                 mss = stp.DEFAULT_MSS, ack_every = ACK_EVERY, ack_delay = ACK_DELAY):
 
-    f = open(txt_file_rcvd, 'wb')
+        self.receiver_port = receiver_port
+        self.txt_file_rcvd = txt_file_rcvd # pattern for the output files
+        self.max_win = max_win
+        self.max_conns = max_conns
+        self.mss = max(1, min(mss, max_win, stp.MAX_MSS))
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.transport = None
+        self.io = batchio.BatchIO(self.sock, self.mss + MAX_HEADER_SIZE + MAX_OPTIONS_SIZE)
+        # a window for every connection that can be open at once, as far as that is known
+        size_buffers(self.sock, max_win * max(1, max_conns), self.mss)
+        self.timers = timers.TimerWheel(timer_resolution)
+        self.log = eventlog.EventLog(TRACE_FILE if trace else LOG_FILE, constant_map, log_level, binary=trace)
+        self.metrics = metrics.Metrics("stp_receiver", {"port": receiver_port}) # for all the connections together
+        self.metrics.collect(self.collect_metrics)
+
+        # the receive loop and the timers both touch connections
+        self.lock = metrics.TimedLock(self.metrics.histogram("lock_wait_seconds"))
+        self.notify = None # like Receiver.notify, for every connection
+        self.writes = filewriter.WriterThread() # one writer thread for every connections file
+        self.metrics.histograms["write_seconds"] = self.writes.write_times
+        self.conns = {} # sender address -> Receiver
+        self.transfers = {} # (sender host, transfer id) -> Transfer
+        self.opened = 0
+        self.closed = 0
+        self.failed = 0 # dropped before they finished, counted in closed too
+        self.malformed = 0 # datagrams that werent segments
+        self.finished = 0 # transfers done with, all the stripes of one count once
+        self.bytes_rcvd = 0
+        self.done = False
+        self.on_done = None # called once max_conns transfers have finished and nothing is open
+        self.sock_drops = None
+
+    def output_name(self, n, addr):
+        if "{" not in self.txt_file_rcvd:
+            return f"{self.txt_file_rcvd}.{n}"
+        return self.txt_file_rcvd.format(n=n, host=addr[0], port=addr[1])
+
+    def count_drops(self):
+        drops = batchio.receive_drops(self.sock)
+        if drops != None:
+            self.sock_drops = drops + self.io.send_drops
+
+    # runs a segment through its connection, returns the connection (None if there is none)
+    def dispatch(self, seg_bytes, addr):
+        try:
+            seg = STPSegment.deserialise(seg_bytes)
+        except ValueError as e: # a stray datagram, not for any connection to see
+            self.malformed += 1
+            log_malformed(self.log, self.malformed, addr, seg_bytes, e)
+            return None
+        with self.lock:
+            conn = self.conns.get(addr)
+            if conn == None:
+                if seg.seg_type != SYN or self.done:
+                    return None # left over from a closed connection
+                try:
+                    conn = self.open_connection(addr, seg)
+                except ValueError as e: # a SYN no connection can be opened for, dropped like a stray datagram
+                    self.malformed += 1
+                    log_malformed(self.log, self.malformed, addr, seg_bytes, e)
+                    return None
+                if conn == None:
+                    return None
+            try:
+                conn.handle_segment(seg, conn.file)
+            except Exception as e: # whatever went wrong in one connection, the others carry on
+                conn.fail(f"Failed on a segment from {addr[0]}:{addr[1]}: {e!r}")
+        return conn
+
+    # the acks the connections that got segments in a burst still owe
+    def send_acks(self, conns):
+        with self.lock:
+            for conn in conns:
+                conn.send_acks()
+
+    # the connection for a new sender, None once every transfer asked for has started
+    def open_connection(self, addr, syn):
+        full = self.max_conns > 0 and self.opened >= self.max_conns
+        if syn.options and OPT_STRIPE in syn.options:
+            stripe = STRIPE.unpack(syn.options[OPT_STRIPE])
+            key = (addr[0], stripe[0])
+            transfer = self.transfers.get(key)
+            if transfer != None and (stripe[2] != transfer.stripes or stripe[1] in transfer.indexes):
+                raise ValueError(f"stripe {stripe[1]} of {stripe[2]} doesnt fit transfer {stripe[0]}")
+            if transfer == None: # first stripe to arrive
+                if full:
+                    return None
+                self.opened += 1
+                transfer = Transfer(self.output_name(self.opened, addr), stripe[2], self.writes)
+                self.transfers[key] = transfer
+            conn = Receiver(self.receiver_port, addr[1], transfer.name, self.max_win, LISTEN, server=self, peer=addr,
+                            mss=self.mss, ack_every=self.ack_every, ack_delay=self.ack_delay)
+            conn.file = transfer.file
+            conn.writer = transfer.writer
+            transfer.indexes.add(stripe[1])
+            conn.stripe = stripe
+            conn.base_offset = stripe[3]
+        else:
+            if full:
+                return None
+            self.opened += 1
+            name = self.output_name(self.opened, addr)
+            conn = Receiver(self.receiver_port, addr[1], name, self.max_win, LISTEN, server=self, peer=addr,
+                            mss=self.mss, ack_every=self.ack_every, ack_delay=self.ack_delay)
+            if syn.options and OPT_OBJECTS in syn.options: # a directory of objects rather than a file
+                conn.framed = True
+                conn.writer = framing.ObjectWriter(framing.DirectorySink(name))
+            else:
+                conn.file = open(name, 'wb')
+        conn.on_closed = lambda: self.close_connection(addr)
+        conn.on_failed = lambda: self.end_connection(addr, "Failed connection")
+        self.conns[addr] = conn
+        return conn
+
+    # closes the file once the connection, or every stripe of its transfer, is done
+    def release_file(self, conn):
+        if conn.stripe == None:
+            if conn.writer != None:
+                conn.writer.close()
+            if conn.file != None:
+                conn.file.close()
+            self.finished += 1
+            return
+        key = (conn.sender_addr[0], conn.stripe[0])
+        transfer = self.transfers[key]
+        transfer.open_stripes -= 1
+        transfer.bytes_rcvd += conn.rcv_nxt
+        if transfer.open_stripes == 0:
+            transfer.writer.close()
+            transfer.file.close()
+            del self.transfers[key]
+            self.finished += 1
+            self.log.summary(f'\nStriped transfer of {conn.stripe[2]} stripes -> {transfer.name}: '
+                             f'{transfer.bytes_rcvd} bytes\n')
+
+    # TIME_WAIT is over, runs on the timer thread (or the event loop)
+    def close_connection(self, addr):
+        with self.lock:
+            self.end_connection(addr, "Connection")
+
+    # logs the connections stats and lets go of it, with the lock held
+    def end_connection(self, addr, what):
+        conn = self.conns.pop(addr, None)
+        if conn == None:
+            return
+        title = f'{what} {addr[0]}:{addr[1]} -> {conn.txt_file_rcvd}'
+        if conn.stripe != None:
+            title += f' (stripe {conn.stripe[1]} of {conn.stripe[2]}, from byte {conn.base_offset})'
+        conn.final_stats(title)
+        self.release_file(conn)
+        self.closed += 1
+        if conn.error != None:
+            self.failed += 1
+        self.bytes_rcvd += conn.rcv_nxt
+        if self.max_conns > 0 and self.finished >= self.max_conns and len(self.conns) == 0:
+            self.done = True
+            if self.on_done != None:
+                self.on_done()
+
+    # closes whatever is still open, e.g. when interrupted
+    def close(self):
+        with self.lock:
+            for addr, conn in self.conns.items():
+                conn.final_stats(f'Unfinished connection: {addr[0]}:{addr[1]} -> {conn.txt_file_rcvd}')
+                self.release_file(conn)
+                self.bytes_rcvd += conn.rcv_nxt
+            self.conns.clear()
+            for transfer in self.transfers.values(): # stripes that never connected
+                transfer.writer.close()
+                transfer.file.close()
+            self.transfers.clear()
+        self.writes.close()
+
+    # gauges over every open connection, read without the lock on the exporter thread
+    def collect_metrics(self):
+        conns = list(self.conns.values())
+        received = self.bytes_rcvd + sum(conn.rcv_nxt for conn in conns)
+        return {
+            "connections_open": len(conns),
+            "connections_closed_total": self.closed,
+            "connections_failed_total": self.failed,
+            "malformed_datagrams_total": self.malformed,
+            "bytes_received_total": received,
+            "goodput_bytes_per_second": self.metrics.rate("goodput", received),
+            "held_bytes": sum(conn.held.size() for conn in conns),
+            "unwritten_bytes": sum(conn.unwritten() for conn in conns),
+            "queued_datagrams": len(self.io.outbox)
+        }
+
+    def final_stats(self):
+        conns = f'Connections completed: {str(self.closed - self.failed).rjust(10)}\n'
+        if self.failed > 0:
+            conns += f'Connections failed: {str(self.failed).rjust(13)}\n'
+        data_rcv = f'Total data received: {str(self.bytes_rcvd).rjust(12)}\n'
+        if self.malformed > 0:
+            data_rcv += f'Malformed datagrams dropped: {str(self.malformed).rjust(4)}\n'
+        if self.sock_drops != None:
+            data_rcv += f'Socket buffer drops: {str(self.sock_drops).rjust(12)}\n'
+        self.log.summary("\n" + conns + data_rcv)
+
+
+def run(receiver, f):
+    receiver.state = LISTEN
+    while receiver.state != CLOSED:
+        if receiver.state == TIME_WAIT: # wake up now and then to see if the timer has closed us
+            receiver.sock.settimeout(TIME_WAIT_POLL)
+        try:
+            burst = receiver.receive_segments()
+        except timeout:
+            continue
+        with receiver.lock:
+            for rcvd_segment in burst:
+                receiver.handle_segment(rcvd_segment, f)
+            receiver.send_acks() # one ack for the in order data of the whole burst
+        receiver.io.flush()
+    receiver.count_drops()
+
+
+# the same state machine driven by one asyncio loop, TIME_WAIT is a loop.call_later
+class ReceiverProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver, f, done):
+        self.receiver = receiver
+        self.f = f
+        self.done = done
+
+    def connection_made(self, transport):
+        self.receiver.transport = transport
+        self.receiver.on_closed = lambda: self.done.set_result(None)
+
+    def datagram_received(self, data, addr):
+        receiver = self.receiver
+        try:
+            seg = STPSegment.deserialise(data)
+        except ValueError as e:
+            receiver.malformed_log += 1
+            log_malformed(receiver.log, receiver.malformed_log, addr, data, e)
+            return
+        receiver.handle_segment(seg, self.f)
+        receiver.send_acks()
+
+async def run_async(receiver, f):
+    loop = asyncio.get_running_loop()
+    receiver.timers = loop
+    receiver.notify = loop.call_soon_threadsafe
+    receiver.state = LISTEN
+    done = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: ReceiverProtocol(receiver, f, done), sock=receiver.sock)
+    try:
+        await done
+    finally:
+        receiver.count_drops()
+        transport.close()
+
+
+def run_server(server):
+    server.sock.settimeout(TIME_WAIT_POLL) # to notice when the last connection has closed
+    while not server.done:
+        try:
+            burst = server.io.recv()
+        except timeout:
+            continue
+        conns = {} # connections with segments in this burst, in arrival order
+        for seg_bytes, addr in burst:
+            conn = server.dispatch(seg_bytes, addr)
+            if conn != None:
+                conns[conn] = None
+        server.send_acks(conns)
+        server.io.flush()
+    server.count_drops()
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server, done):
+        self.server = server
+        self.done = done
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+        self.server.on_done = lambda: self.done.set_result(None)
+
+    def datagram_received(self, data, addr):
+        conn = self.server.dispatch(data, addr)
+        if conn != None:
+            self.server.send_acks([conn])
+
+async def run_server_async(server):
+    loop = asyncio.get_running_loop()
+    server.timers = loop
+    server.notify = loop.call_soon_threadsafe
+    done = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: ServerProtocol(server, done), sock=server.sock)
+    try:
+        await done
+    finally:
+        server.count_drops()
+        transport.close()
+
+
+def serve(args):
+    server = ReceiverServer(args.receiver_port, args.txt_file_rcvd, args.max_win, args.connections,
+                            log_level=eventlog.LEVELS[args.log], trace=args.trace,
+                            timer_resolution=args.timer_resolution / 1000, mss=args.mss,
+                            ack_every=args.ack_every, ack_delay=args.ack_delay / 1000)
+    server.sock.bind(('127.0.0.1', args.receiver_port))
+    metrics.start_from_args(server.metrics, args)
+
+    try:
+        if args.engine == "asyncio":
+            asyncio.run(run_server_async(server))
+        else:
+            run_server(server)
+    except KeyboardInterrupt:
+        pass
+    server.sock.close()
+    server.close()
+    server.metrics.close()
+
+    server.final_stats()
+    server.log.close()
 
-    receiver = Receiver(receiver_port, sender_port, txt_file_rcvd, max_win)
-    receiver.sock.bind(('127.0.0.1', receiver_port))
 
-    receiver.state = LISTEN
+def main():
+    args = parse_args(sys.argv)
+    if args.max_win < stp.MIN_MSS or args.mss < stp.MIN_MSS:
+        sys.exit(f"max_win and --mss need to be at least {stp.MIN_MSS} bytes")
+    if args.multi:
+        return serve(args)
+
+    f = None if args.objects else open(args.txt_file_rcvd, 'wb')
+
+    receiver = Receiver(args.receiver_port, args.sender_port, args.txt_file_rcvd, args.max_win,
+                        log_level=eventlog.LEVELS[args.log], trace=args.trace,
+                        timer_resolution=args.timer_resolution / 1000, mss=args.mss,
+                        ack_every=args.ack_every, ack_delay=args.ack_delay / 1000)
+    receiver.file = f
+    receiver.framed = args.objects
+    if args.objects:
+        receiver.writer = framing.ObjectWriter(framing.DirectorySink(args.txt_file_rcvd))
+    else:
+        receiver.metrics.histograms["write_seconds"] = receiver.writes.write_times
+    receiver.sock.bind(('127.0.0.1', args.receiver_port))
+    metrics.start_from_args(receiver.metrics, args)
+
+    if args.engine == "asyncio":
+        asyncio.run(run_async(receiver, f))
+    else:
+        run(receiver, f)
+    receiver.sock.close()
+    if receiver.writer != None:
+        receiver.writer.close() # a compress.Decompressor around the writer when the sender compressed
+    receiver.writes.close()
+    if f != None:
+        f.close()
+    receiver.metrics.close()
 
-    while 1:
-        # CONNECTION SETUP #
-        if receiver.state == LISTEN:
-            # print("receiver listening for segments")
-            try:
-                rcvd_segment = receiver.receive_segment()
-                if not receiver.first:
-                    receiver.time_start = time.time()
-                    receiver.first = True
-            except Exception as e:
-                sys.exit(f"Failed to get segment")
-
-            receiver.update_logs("rcv", rcvd_segment)
-
-            if rcvd_segment.seg_type == SYN:
-                new_seqno = (rcvd_segment.seqno + 1) % 2**16
-                connection_ack = STPSegment(ACK, new_seqno, '')
-                receiver.first_ack = new_seqno # for log
-                receiver.expected = new_seqno 
-                receiver.send_segment(connection_ack)
-                receiver.state = EST
-        
-        # START RECEIVING AND WRITING DATA #
-        if receiver.state == EST:
-            data_seg = receiver.receive_segment()
-            receiver.update_logs("rcv", data_seg)
-
-            if data_seg.seg_type == SYN: # if its a resend of syn
-                receiver.state = LISTEN
-            if data_seg.seg_type == FIN:
-                receiver.last_fin_seqno = data_seg.seqno
-                receiver.state = TIME_WAIT
-                receiver.expected += 1
-                
-            if data_seg.seqno == receiver.expected:
-                # if its expected
-                receiver.write_and_send(f, data_seg)
-                receiver.check_buffer(f)
-            elif data_seg.seqno > receiver.expected:
-                # if its out of order, buffer the data
-                receiver.buffer_data(data_seg)
-            elif data_seg.seqno < receiver.expected: # if its a duplicate
-                # check if seqno is in, send dupack
-                if data_seg.seqno in receiver.received_seqnos:
-                    dup_ack = STPSegment(ACK, receiver.expected, '')
-                    receiver.send_segment(dup_ack)
-                    receiver.dupdata_log += 1
-                    receiver.dupacks_log += 1
-                
+    receiver.final_stats()
+    receiver.log.close()
+    if receiver.error != None:
+        return receiver.error
 
-        # CONNECTION TEARDOWN #
-        if receiver.state == TIME_WAIT:
-            # create thread for timer to close program
-            if not receiver.close_started:
-                receiver.close_started = True
-                receiver.timer.start()
-                # 
-                finack = STPSegment(ACK, receiver.expected, '')
-                receiver.send_segment(finack)
-
-        if receiver.state == CLOSED:
-            break
-    
-    receiver.final_stats(f_log.name)
-                
-        
-     
 
 if __name__ == '__main__':
     sys.exit(main())
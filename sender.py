@@ -1,10 +1,27 @@
 import sys
 from socket import *
 import random
-from stp import STPSegment
+from stp import STPSegment, BufferPool, MAX_HEADER_SIZE, MAX_OPTIONS_SIZE, OPT_SACK_PERMITTED, OPT_SACK, OPT_STRIPE, OPT_MSS, OPT_WIDE, OPT_WINDOW, OPT_OBJECTS, OPT_FEC, OPT_COMPRESS, STRIPE, FEC, COMPRESS, WINDOW, unpack_sack
+import stp
 import threading
 import math
+import bisect
 import time
+import os
+import mmap
+import argparse
+import congestion
+import intervals
+import eventlog
+import metrics
+import framing
+import fec
+import compress
+import pacing
+import batchio
+import timers
+import asyncio
+import concurrent.futures
 
 
 NUM_ARGS = 7
@@ -14,6 +31,7 @@ DATA = 0
 ACK = 1
 SYN = 2
 FIN = 3
+PARITY = 4
 
 # states
 CLOSED = 0
@@ -26,58 +44,514 @@ constant_map = {
     DATA: "DATA",
     ACK: "ACK",
     SYN: "SYN",
-    FIN: "FIN"
+    FIN: "FIN",
+    PARITY: "PAR"
 }
 
-MSS = 1000
+LOG_FILE = "Sender_log.txt"
+TRACE_FILE = "Sender_trace.bin"
+
+# rto clamps in seconds, loopback rtts are well under a millisecond so the
+# usual one second floor would make every loss stall the transfer
+MIN_RTO = 0.01
+MAX_RTO = 60
+CLOCK_G = 0.001 # timer granularity
+
+# SYNs with options that go unanswered before the sender tries a plain one, a receiver
+# from before options drops what it cannot parse. stripes and objects need the options
+SYN_OPTION_TRIES = 3
 
 
 # parse in args
 def parse_args(args):
-    sender_port = int(args[1])
-    receiver_port = int(args[2])
-    txt_file_send = args[3]
-    max_win = int(args[4])
-    rto = int(args[5])
-    flp = float(args[6])
-    rlp = float(args[7])
+    parser = argparse.ArgumentParser(description="STP sender")
+    parser.add_argument('sender_port', type=int)
+    parser.add_argument('receiver_port', type=int)
+    parser.add_argument('txt_file_send')
+    parser.add_argument('max_win', type=int, help="max window in bytes")
+    parser.add_argument('rto', type=int, help="initial retransmission timeout in ms")
+    parser.add_argument('flp', type=float, help="forward loss probability")
+    parser.add_argument('rlp', type=float, help="reverse loss probability")
+    parser.add_argument('--cc', choices=congestion.ALGORITHMS, default=congestion.NewReno.name,
+                        help="congestion control, none keeps a fixed max_win window")
+    parser.add_argument('--sack', action='store_true', help="negotiate selective acknowledgements")
+    parser.add_argument('--log', choices=eventlog.LEVELS, default="packet", help="what goes in the log")
+    parser.add_argument('--trace', action='store_true',
+                        help=f"write a binary trace to {TRACE_FILE} instead of the text log")
+    parser.add_argument('--engine', choices=["thread", "asyncio"], default="thread",
+                        help="run with an ack thread and a timer thread, or in one asyncio event loop")
+    parser.add_argument('--timer-resolution', type=float, default=timers.RESOLUTION * 1000,
+                        help="retransmission timer resolution in ms")
+    parser.add_argument('--mss', type=int, default=None,
+                        help=f"largest segment payload to ask the receiver for (default {stp.DEFAULT_MSS}, "
+                             f"{stp.MIN_MSS} to {stp.MAX_MSS}), the smaller of both sides is used")
+    parser.add_argument('--probe-mss', action='store_true',
+                        help="ask for the largest segment the path to the receiver carries unfragmented "
+                             "(capped by --mss if given)")
+    metrics.add_arguments(parser)
+    parser.add_argument('--fec', type=int, default=0, metavar='K',
+                        help=f"send an xor parity segment after every K data segments ({fec.MIN_K} to {fec.MAX_K}) so the receiver "
+                             "can rebuild one lost segment per group without a retransmission")
+    parser.add_argument('--compress', choices=list(compress.NAMES), default=None,
+                        help="compress the file as one stream on a background thread while it is sent, if the "
+                             "receiver has the codec too (lzma needs a python built with it, zstd the zstandard package)")
+    parser.add_argument('--pace', default=None, metavar='RATE',
+                        help="spread new segments out over time instead of sending them back to back, at RATE "
+                             "Mbit/s (per connection) or with 'auto' at the congestion window over the smoothed rtt")
+    parser.add_argument('--objects', action='store_true',
+                        help="txt_file_send is a directory, send every file in it as an object over one "
+                             "connection (the receiver needs --objects)")
+    parser.add_argument('--stripes', type=int, default=1,
+                        help="split the file into this many byte ranges, each sent over its own connection "
+                             "from sender_port + i by its own process (the receiver needs --multi)")
+
+    return parser.parse_args(args[1:])
+
+# cuts the file into MSS sized segments on demand instead of reading it all in,
+# only the segments between the window base and the furthest one handed out are kept
+class SegmentSource:
+    sealed = True # every byte is known from the start
+    def __init__(self, txt_file_send, first_seqno, mss, seq, offset = 0, length = None):
+        self.f = open(txt_file_send, 'rb')
+        self.mss = mss
+        self.seq = seq # SeqSpace the seqnos wrap in
+        file_size = os.fstat(self.f.fileno()).st_size
+        self.offset = offset # only the bytes offset .. offset+length of the file are sent
+        self.size = file_size - offset if length == None else length
+        self.mm = None
+        if file_size > 0: # cant mmap an empty file
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.first_seqno = first_seqno
+        self.cache = {} # segment index -> segment, only for the current window
+        self.low = 0 # lowest index still cached
+
+    def __len__(self):
+        return math.ceil(self.size / self.mss)
+
+    def __getitem__(self, i):
+        seg = self.cache.get(i)
+        if seg == None:
+            offset = i * self.mss
+            data = self.mm[self.offset + offset:self.offset + min(offset + self.mss, self.size)]
+            seg = STPSegment(DATA, self.seq.add(self.first_seqno, offset), data, wide=self.seq.wide)
+            self.cache[i] = seg
+        return seg
+
+    # forget segments below base, they have been acked
+    def release(self, base):
+        while self.low < base:
+            self.cache.pop(self.low, None)
+            self.low += 1
+
+    def close(self):
+        self.cache.clear()
+        if self.mm != None:
+            self.mm.close()
+        self.f.close()
+
+# the stream of a connection that carries objects (see framing.py), cut into MSS sized
+# segments like a file. objects are added as (header, data) chunks while the connection
+# runs, a short last segment is only handed out once the stream is sealed or padded
+class ObjectSource:
+    def __init__(self, first_seqno, mss, seq):
+        self.mss = mss
+        self.seq = seq
+        self.first_seqno = first_seqno
+        self.size = 0 # stream bytes added so far
+        self.sealed = False # no more objects, the last segment may be short
+        self.starts = [] # stream offset of every chunk
+        self.chunks = [] # bytes or mmaps of the files
+        self.files = [] # file behind a chunk, None for bytes
+        self.objects = 0
+        self.cache = {}
+        self.low = 0
+
+    def __len__(self):
+        if self.sealed:
+            return math.ceil(self.size / self.mss)
+        return self.size // self.mss
+
+    def add(self, chunk, f = None):
+        self.starts.append(self.size)
+        self.chunks.append(chunk)
+        self.files.append(f)
+        self.size += len(chunk)
+
+    def add_bytes(self, name, data):
+        self.add(framing.header(name, len(data)) + bytes(data))
+        self.objects += 1
+
+    def add_file(self, name, path):
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        self.add(framing.header(name, size))
+        if size > 0: # cant mmap an empty file
+            self.add(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f)
+        else:
+            f.close()
+        self.objects += 1
+
+    # fills the short last segment up with padding, true if there was one
+    def pad(self):
+        if self.sealed or self.size % self.mss == 0:
+            return False
+        self.add(bytes(self.mss - self.size % self.mss))
+        return True
+
+    def seal(self):
+        self.sealed = True
+
+    def __getitem__(self, i):
+        seg = self.cache.get(i)
+        if seg == None:
+            start = i * self.mss
+            seg = STPSegment(DATA, self.seq.add(self.first_seqno, start), self.read(start, min(start + self.mss, self.size)),
+                             wide=self.seq.wide)
+            self.cache[i] = seg
+        return seg
+
+    # stream bytes start .. end, joined up where they span chunks
+    def read(self, start, end):
+        j = bisect.bisect_right(self.starts, start) - 1
+        parts = []
+        while start < end:
+            chunk_start, chunk = self.starts[j], self.chunks[j]
+            part = chunk[start - chunk_start:min(end, chunk_start + len(chunk)) - chunk_start]
+            parts.append(part)
+            start += len(part)
+            j += 1
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    # forgets the segments and whole chunks below base
+    def release(self, base):
+        while self.low < base:
+            self.cache.pop(self.low, None)
+            self.low += 1
+        done = bisect.bisect_right(self.starts, base * self.mss) - 1 # chunks before this one are all acked
+        if done > 0:
+            self.drop(done)
+
+    def drop(self, n):
+        for chunk, f in zip(self.chunks[:n], self.files[:n]):
+            if f != None:
+                chunk.close()
+                f.close()
+        del self.starts[:n]
+        del self.chunks[:n]
+        del self.files[:n]
+
+    def close(self):
+        self.cache.clear()
+        self.drop(len(self.chunks))
+
+COMPRESS_CHUNK = 64 * 1024 # file bytes per step of the compressor
+COMPRESS_AHEAD = 4 * 1024 * 1024 # compressed bytes the compressor keeps ready past the window base at most
 
-    return sender_port, receiver_port, txt_file_send, max_win, rto, flp, rlp
+# a file compressed as one stream while it is sent. a thread compresses ahead of the
+# window and adds its output like objects are added to an ObjectSource, the stream is
+# sealed once the whole file went through. lock and added are the senders, the stream
+# only grows with the lock held
+class CompressedSource(ObjectSource):
+    def __init__(self, txt_file_send, first_seqno, mss, seq, codec, lock, added):
+        super().__init__(first_seqno, mss, seq)
+        self.f = open(txt_file_send, 'rb')
+        self.raw_size = os.fstat(self.f.fileno()).st_size
+        self.codec = codec
+        self.lock = lock
+        self.added = added
+        self.seconds = 0 # spent compressing
+        self.room = threading.Event() # acks freed some of what was compressed ahead
+        self.closed = False
+        self.thread = threading.Thread(target=self.compress_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # zlib and lzma let go of the gil while they compress, the senders threads keep running
+    def compress_loop(self):
+        c = compress.compressor(self.codec)
+        while not self.closed:
+            data = self.f.read(COMPRESS_CHUNK)
+            if len(data) == 0:
+                break
+            self.push(self.timed(c.compress, data), False)
+            self.wait_room()
+        self.push(self.timed(c.flush), True)
+
+    def timed(self, fn, *args):
+        start = time.perf_counter()
+        out = fn(*args)
+        self.seconds += time.perf_counter() - start
+        return out
+
+    def push(self, out, last):
+        with self.lock:
+            if len(out) > 0:
+                self.add(out)
+            if last:
+                self.seal()
+            self.added()
+
+    def ahead(self):
+        return self.size - self.low * self.mss
+
+    def wait_room(self):
+        while not self.closed and self.ahead() > COMPRESS_AHEAD:
+            self.room.clear()
+            if self.ahead() > COMPRESS_AHEAD: # release may have run before the clear
+                self.room.wait()
+
+    def release(self, base):
+        super().release(base)
+        self.room.set()
+
+    def close(self):
+        self.closed = True
+        self.room.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        super().close()
+        self.f.close()
+
+# keeps track of the segments in flight by their index in the segment source
+# (offset from the ISN / mss) so send, ack and retransmit lookups are constant time,
+# segments base .. nxt-1 have been sent but not acked yet
+class Scoreboard:
+    def __init__(self, first_seqno, size, slots, mss, seq):
+        self.first_seqno = first_seqno
+        self.mss = mss
+        self.seq = seq
+        self.size = size # bytes in the file
+        self.base = 0 # oldest unacked segment
+        self.nxt = 0 # next segment that has never been sent
+
+        # first send times in a ring of window size, indexed by segment index % slots
+        self.slots = slots
+        self.sent_at = [0.0] * slots
+        self.sample_from = 0 # karns rule, only segments first sent after the last retransmit are timed
+
+        # SACK scoreboard, what the receiver reported holding and what has been resent
+        self.sacked = bytearray(slots)
+        self.resent = bytearray(slots)
+        self.sacked_ranges = intervals.IntervalSet() # segments already marked, a block that grew only marks what is new
+        self.high_sacked = 0 # one past the highest SACKed segment
+        self.hole = 0 # where the search for the next hole to resend goes on from, it only moves forward
+        self.resent_out = 0 # resent segments past the base that are neither acked nor SACKed yet
+        self.recover_until = 0 # loss recovery lasts until the base reaches this
+
+    def seqno_of(self, i):
+        return self.seq.add(self.first_seqno, i * self.mss)
+
+    def in_flight(self):
+        return self.nxt - self.base
+
+    # one past the last byte of segment i
+    def end_of(self, i):
+        return min((i + 1) * self.mss, self.size)
+
+    # file offset an ack points at, None if it is behind the base or past what was sent
+    def ack_offset(self, ackno):
+        offset = self.seq.diff(ackno, self.seqno_of(self.base))
+        bytes_in_flight = min(self.nxt * self.mss, self.size) - self.base * self.mss
+        if offset > bytes_in_flight:
+            return None
+        return self.base * self.mss + offset
+
+    # index of the first segment not covered by an ack,
+    # None if the ack doesnt acknowledge anything new (dupacks and old acks)
+    def acked_upto(self, ackno):
+        offset = self.ack_offset(ackno)
+        if offset == None or offset == self.base * self.mss:
+            return None
+        return math.ceil(offset / self.mss)
+
+    # the cumulative ack moved up to segment base
+    def advance(self, base):
+        for i in range(self.base, base):
+            if self.resent[i % self.slots] and not self.sacked[i % self.slots]:
+                self.resent_out -= 1
+        self.base = base
+        self.sacked_ranges.pop_from(base)
+
+    def on_send(self, i, now):
+        self.sent_at[i % self.slots] = now
+        self.sacked[i % self.slots] = 0
+        self.resent[i % self.slots] = 0
+
+    # marks the segments that lie completely inside the SACK blocks
+    def sack(self, blocks):
+        base_seqno = self.seqno_of(self.base)
+        bytes_in_flight = min(self.nxt * self.mss, self.size) - self.base * self.mss
+        for start, end in blocks:
+            first = self.seq.diff(start, base_seqno)
+            last = self.seq.diff(end, base_seqno)
+            if first >= last or last > bytes_in_flight: # stale or already acked
+                continue
+            if self.base * self.mss + last == self.size: # block runs to the short last segment
+                end_i = self.base + math.ceil(last / self.mss)
+            else:
+                end_i = self.base + last // self.mss
+            start_i = self.base + math.ceil(first / self.mss)
+            for gap_start, gap_end in self.sacked_ranges.gaps(start_i, end_i):
+                for i in range(gap_start, gap_end):
+                    if not self.sacked[i % self.slots]:
+                        self.resent_out -= self.resent[i % self.slots]
+                        self.sacked[i % self.slots] = 1
+            self.sacked_ranges.add(start_i, end_i)
+            self.high_sacked = max(self.high_sacked, end_i)
+
+    # next segment to resend in SACK recovery (rfc 6675 NextSeg): the first one below the
+    # highest SACKed segment that is neither SACKed nor resent yet, None if there is none
+    def next_hole(self):
+        i = max(self.hole, self.base)
+        while i < self.high_sacked and (self.sacked[i % self.slots] or self.resent[i % self.slots]):
+            i += 1
+        self.hole = i
+        return i if i < self.high_sacked else None
+
+    # segments still in the network by the rfc 6675 estimate: unsacked ones past the highest
+    # SACKed segment (those before it count as lost) and every resend that is still out
+    def pipe(self):
+        return max(0, self.nxt - max(self.base, self.high_sacked)) + self.resent_out
+
+    def mark_resent(self, i):
+        if not self.resent[i % self.slots] and not self.sacked[i % self.slots]:
+            self.resent_out += 1
+        self.resent[i % self.slots] = 1
+
+    # after a timeout any resent hole may have been lost again
+    def on_timeout(self):
+        self.resent = bytearray(self.slots)
+        self.resent_out = 0
+        self.hole = self.base
+
+    def in_recovery(self):
+        return self.base < self.recover_until
+
+    # anything already sent may now be acked late because of the hole,
+    # so the retransmitted segment and everything before nxt is never timed
+    def on_retransmit(self):
+        self.sample_from = self.nxt
+
+    # rtt of an ack that moves the base up to new_base, None if it would be ambiguous
+    def rtt_sample(self, new_base, now):
+        if new_base - 1 < self.sample_from:
+            return None
+        return now - self.sent_at[(new_base - 1) % self.slots]
+
+# smoothed rtt and rto from measured round trips (rfc 6298), times in seconds
+class RTOEstimator:
+    def __init__(self, initial_rto):
+        self.initial_rto = initial_rto
+        self.rto = initial_rto
+        self.srtt = None
+        self.rttvar = None
+        self.last_rtt = None
+
+    def sample(self, rtt):
+        self.last_rtt = rtt
+        if self.srtt == None: # first measurement
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.reset_backoff()
+
+    # new data got acked so the path works again, drop back from any backoff
+    def reset_backoff(self):
+        if self.srtt != None:
+            self.rto = min(max(self.srtt + max(CLOCK_G, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+        else:
+            self.rto = self.initial_rto
+
+    # timer expired, double the rto until the next valid sample
+    def backoff(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
 
 class Sender:       
-    def __init__(self, sender_port, receiver_port, txt_file_send, max_win, rto, flp, rlp, state = CLOSED):
+    def __init__(self, sender_port, receiver_port, txt_file_send, max_win, rto, flp, rlp, state = CLOSED,
+                 cc = congestion.NewReno.name, sack = False, log_level = eventlog.LOG_PACKET, trace = False,
+                 timer_resolution = timers.RESOLUTION, stripe = None, log_path = None, mss = stp.DEFAULT_MSS,
+                 objects = None, fec_k = 0, codec = None, pace = None):
         # initialising parsed variables
         self.sender_port = sender_port
         self.receiver_port = receiver_port
         self.txt_file_send =  txt_file_send
-        self.max_win = math.ceil(max_win / MSS) # ??
-        self.rto = rto / 1000 # ??
+        self.max_win_bytes = max_win
+        self.mss = max(1, min(mss, max_win, stp.MAX_MSS)) # asked for in the SYN, lowered to what the receiver agrees to
+        self.max_win = self.window_segments()
+        self.rtt = RTOEstimator(rto / 1000) # the given rto is only the starting value
         self.flp = flp
         self.rlp = rlp
         self.state = state
         
-        self.ISN = random.randint(0, 2**16-1) # initial seqno
+        self.ISN = random.randint(0, 2**32-1) # initial seqno, only the low 16 bits unless 32 bit seqnos are agreed
         self.seqno = self.ISN
+        self.seq = stp.NARROW # until the receiver agrees to OPT_WIDE
         self.sock = socket(AF_INET, SOCK_DGRAM) # create socket
-        self.sock.settimeout(rto)
+        self.sock.settimeout(self.rtt.rto)
         self.sock.bind(('127.0.01', self.sender_port))
+        self.receiver_addr = ('127.0.0.1', self.receiver_port)
+        self.transport = None # set when an asyncio loop owns the socket
+        self.recv_pool = BufferPool(MAX_HEADER_SIZE + MAX_OPTIONS_SIZE) # reused buffers for incoming acks
+        self.io = batchio.BatchIO(self.sock, self.mss + MAX_HEADER_SIZE + MAX_OPTIONS_SIZE) # bursts of sends and acks
+        batchio.size_buffers(self.sock, self.max_win, self.mss + MAX_HEADER_SIZE) # room for a whole window of segments and acks
         self.time_start = 0
         self.first = False # indicates if the very first has been sent
+        if log_path == None:
+            log_path = TRACE_FILE if trace else LOG_FILE
+        self.log = eventlog.EventLog(log_path, constant_map, log_level, binary=trace, rtt_columns=True)
+        self.syn_sent_at = 0
+        self.syn_sends = 0 # only a syn sent once gives an rtt sample
+        self.plain_syn = False # gave up on options, see SYN_OPTION_TRIES
+        labels = {"port": sender_port} if stripe == None else {"port": sender_port, "stripe": stripe[1]}
+        self.metrics = metrics.Metrics("stp_sender", labels)
+        self.metrics.collect(self.collect_metrics)
+        self.rtt_samples = self.metrics.histogram("rtt_seconds")
 
         # sliding window variables
-        self.segments = []
-        self.sent_unacked = []
-        self.base = 0
+        self.segments = None # SegmentSource, made once the connection is up
+        self.board = None # Scoreboard of the segments in flight
         self.oldest_seg = None
         self.expected_ack = 0
-        self.lock = threading.Lock()
+        self.lock = metrics.TimedLock(self.metrics.histogram("lock_wait_seconds"))
         self.ack_received_event = threading.Event()
         self.ack_thread = threading.Thread(target=self.receive_acks)
 
         # timers and timeouts and dupacks
+        self.timers = timers.TimerWheel(timer_resolution) # one thread for every timer
         self.timer_running = False
         self.ack_timer = None
+        self.timer_gen = 0 # bumped on every (re)start so a stale expiry can be told apart
+        self.timer_started_at = 0
+        self.acked_at = 0 # last time new data was acked
         self.dupACK = 0
+        self.cc_name = cc
+        self.cc = congestion.make(cc, self.max_win) # in flight is capped at min(cwnd, max_win)
+        self.sack = sack # ask the receiver for SACK blocks
+        self.sack_ok = False # receiver agreed in its SYN ACK
+        self.stripe = stripe # (transfer id, index, count, offset, length) when sending one stripe of the file
+        self.objects = objects # (name, path) of every file to send as an object, instead of txt_file_send
+        self.framed = objects != None # the stream is an ObjectSource, connect() turns it on too
+        self.pump = None # thread running sliding_window for connect()
+        self.drained = threading.Event() # set whenever everything added so far has been acked
+        self.fec_k = fec_k # data segments per parity segment asked for, 0 for none
+        self.fec = None # fec.Encoder once the receiver agreed to it
+        self.codec = codec # compress.ZLIB etc. to compress with, None once the receiver turned it down
+        self.notify = None # runs more_data on the event loop, for the asyncio engine
+        # pacing, "auto" or Mbit/s. when the pacer holds the next segment back pace_wait is the
+        # seconds until it may go, the sliding window waits that long (asyncio arms pace_timer)
+        self.pacer = pacing.Pacer(pacing.parse_rate(pace)) if pace != None else None
+        self.pace_wait = None
+        self.pace_timer = None
+
+        # flow control, the receiver advertises its window in every ack once it agreed to OPT_WINDOW
+        self.flow = False
+        self.send_edge = 0 # file offset the receivers window ends at, nothing past it is sent
+        self.persist_timer = None # probes the window while it is closed and nothing is in flight
+        self.persist_gen = 0 # like timer_gen
+        self.persist_delay = 0 # backs off like the rto, 0 until the first probe
 
         # final log stats
         self.last_fin_seqno = 0
@@ -87,39 +561,105 @@ class Sender:
         self.dupacks_log = 0
         self.drop_send_log = 0
         self.drop_ack_log = 0        
+        self.probes_log = 0
+        self.malformed_log = 0
+        self.parity_log = 0
+        self.sock_drops = 0
 
-    def final_stats(self, file):
-    
-        final_data = self.last_fin_seqno - (self.ISN + 1)
-        final_acked = self.last_ack_log - (self.ISN + 1)
-
-        data_sent = f'Original data sent: {str(final_data).rjust(10)}\n'
-        data_acked = f'Original data acked: {str(final_acked).rjust(10)}\n'
-        segs_sent = f'Original segments sent: {str(self.segs_log).rjust(5)}\n'
-        retransmit = f'Retransmitted segments: {str(self.retransmit_log).rjust(5)}\n'
-        dupack = f'Dup acks received: {str(self.dupacks_log).rjust(10)}\n'
-        drop_data = f'Data segments dropped: {str(self.drop_send_log).rjust(5)}\n'
-        drop_ack = f'Ack segments dropped: {str(self.drop_ack_log).rjust(5)}'
-
-        with open(file, 'a') as f:
-            f.write("\n" + data_sent + data_acked + segs_sent)
-            f.write(retransmit + dupack + drop_data + drop_ack)
-    
+    # the numbers behind final_stats, a striped transfer adds them up over its stripes
+    def stats(self):
+        data_sent = data_acked = 0
+        if self.board != None:
+            data_sent = min(self.board.nxt * self.mss, self.board.size)
+            data_acked = min(self.board.base * self.mss, self.board.size)
+        return {
+            "data_sent": data_sent,
+            "data_acked": data_acked,
+            "segs": self.segs_log,
+            "retransmits": self.retransmit_log,
+            "dupacks": self.dupacks_log,
+            "drop_data": self.drop_send_log,
+            "drop_ack": self.drop_ack_log,
+            "sock_drops": self.sock_drops,
+            "probes": self.probes_log,
+            "malformed": self.malformed_log,
+            "parity": self.parity_log,
+            "pace_waits": self.pacer.waits if self.pacer != None else 0,
+            "raw": self.segments.raw_size if self.codec != None and self.segments != None else 0,
+            "compress_time": self.segments.seconds if self.codec != None and self.segments != None else 0,
+            "objects": self.segments.objects if self.framed and self.segments != None else 0,
+            "srtt": self.rtt.srtt,
+            "rto": self.rtt.rto
+        }
+
+    def final_stats(self):
+        self.log.summary(format_stats(self.stats()))
 
+    # gauges for a metrics snapshot, read without the lock on the exporter thread
+    def collect_metrics(self):
+        values = self.stats()
+        values = {
+            "bytes_sent_total": values["data_sent"],
+            "bytes_acked_total": values["data_acked"],
+            "segments_sent_total": values["segs"],
+            "retransmits_total": values["retransmits"],
+            "dupacks_total": values["dupacks"],
+            "probes_total": values["probes"],
+            "parity_segments_total": values["parity"],
+            "pace_waits_total": values["pace_waits"] if self.pacer != None else None,
+            "pacing_rate_bytes_per_second": self.pacing_rate() if self.pacer != None else None,
+            "uncompressed_bytes_total": values["raw"] if self.codec != None else None,
+            "dropped_data_total": values["drop_data"],
+            "dropped_acks_total": values["drop_ack"],
+            "goodput_bytes_per_second": self.metrics.rate("goodput", values["data_acked"]),
+            "srtt_seconds": values["srtt"],
+            "rto_seconds": values["rto"],
+            "state": self.state,
+            "cwnd_segments": self.cc.cwnd,
+            "ssthresh_segments": self.cc.ssthresh,
+            "send_window_segments": self.cc.window(),
+            "queued_datagrams": len(self.io.outbox)
+        }
+        board = self.board
+        if board != None:
+            values["in_flight_segments"] = board.in_flight()
+            values["in_flight_bytes"] = values["bytes_sent_total"] - values["bytes_acked_total"]
+            if self.flow:
+                values["receive_window_bytes"] = max(0, self.send_edge - values["bytes_acked_total"])
+        return values
 
-    def send_segment(self, segment): # returns true if successfully sent
+    # returns true if it wasnt dropped. on the socket the segment is only queued, it goes
+    # out with the rest of the burst on the next flush, which callers do after the lock
+    def send_segment(self, segment):
         if random.random() < self.flp: # drop packet
             self.update_logs("drp", segment)
             if segment.seg_type == DATA:
                 self.drop_send_log += 1
             return False
-        seg_bytes = segment.serialise()
-        self.sock.sendto(seg_bytes, ('127.0.0.1', self.receiver_port))
+        if self.transport != None:
+            self.transport.sendto(segment.serialise(), self.receiver_addr)
+        else:
+            self.io.queue(segment, self.receiver_addr)
         return True
+
+    # datagrams lost in the socket buffers, not by flp / rlp
+    def count_drops(self):
+        drops = batchio.receive_drops(self.sock)
+        self.sock_drops = self.io.send_drops + (drops if drops != None else 0)
     
     def receive_segment(self):
-        seg_bytes, _ = self.sock.recvfrom(MSS)
-        rcvd_seg = STPSegment.deserialise(seg_bytes)
+        seg_bytes, _ = self.recv_pool.recvfrom(self.sock)
+        return self.incoming(seg_bytes)
+
+    # parses a received datagram, None if it is dropped
+    def incoming(self, seg_bytes):
+        if len(seg_bytes) == 0: # not a segment, close() waking the ack thread (see wake_acks)
+            return None
+        try:
+            rcvd_seg = STPSegment.deserialise(seg_bytes)
+        except ValueError: # a stray datagram, not from the receiver
+            self.malformed_log += 1
+            return None
         if random.random() < self.rlp: # drop packet
             self.update_logs("drp", rcvd_seg)
             self.drop_ack_log += 1
@@ -128,224 +668,797 @@ class Sender:
 
     def receive_synack(self): # for establishing the connection
         try: 
-            self.sock.settimeout(self.rto)
+            self.sock.settimeout(self.rtt.rto)
             rcvd_ack = self.receive_segment()
             if rcvd_ack == None:
                 # raise timeout
                 return None
-            if rcvd_ack.seg_type == ACK:
-                self.update_logs("rcv", rcvd_ack)
+            if self.is_synack(rcvd_ack):
+                self.on_synack(rcvd_ack)
                 return rcvd_ack
         except timeout:
             # print("Timeout for ACK, resending SYN")
+            self.rtt.backoff()
             self.state = CLOSED
             return None
         
+    def send_syn(self):
+        try:
+            seg = self.make_syn() # create syn packet
+            if not self.first:
+                self.time_start = time.time()
+                self.first = True
+            self.syn_sent_at = time.monotonic()
+            self.syn_sends += 1
+            if self.send_segment(seg): # send packet to rcv
+                self.update_logs("snd", seg)
+            self.io.flush()
+        except Exception as e:
+            sys.exit(f"Failed to start connection")
+        self.state = SYN_SENT
+
+    # once the SYN is plain an ack with options answers an earlier SYN, the
+    # receiver went back to 16 bit seqnos and no options with the plain one
+    def is_synack(self, ack):
+        return ack.seg_type == ACK and not (self.plain_syn and ack.options)
+
+    def on_synack(self, ack):
+        self.accept_synack(ack)
+        if self.syn_sends == 1:
+            self.rtt.sample(time.monotonic() - self.syn_sent_at)
+            self.rtt_samples.observe(time.monotonic() - self.syn_sent_at)
+        self.update_logs("rcv", ack)
+        self.seqno = self.seq.add(self.seqno, 1)
+        self.state = EST
+
+    def send_fin(self):
+        try:
+            self.last_fin_seqno = self.expected_ack
+            seg = STPSegment(FIN, self.expected_ack, '', wide=self.seq.wide) # create fin packet
+            if self.send_segment(seg): # send packet to rcv
+                self.update_logs("snd", seg)
+            self.io.flush()
+            self.state = FIN_WAIT
+        except Exception as e:
+            sys.exit(f"Failed to send fin packet")
+
+    def is_finack(self, seg):
+        return seg.seg_type == ACK and seg.seqno == self.seq.add(self.expected_ack, 1)
+
+    # whole segments that fit in max_win, so the bytes in flight never go past it
+    def window_segments(self):
+        return max(1, self.max_win_bytes // self.mss)
+
+    # the receiver may have lowered the mss, the window in segments and everything sized by it follow
+    def set_mss(self, mss):
+        if mss == self.mss and self.max_win == self.window_segments():
+            return
+        self.mss = mss
+        self.max_win = self.window_segments()
+        self.cc = congestion.make(self.cc_name, self.max_win)
+        self.io.resize(mss + MAX_HEADER_SIZE + MAX_OPTIONS_SIZE)
+        batchio.size_buffers(self.sock, self.max_win, mss + MAX_HEADER_SIZE)
+
+    # SYN carrying the options this sender would like to use
+    def make_syn(self):
+        if self.syn_sends >= SYN_OPTION_TRIES and self.stripe == None and not self.framed:
+            self.plain_syn = True
+        if self.plain_syn:
+            return STPSegment(SYN, self.ISN % stp.NARROW.size, '')
+        options = {OPT_MSS: stp.MSS.pack(self.mss), OPT_WIDE: stp.ISN.pack(self.ISN), OPT_WINDOW: b""}
+        if self.framed:
+            options[OPT_OBJECTS] = b""
+        if self.fec_k > 0:
+            options[OPT_FEC] = FEC.pack(self.fec_k)
+        if self.codec != None:
+            options[OPT_COMPRESS] = COMPRESS.pack(self.codec)
+        if self.sack:
+            options[OPT_SACK_PERMITTED] = b""
+        if self.stripe != None:
+            options[OPT_STRIPE] = STRIPE.pack(*self.stripe[:4])
+        return STPSegment(SYN, self.ISN % stp.NARROW.size, '', options)
+
+    # only use what the receiver echoed back
+    def accept_synack(self, ack):
+        options = ack.options if ack.options else {}
+        self.sack_ok = self.sack and OPT_SACK_PERMITTED in options
+        if OPT_WIDE in options:
+            self.seq = stp.WIDE
+        else: # a receiver that only knows 16 bit seqnos, in flight has to stay under half of them
+            self.ISN %= stp.NARROW.size
+            self.max_win_bytes = min(self.max_win_bytes, stp.NARROW.half - 1)
+        self.seqno = self.ISN
+        if OPT_WINDOW in options: # otherwise only max_win holds the sender back
+            self.flow = True
+            self.send_edge = WINDOW.unpack(options[OPT_WINDOW])[0]
+        agreed = stp.MSS.unpack(options[OPT_MSS])[0] if OPT_MSS in options else stp.DEFAULT_MSS
+        self.set_mss(min(agreed, self.mss, self.max_win_bytes))
+        if self.stripe != None and OPT_STRIPE not in options:
+            sys.exit("receiver cannot take a striped transfer, run it with --multi")
+        if self.fec_k > 0 and OPT_FEC in options: # after set_mss, parity payloads are an mss long
+            self.fec = fec.Encoder(self.fec_k, self.mss)
+        if self.framed and OPT_OBJECTS not in options:
+            sys.exit("receiver cannot take objects, run it with --objects")
+        if self.codec != None and OPT_COMPRESS not in options: # the file goes as it is
+            self.codec = None
+
     def receive_finack(self): # for establishing the connection
         try: 
-            self.sock.settimeout(self.rto)
+            self.sock.settimeout(self.rtt.rto)
             rcvd_ack = self.receive_segment()
             if rcvd_ack == None:
                 return None
-            if rcvd_ack.seg_type == ACK and rcvd_ack.seqno == self.expected_ack + 1:
+            if self.is_finack(rcvd_ack):
                 self.update_logs("rcv", rcvd_ack)
                 return rcvd_ack
         except timeout:
             # print("Timeout for ACK, resending FIN")
+            self.rtt.backoff()
             self.state = CLOSING
             return None
             
+    # queues the event, the log writes it out in the background
     def update_logs(self, action, segment):
-        seqno_str = str(segment.seqno)
-        seg_type = constant_map.get(segment.seg_type, "Unknown")
-        
-        no_bytes = str(len(segment.data))
-        t = time.time()
-        t_take = (t - self.time_start) * 1000
-        time_str =  f"{t_take:.2f}"
-
-        log_str = f'{action.ljust(5)} {time_str.ljust(10)} {seg_type.ljust(5)} {seqno_str.ljust(5)} {no_bytes.ljust(5)}\n'
-
-        f = open("Sender_log.txt", "a+")
-        f.write(log_str)
-        f.close()
-   
-    # reads file and creates segments to send
+        t = (time.time() - self.time_start) * 1000
+        srtt = self.rtt.srtt * 1000 if self.rtt.srtt != None else None
+        self.log.packet(action, t, segment.seg_type, segment.seqno, len(segment.data), srtt, self.rtt.rto * 1000)
+
+    # opens the file as a segment source, segments are only made as the window reaches them
     def create_segments(self):
-        f = open(self.txt_file_send, 'rb')
-        file_data = f.read()
-        seqno = (self.ISN + 1) % 2**16
-
-        for i in range(0, len(file_data), MSS):
-            data = file_data[i:i+MSS]
-            new_seqno = (seqno + len(data)) % 2**16
-            segment = STPSegment(DATA, seqno, data)
-            self.segments.append(segment)
-            seqno = new_seqno
-        self.oldest_seg = self.segments[self.base]
-        self.expected_ack = (self.oldest_seg.seqno + len(self.oldest_seg.data)) % 2**16
+        seqno = self.seq.add(self.ISN, 1)
+        if self.framed:
+            self.segments = ObjectSource(seqno, self.mss, self.seq)
+            if self.objects != None: # everything there is to send, otherwise connect() has it added later
+                for name, path in self.objects:
+                    self.segments.add_file(name, path)
+                self.segments.seal()
+        elif self.codec != None:
+            self.segments = CompressedSource(self.txt_file_send, seqno, self.mss, self.seq, self.codec, self.lock, self.added)
+        elif self.stripe != None:
+            self.segments = SegmentSource(self.txt_file_send, seqno, self.mss, self.seq, self.stripe[3], self.stripe[4])
+        else:
+            self.segments = SegmentSource(self.txt_file_send, seqno, self.mss, self.seq)
+        self.board = Scoreboard(seqno, self.segments.size, self.max_win, self.mss, self.seq)
+        if self.codec != None:
+            self.segments.start()
+        if len(self.segments) == 0: # nothing to send yet, or nothing at all and it goes straight to closing
+            self.expected_ack = seqno
+            return
+        self.oldest_seg = self.segments[self.board.base]
+        self.expected_ack = self.seq.add(self.oldest_seg.seqno, len(self.oldest_seg.data))
 
+    # takes every ack waiting on the socket per wakeup and handles them under one
+    # acquisition of the lock, retransmits they cause go out as one burst afterwards
     def receive_acks(self):
         while 1:
-            rcvd_ack = self.receive_segment() # wait to receive an segment
-            if rcvd_ack == None or rcvd_ack.seg_type != ACK:
-                continue
-            self.lock.acquire()
-            if rcvd_ack.seqno >= self.expected_ack:
-                # check if this is the ack for the oldest unacked segment
-                self.update_logs("rcv", rcvd_ack)
+            done = False
+            burst = self.io.recv() # wait for at least one segment
+            with self.lock:
+                for seg_bytes, _ in burst:
+                    rcvd_ack = self.incoming(seg_bytes)
+                    if rcvd_ack == None or rcvd_ack.seg_type != ACK:
+                        continue
+                    done = self.process_ack(rcvd_ack)
+                    if done:
+                        break
+                done = done or self.all_acked()
+            self.io.flush()
+            if done:
+                return
 
-                if rcvd_ack.seqno == self.expected_ack:
-                    self.sent_unacked.remove(self.oldest_seg) # remove from sent unacked list
-                    self.base += 1 # slide the window   
-                elif rcvd_ack.seqno > self.expected_ack: # deal with cumulitive acks
-                    # change base to index of rcvd_acks seqno segment in segments
-                    self.base = self.get_base(rcvd_ack.seqno)
-                    # go through sent unacked and remove the segments that have smaller seqno than the rcvd_ack.seqno
-                    self.sent_unacked = [seg for seg in self.sent_unacked if seg.seqno >= rcvd_ack.seqno]
-
-                # reach end of segments -> all data sent, clean thread stuff and exit
-                if self.base >= len(self.segments) and len(self.sent_unacked) == 0:
-                    self.last_ack_log = rcvd_ack.seqno 
-                    self.lock.release() 
-                    self.stop_timer()
-                    self.ack_received_event.set()
-                    return
-                
-                self.oldest_seg = self.segments[self.base] # update the oldest segment to the next unsent segment
-                self.expected_ack = (self.oldest_seg.seqno + len(self.oldest_seg.data)) % 2**16 # update the expected ack aswell
-                self.ack_received_event.set() # unblock
-
-                if len(self.sent_unacked) == 0: 
-                    self.stop_timer()
-            else:
+    # handles one ack with the lock held, returns true once everything has been acked
+    def process_ack(self, rcvd_ack):
+        opened = rcvd_ack.window != None and self.update_window(rcvd_ack)
+        if self.sack_ok and rcvd_ack.options and OPT_SACK in rcvd_ack.options:
+            self.board.sack(unpack_sack(rcvd_ack.options[OPT_SACK]))
+        new_base = self.board.acked_upto(rcvd_ack.seqno)
+        if new_base == None:
+            # the receiver never opens the window in a dupack, so an ack that did is a
+            # window update or answers a probe. with nothing in flight it cant be a dupack either
+            if not opened and self.board.in_flight() > 0:
                 self.handle_dupack(rcvd_ack) # otherwise check if its a duplicated ACK
-            self.lock.release()
-    
-    def get_base(self, seqno):
-        i = self.base
-        while i < len(self.segments):
-            if self.segments[i].seqno == seqno:
-                return i
-            i += 1
+            return False
+
+        # ack for the oldest unacked segment, or a cumulative ack past it
+        rtt = self.board.rtt_sample(new_base, time.monotonic())
+        if rtt != None:
+            self.rtt.sample(rtt)
+            self.rtt_samples.observe(rtt)
+        else:
+            self.rtt.reset_backoff()
+        self.update_logs("rcv", rcvd_ack)
+        acked = new_base - self.board.base
+        self.board.advance(new_base) # slide the window
+        self.segments.release(new_base) # acked segments are no longer needed
+        self.dupACK = 0
+        self.acked_at = time.monotonic() # the timer counts the rto from here
+
+        if new_base >= len(self.segments):
+            self.expected_ack = rcvd_ack.seqno
+            self.drained.set()
+            # reach end of segments -> all data sent, clean thread stuff and exit
+            if self.segments.sealed:
+                self.last_ack_log = rcvd_ack.seqno
+                self.stop_timer()
+                self.ack_received_event.set()
+                return True
+            self.oldest_seg = None # caught up with the objects added so far, send_next sets it again
+        else:
+            self.oldest_seg = self.segments[new_base] # update the oldest segment to the next unsent segment
+            self.expected_ack = self.seq.add(self.oldest_seg.seqno, len(self.oldest_seg.data)) # update the expected ack aswell
+        partial = self.cc.on_ack(acked, new_base, time.monotonic(), self.rtt.srtt)
+        if self.sack_ok and self.board.in_recovery():
+            self.retransmit_holes("sack") # whatever the SACK blocks say is still missing
+        elif partial:
+            self.retransmit_oldest("partial") # partial ack in recovery, the next hole is lost too
+        self.ack_received_event.set() # unblock
+
+        if self.board.in_flight() == 0:
+            self.stop_timer()
+        return False
+
+    # moves the edge of the receivers window up (the receiver never moves it back), true if it moved
+    def update_window(self, ack):
+        offset = self.board.ack_offset(ack.seqno)
+        if offset == None or offset + ack.window <= self.send_edge:
+            return False
+        self.send_edge = offset + ack.window
+        if self.persist_timer != None: # a later stall starts its own
+            self.persist_timer.cancel()
+            self.persist_timer = None
+            self.persist_gen += 1
+        self.persist_delay = 0
+        self.ack_received_event.set() # the window may have opened
+        return True
+
+    # every segment there will ever be has been acked
+    def all_acked(self):
+        return self.segments.sealed and self.board.base >= len(self.segments)
 
     def sliding_window(self, segments):
-        win_i = 0 # window index
-        self.oldest_seg = segments[self.base] # keep track of oldest unacked seg and expected ack
-        self.expected_ack = (self.oldest_seg.seqno + len(self.oldest_seg.data)) % 2**16
-
-        while self.base < len(segments): # iterate through all segments
-            # sending segments within the window
-            while win_i < min(self.base + self.max_win, len(segments)):
-                self.lock.acquire()
-                win_i = max(win_i, self.base)
-                seg = segments[win_i]               
-                if seg not in self.sent_unacked: # if sent but not acked, send and add to sent unacked list
-                    if self.send_segment(seg):
-                        self.update_logs("snd", seg)
-                    self.segs_log += 1
-                    self.sent_unacked.append(seg)
-                    
-                    if not self.timer_running: 
-                        self.start_timer()  # start timer for timeout
-                
-                win_i += 1
-                self.lock.release()
-            # wait for an ack or timeout
-            self.ack_received_event.wait()        
-            self.ack_received_event.clear() 
+        if self.all_acked():
+            return
+
+        while not self.all_acked(): # iterate through all segments
+            # sending segments within the window that havent been sent yet, in one burst
+            with self.lock:
+                self.fill_window()
+                wait = self.pace_wait
+            self.io.flush()
+            # wait for an ack or timeout, or until the pacer lets the next segment go
+            self.ack_received_event.wait(wait)
+            self.ack_received_event.clear()
+
+    def window_open(self):
+        return self.board.nxt < min(self.board.base + self.cc.window(), len(self.segments)) \
+            and (not self.flow or self.board.end_of(self.board.nxt) <= self.send_edge)
+
+    # sends the next never sent segment, with the lock held
+    def send_next(self):
+        seg = self.segments[self.board.nxt]
+        if self.board.nxt == self.board.base: # everything before was acked, it is the oldest one now
+            self.oldest_seg = seg
+            self.expected_ack = self.seq.add(seg.seqno, len(seg.data))
+        self.board.on_send(self.board.nxt, time.monotonic())
+        if self.send_segment(seg):
+            self.update_logs("snd", seg)
+        self.segs_log += 1
+        if self.fec != None:
+            parity = self.fec.add(self.board.nxt, seg.data)
+            if parity == None and self.segments.sealed and self.board.nxt + 1 == len(self.segments):
+                parity = self.fec.flush() # the last group is short
+            if parity != None:
+                self.send_parity(*parity)
+        self.board.nxt += 1
+
+        if not self.timer_running:
+            self.start_timer()  # start timer for timeout
+
+    # parity of the group starting at segment first, it isnt acked or resent
+    def send_parity(self, first, payload):
+        seg = STPSegment(PARITY, self.board.seqno_of(first), payload, wide=self.seq.wide)
+        if self.send_segment(seg):
+            self.update_logs("snd", seg)
+        self.parity_log += 1
+
+    # sends everything the window allows, for callers that already hold the lock
+    def fill_window(self):
+        self.pace_wait = None
+        while self.window_open():
+            if self.pacer != None and not self.paced():
+                break
+            self.send_next()
+        if self.framed and self.board.in_flight() == 0 and self.board.nxt >= len(self.segments) \
+                and self.segments.pad():
+            # like nagle, the short last segment waits while anything is in flight,
+            # once nothing is it is padded up to a whole segment and goes out
+            self.board.size = self.segments.size
+            while self.window_open():
+                self.send_next()
+        if self.flow and self.board.in_flight() == 0 and self.board.nxt < len(self.segments) \
+                and self.persist_timer == None and self.pace_wait == None:
+            # only the receivers window holds the next segment back and there is nothing in flight to bring an ack
+            if self.persist_delay == 0:
+                self.persist_delay = self.rtt.rto
+            self.persist_timer = self.timers.call_later(self.persist_delay, self.probe_window, self.persist_gen)
+
+    # bytes per second the pacer lets out now, None while it has no rtt to go by
+    def pacing_rate(self):
+        return self.pacer.window_rate(self.cc.window() * self.mss, self.rtt.srtt, self.cc.cwnd < self.cc.ssthresh)
+
+    # true if the pacer lets the next segment go now, otherwise it sets pace_wait
+    def paced(self):
+        wait = self.pacer.take(self.mss, self.pacing_rate(), time.monotonic(), self.mss)
+        if wait == 0:
+            return True
+        self.pace_wait = wait
+        if self.notify != None and self.pace_timer == None: # the event loop has no sliding window to wait in
+            self.pace_timer = self.timers.call_later(wait, self.pace_timeout)
+        return False
+
+    def pace_timeout(self):
+        self.pace_timer = None
+        self.notify()
+
+    # the window is still closed, ask the receiver for it with an empty segment just
+    # behind the cumulative point (like a tcp zero window probe), runs on the timer thread
+    def probe_window(self, gen):
+        with self.lock:
+            if gen != self.persist_gen:
+                return # the window opened while waiting for the lock
+            self.persist_timer = None
+            self.persist_gen += 1
+            if self.state != EST or self.board.in_flight() > 0 or self.board.nxt >= len(self.segments) \
+                    or self.window_open():
+                return
+            probe = STPSegment(DATA, self.seq.add(self.board.seqno_of(self.board.nxt), -1), '', wide=self.seq.wide)
+            if self.send_segment(probe):
+                self.update_logs("snd", probe)
+            self.probes_log += 1
+            self.persist_delay = min(2 * self.persist_delay, MAX_RTO)
+            self.persist_timer = self.timers.call_later(self.persist_delay, self.probe_window, self.persist_gen)
+        self.io.flush()
 
 
     def handle_dupack(self, ack):
         if ack.seqno == self.oldest_seg.seqno:
             self.dupacks_log += 1
             self.dupACK += 1
-            if self.dupACK == 3: # if 3 dupacks, resend the oldest segment
-                if self.send_segment(self.oldest_seg):
-                    self.retransmit_log += 1
-                    self.update_logs("snd", self.oldest_seg)
+            if self.dupACK >= self.dupthresh(): # enough dupacks, resend the oldest segment
+                self.cc.on_fast_retransmit(self.board.in_flight(), self.board.nxt, time.monotonic())
+                if not self.sack_ok:
+                    self.retransmit_oldest("fast")
+                elif self.board.in_recovery():
+                    self.retransmit_holes("fast")
+                else: # with SACK the holes go out as the pipe drains, not one per loss event
+                    self.board.recover_until = self.board.nxt
+                    if self.retransmit_holes("fast", True) == 0:
+                        self.retransmit_oldest("fast")
                 self.dupACK = 0 # reset dupack count
+            else:
+                self.cc.on_dupack()
+                if self.sack_ok and self.board.in_recovery():
+                    self.retransmit_holes("sack")
+                self.ack_received_event.set() # the window may have been inflated
 
-    def start_timer(self):
-        # start a new thread that runs the timer
+    # dupacks that set off a fast retransmit. with fec a single loss in a group brings up to
+    # k-1 of them before the parity fills the hole, so wait for those while a window has room for them
+    def dupthresh(self):
+        if self.fec == None:
+            return 3
+        return max(3, min(self.fec.k, self.cc.window() - 1))
+
+    # resends the holes the SACK blocks point at while the pipe estimate is below the
+    # congestion window (rfc 6675), returns how many. the first hole of a recovery goes
+    # regardless. reason is what set it off (fast, sack, partial or timeout), counted in the metrics
+    def retransmit_holes(self, reason, first = False):
+        sent = 0
+        while (first and sent == 0) or self.board.pipe() < self.cc.recovery_window():
+            i = self.board.next_hole()
+            if i == None:
+                break
+            seg = self.segments[i]
+            self.board.mark_resent(i)
+            self.board.on_retransmit()
+            if self.send_segment(seg):
+                self.retransmit_log += 1
+                self.metrics.count(f"retransmits_{reason}_total")
+                self.update_logs("snd", seg)
+            sent += 1
+        return sent
+
+    def retransmit_oldest(self, reason):
+        self.board.mark_resent(self.board.base)
+        self.board.on_retransmit()
+        if self.send_segment(self.oldest_seg):
+            self.retransmit_log += 1
+            self.metrics.count(f"retransmits_{reason}_total")
+            self.update_logs("snd", self.oldest_seg)
+
+    def start_timer(self, delay = None):
         self.timer_running = True
-        self.ack_timer = threading.Timer(self.rto, self.handle_timeout)
-        self.ack_timer.start()
+        self.timer_gen += 1
+        if delay == None:
+            delay = self.rtt.rto
+            self.timer_started_at = time.monotonic()
+        self.ack_timer = self.timers.call_later(delay, self.handle_timeout, self.timer_gen)
 
     def stop_timer(self):
         if self.timer_running:
             self.ack_timer.cancel()
             self.timer_running = False
 
-    def handle_timeout(self):
-        if self.send_segment(self.oldest_seg):
-            self.update_logs("snd", self.oldest_seg)
-            self.retransmit_log += 1
-        self.start_timer()
+    def handle_timeout(self, gen):
+        with self.lock:
+            if not self.timer_running or gen != self.timer_gen:
+                return # stopped or restarted while waiting for the lock
+            # acks of new data restart the rto (rfc 6298 5.3), rather than rearming the
+            # timer on every ack it is pushed back here when it fires early
+            left = max(self.timer_started_at, self.acked_at) + self.rtt.rto - time.monotonic()
+            if left > CLOCK_G:
+                self.start_timer(left)
+                return
+            self.rtt.backoff()
+            self.cc.on_timeout(self.board.in_flight(), time.monotonic())
+            if self.sack_ok: # keep the SACK info but let every hole be resent again
+                self.board.on_timeout()
+                self.board.recover_until = self.board.nxt
+            self.retransmit_oldest("timeout")
+            self.start_timer()
+        self.io.flush()
 
+    # for use as a library: connect() once, add any number of objects with send_file()
+    # and send_bytes() (they only queue them, the window goes on sending in the background),
+    # flush() waits until the receiver has everything and close() ends the connection
+    def connect(self):
+        self.framed = True
+        while self.state != EST:
+            if self.state == CLOSED:
+                self.send_syn()
+            if self.state == SYN_SENT:
+                self.receive_synack()
+        self.sock.settimeout(None)
+        self.create_segments()
+        self.drained.set()
+        self.ack_thread.start()
+        self.pump = threading.Thread(target=self.sliding_window, args=(self.segments,), daemon=True)
+        self.pump.start()
 
-def main():
-    sender_port, receiver_port, txt_file_send,\
-        max_win, rto, flp, rlp = parse_args(sys.argv)
+    def send_file(self, path, name = None):
+        with self.lock:
+            self.segments.add_file(os.path.basename(path) if name == None else name, path)
+            self.added()
 
-    f_log = open("Sender_log.txt", "w")
-    f_log.close()
-    
-    sender = Sender(sender_port, receiver_port, txt_file_send, max_win, rto, flp, rlp)
-    random.seed()
-    
-    # ESTABLISHING CONNECTION
+    def send_bytes(self, data, name = ""):
+        with self.lock:
+            self.segments.add_bytes(name, data)
+            self.added()
+
+    # with the lock held
+    def added(self):
+        self.board.size = self.segments.size
+        self.ack_received_event.set() # the window gets to the new segments
+        if self.notify != None:
+            self.notify()
+        elif self.all_acked(): # the stream was sealed after its last ack, the ack thread is still waiting
+            self.wake_acks()
+
+    # waits until every object added so far has been acked
+    def flush(self):
+        while 1:
+            with self.lock:
+                if self.board.base * self.mss >= self.segments.size:
+                    return
+                self.drained.clear() # only set again by an ack from now on
+            self.drained.wait()
+
+    # sends whatever is still queued, then the FIN
+    def close(self):
+        with self.lock:
+            self.segments.seal()
+            self.board.size = self.segments.size
+            self.ack_received_event.set()
+        self.pump.join()
+        self.wake_acks()
+        self.ack_thread.join()
+        self.count_drops()
+        self.segments.close()
+        self.state = CLOSING
+        while self.state != CLOSED:
+            if self.state == CLOSING:
+                self.send_fin()
+            if self.state == FIN_WAIT and self.receive_finack() != None:
+                self.state = CLOSED
+        self.sock.close()
+
+    # the ack thread only looks at all_acked() once something arrives, when the last
+    # ack came in before the stream was sealed it would wait forever without this
+    def wake_acks(self):
+        if self.ack_thread.is_alive():
+            self.sock.sendto(b"", self.sock.getsockname())
+
+
+def format_stats(stats):
+    data_sent = f'Original data sent: {str(stats["data_sent"]).rjust(10)}\n'
+    data_acked = f'Original data acked: {str(stats["data_acked"]).rjust(10)}\n'
+    segs_sent = f'Original segments sent: {str(stats["segs"]).rjust(5)}\n'
+    retransmit = f'Retransmitted segments: {str(stats["retransmits"]).rjust(5)}\n'
+    dupack = f'Dup acks received: {str(stats["dupacks"]).rjust(10)}\n'
+    dupack += f'Window probes sent: {str(stats["probes"]).rjust(9)}\n'
+    if stats["parity"] > 0:
+        dupack += f'Parity segments sent: {str(stats["parity"]).rjust(7)}\n'
+    if stats["pace_waits"] > 0:
+        dupack += f'Pacing waits: {str(stats["pace_waits"]).rjust(15)}\n'
+    if stats["raw"] > 0:
+        ratio = f'{stats["raw"] / stats["data_acked"]:.2f}' if stats["data_acked"] > 0 else '-'
+        dupack += f'Data before compression: {str(stats["raw"]).rjust(6)}\n'
+        dupack += f'Compression ratio: {ratio.rjust(12)}\n'
+        dupack += f'Compression time (s): {stats["compress_time"]:.3f}\n'
+    if stats["objects"] > 0:
+        dupack += f'Objects sent: {str(stats["objects"]).rjust(15)}\n'
+    drop_data = f'Data segments dropped: {str(stats["drop_data"]).rjust(5)}\n'
+    drop_ack = f'Ack segments dropped: {str(stats["drop_ack"]).rjust(5)}\n'
+    sock_drops = f'Socket buffer drops: {str(stats["sock_drops"]).rjust(6)}\n'
+    if stats["malformed"] > 0:
+        sock_drops += f'Malformed datagrams dropped: {str(stats["malformed"]).rjust(4)}\n'
+    srtt = f'{stats["srtt"] * 1000:.2f}' if stats["srtt"] != None else '-'
+    rtt = f'Smoothed RTT (ms): {srtt.rjust(10)}\n'
+    rto_ms = f'{stats["rto"] * 1000:.2f}'
+    rto = f'Final RTO (ms): {rto_ms.rjust(10)}'
+
+    return "\n" + data_sent + data_acked + segs_sent + retransmit + dupack + drop_data + drop_ack + sock_drops + rtt + rto
+
+# stats of all the stripes as one transfer: counts add up, the rtt is averaged and the rto is the worst one
+def combine_stats(all_stats):
+    total = {key: sum(stats[key] for stats in all_stats) for key in all_stats[0] if key not in ("srtt", "rto")}
+    srtts = [stats["srtt"] for stats in all_stats if stats["srtt"] != None]
+    total["srtt"] = sum(srtts) / len(srtts) if len(srtts) > 0 else None
+    total["rto"] = max(stats["rto"] for stats in all_stats)
+    return total
+
+
+def run(sender):
     while 1:
+        # ESTABLISHING CONNECTION
         if sender.state == CLOSED:
-            try:
-                seg = STPSegment(SYN, sender.ISN,'') # create syn packet
-                if not sender.first:
-                    sender.time_start = time.time()
-                    sender.first = True
-                if sender.send_segment(seg): # send packet to rcv
-                    sender.update_logs("snd", seg)                
-            except Exception as e:
-                sys.exit(f"Failed to start connection")
-            sender.state = SYN_SENT
+            sender.send_syn()
         if sender.state == SYN_SENT:
-            r_ack_seg = sender.receive_synack()
-            if r_ack_seg != None:  
-                # print("Connection established")
-                sender.seqno = (sender.seqno + 1) % 2**16
-                sender.state = EST
-                
-    
+            sender.receive_synack()
+
         # SENDING DATA
         if sender.state == EST:
             sender.sock.settimeout(None)
             sender.create_segments()
             # starts receiving acks in a separate thread
-            sender.ack_thread.start()
+            if not sender.all_acked():
+                sender.ack_thread.start()
 
             sender.sliding_window(sender.segments)
+            if sender.ack_thread.is_alive(): # a compressed stream can end after its last ack
+                sender.ack_thread.join()
+            sender.count_drops()
+            sender.segments.close()
             sender.state = CLOSING
-        
+
         # CLOSING CONNECTION
         if sender.state == CLOSING:
-            try:
-                sender.last_fin_seqno = sender.expected_ack
-                seg = STPSegment(FIN, sender.expected_ack,'') # create fin packet
-                if sender.send_segment(seg): # send packet to rcv
-                    sender.update_logs("snd", seg)
-                sender.state = FIN_WAIT
-            except Exception as e:
-                sys.exit(f"Failed to send fin packet")
+            sender.send_fin()
         if sender.state == FIN_WAIT:
             r_ack_seg = sender.receive_finack()
-            if r_ack_seg != None:                 
+            if r_ack_seg != None:
                 sender.state = CLOSED
                 sender.sock.close()
                 break
 
-    sender.final_stats(f_log.name)
+
+# the same state machine driven by one asyncio loop: no ack thread, and timers are loop.call_later
+class SenderProtocol(asyncio.DatagramProtocol):
+    def __init__(self, sender, done):
+        self.sender = sender
+        self.done = done
+        self.handshake_timer = None
+
+    def connection_made(self, transport):
+        self.sender.transport = transport
+        loop = asyncio.get_running_loop()
+        self.sender.notify = lambda: loop.call_soon_threadsafe(self.more_data)
+        self.send_syn()
+
+    def send_syn(self):
+        self.sender.send_syn()
+        self.handshake_timer = self.sender.timers.call_later(self.sender.rtt.rto, self.syn_timeout)
+
+    def syn_timeout(self):
+        if self.sender.state == SYN_SENT:
+            # print("Timeout for ACK, resending SYN")
+            self.sender.rtt.backoff()
+            self.sender.state = CLOSED
+            self.send_syn()
+
+    def send_fin(self):
+        self.sender.send_fin()
+        self.handshake_timer = self.sender.timers.call_later(self.sender.rtt.rto, self.fin_timeout)
+
+    def fin_timeout(self):
+        if self.sender.state == FIN_WAIT:
+            # print("Timeout for ACK, resending FIN")
+            self.sender.rtt.backoff()
+            self.sender.state = CLOSING
+            self.send_fin()
+
+    # all data acked, move on to closing
+    def finish_data(self):
+        self.sender.count_drops()
+        self.sender.segments.close()
+        self.sender.state = CLOSING
+        self.send_fin()
+
+    # the compressor added to the stream (or sealed it), from its thread
+    def more_data(self):
+        sender = self.sender
+        if sender.state != EST:
+            return
+        with sender.lock:
+            done = sender.all_acked()
+            if not done:
+                sender.fill_window()
+        if done:
+            self.finish_data()
+
+    def datagram_received(self, data, addr):
+        sender = self.sender
+        rcvd = sender.incoming(data)
+        if rcvd == None:
+            return
+
+        if sender.state == SYN_SENT:
+            if sender.is_synack(rcvd):
+                self.handshake_timer.cancel()
+                sender.on_synack(rcvd)
+                sender.create_segments()
+                if sender.all_acked():
+                    self.finish_data()
+                else:
+                    with sender.lock:
+                        sender.fill_window()
+        elif sender.state == EST:
+            if rcvd.seg_type != ACK:
+                return
+            with sender.lock:
+                done = sender.process_ack(rcvd)
+                if not done:
+                    sender.fill_window()
+            if done:
+                self.finish_data()
+        elif sender.state == FIN_WAIT:
+            if sender.is_finack(rcvd):
+                sender.update_logs("rcv", rcvd)
+                self.handshake_timer.cancel()
+                sender.state = CLOSED
+                self.done.set_result(None)
+
+async def run_async(sender):
+    loop = asyncio.get_running_loop()
+    sender.timers = loop
+    if sender.pacer != None:
+        sender.pacer.quantum = pacing.ASYNC_QUANTUM
+    done = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: SenderProtocol(sender, done), sock=sender.sock)
+    try:
+        await done
+    finally:
+        transport.close()
+
+
+# the mss to ask the receiver for
+def requested_mss(args):
+    mss = args.mss if args.mss != None else stp.DEFAULT_MSS
+    if args.probe_mss:
+        probed = stp.probe_mss(('127.0.0.1', args.receiver_port))
+        if probed != None:
+            mss = min(probed, args.mss) if args.mss != None else probed
+    return mss
+
+# (name, path) of every file to send with --objects, a plain file is sent as the one object
+def object_files(path):
+    if not os.path.isdir(path):
+        return [(os.path.basename(path), path)]
+    names = sorted(name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name)))
+    return [(name, os.path.join(path, name)) for name in names]
+
+def make_sender(args, sender_port, stripe = None, log_path = None):
+    return Sender(sender_port, args.receiver_port, args.txt_file_send, args.max_win,
+                  args.rto, args.flp, args.rlp, cc=args.cc, sack=args.sack,
+                  log_level=eventlog.LEVELS[args.log], trace=args.trace,
+                  timer_resolution=args.timer_resolution / 1000, stripe=stripe, log_path=log_path,
+                  mss=requested_mss(args), objects=object_files(args.txt_file_send) if args.objects else None,
+                  fec_k=args.fec, codec=compress.NAMES[args.compress] if args.compress != None else None,
+                  pace=args.pace)
+
+def run_engine(args, sender):
+    if args.engine == "asyncio":
+        asyncio.run(run_async(sender))
+    else:
+        run(sender)
+
+# log of stripe i, e.g. Sender_log_2.txt
+def stripe_log_path(args, i):
+    root, ext = os.path.splitext(TRACE_FILE if args.trace else LOG_FILE)
+    return f"{root}_{i}{ext}"
+
+# metrics of stripe i go to a file of their own, over udp the stripe label tells them apart
+def stripe_metrics_path(args, i):
+    if args.metrics == None or args.metrics.startswith("udp:"):
+        return args.metrics
+    root, ext = os.path.splitext(args.metrics)
+    return f"{root}_{i}{ext}"
+
+# runs in a worker process, sends one stripe and returns its stats
+def send_stripe(args, stripe):
+    random.seed()
+    index = stripe[1]
+    sender = make_sender(args, args.sender_port + index, stripe, stripe_log_path(args, index))
+    metrics.start_from_args(sender.metrics, args, stripe_metrics_path(args, index))
+    run_engine(args, sender)
+    sender.metrics.close()
+    sender.final_stats()
+    sender.log.close()
+    return sender.stats()
+
+# splits the file into contiguous mss aligned ranges, one connection and process each,
+# the receiver writes every stripe at its offset so they can arrive in any order
+def send_striped(args):
+    size = os.path.getsize(args.txt_file_send)
+    mss = requested_mss(args) # the receiver may still agree to less, then the ranges just arent aligned
+    per_stripe = math.ceil(math.ceil(size / mss) / args.stripes) * mss
+    count = math.ceil(size / per_stripe)
+    transfer_id = random.randint(0, 2**32 - 1)
+    stripes = [(transfer_id, i, count, i * per_stripe, min(per_stripe, size - i * per_stripe))
+               for i in range(count)]
+
+    with concurrent.futures.ProcessPoolExecutor(len(stripes)) as pool:
+        all_stats = list(pool.map(send_stripe, [args] * len(stripes), stripes))
+
+    log = eventlog.EventLog(TRACE_FILE if args.trace else LOG_FILE, constant_map,
+                            eventlog.LEVELS[args.log], binary=args.trace, rtt_columns=True)
+    for (_, i, _, offset, length), stats in zip(stripes, all_stats):
+        log.summary(f"Stripe {i}: bytes {offset} - {offset + length}, port {args.sender_port + i}, "
+                    f"log in {stripe_log_path(args, i)}\n")
+    log.summary(f"\nStriped transfer over {len(stripes)} connections" + format_stats(combine_stats(all_stats)))
+    log.close()
+
+
+def main():
+    args = parse_args(sys.argv)
+    random.seed()
+
+    if args.max_win < stp.MIN_MSS or (args.mss != None and args.mss < stp.MIN_MSS):
+        sys.exit(f"max_win and --mss need to be at least {stp.MIN_MSS} bytes")
+    if args.fec != 0 and not fec.MIN_K <= args.fec <= fec.MAX_K:
+        sys.exit(f"--fec takes groups of {fec.MIN_K} to {fec.MAX_K} segments")
+    if args.stripes > 1 and args.objects:
+        sys.exit("--stripes cannot be used with --objects")
+    if args.pace != None:
+        try:
+            pacing.parse_rate(args.pace)
+        except ValueError:
+            sys.exit("--pace takes 'auto' or a rate in Mbit/s")
+    if args.compress != None and (args.stripes > 1 or args.objects):
+        sys.exit("--compress cannot be used with --stripes or --objects")
+    if args.compress != None and compress.NAMES[args.compress] not in compress.available():
+        sys.exit(f"{args.compress} is not available here")
+    if args.stripes > 1 and os.path.getsize(args.txt_file_send) > requested_mss(args):
+        return send_striped(args)
+
+    sender = make_sender(args, args.sender_port)
+    metrics.start_from_args(sender.metrics, args)
+    run_engine(args, sender)
+    sender.metrics.close()
+
+    sender.final_stats()
+    sender.log.close()
                 
             
 
 if __name__ == '__main__':
     sys.exit(main())
-
@@ -1,34 +1,231 @@
-import sys
+import struct
+import socket
+
+HEADER = struct.Struct('!HH') # seg type, seqno
+HEADER_SIZE = HEADER.size
+WIDE_HEADER = struct.Struct('!HI') # seg type, 32 bit seqno
+WINDOW = struct.Struct('!I') # receive window in bytes, 32 bits is enough for any max_win without a scale factor
+MAX_HEADER_SIZE = WIDE_HEADER.size + WINDOW.size
+
+# when this flag is set in the type field an options block follows the header:
+# one length byte then (kind, length, value) entries
+FLAG_OPTIONS = 0x8000
+FLAG_WIDE = 0x4000 # the seqno is 32 bits, only once both ends agreed to it with OPT_WIDE
+FLAG_WINDOW = 0x2000 # the receive window follows the seqno, in acks once both ends agreed to OPT_WINDOW
+TYPE_MASK = 0x00FF
+MAX_OPTIONS_SIZE = 1 + 255
+
+# option kinds
+OPT_MSS = 2 # in the SYN the largest segment the sender would send, in its ACK the agreed one
+OPT_WIDE = 3 # in the SYN the 32 bit ISN of a sender that can use 32 bit seqnos, echoed (empty) in the ACK
+OPT_SACK_PERMITTED = 4 # in the SYN and its ACK, both ends understand SACK blocks
+OPT_SACK = 5 # (start, end) seqno ranges the receiver holds past the cumulative ack
+OPT_STRIPE = 6 # in the SYN, this connection carries one byte range of a striped file
+OPT_WINDOW = 7 # in the SYN the sender does flow control, in its ACK the receivers first window (later acks have FLAG_WINDOW)
+OPT_OBJECTS = 8 # in the SYN and its ACK, the stream carries framed objects rather than one file
+OPT_FEC = 9 # in the SYN and its ACK, a parity segment follows every FEC.k data segments
+OPT_COMPRESS = 10 # in the SYN the codec the sender would compress with, echoed if the receiver has it
+
+SACK_BLOCK = struct.Struct('!II')
+MAX_SACK_BLOCKS = 16 # leaves room for other options in the same ack
+
+# transfer id, stripe index, number of stripes, file offset of the stripe
+STRIPE = struct.Struct('!IHHQ')
+
+FEC = struct.Struct('!H') # data segments per parity segment
+COMPRESS = struct.Struct('!B') # codec, compress.ZLIB / LZMA / ZSTD
+
+ISN = struct.Struct('!I')
+MSS = struct.Struct('!H')
+DEFAULT_MSS = 1000 # what is used with a peer that doesnt send OPT_MSS
+MIN_MSS = 16 # an OPT_MSS below this is malformed, neither end asks for less
+MAX_MSS = 65507 - MAX_HEADER_SIZE - MAX_OPTIONS_SIZE # largest udp payload less the stp header
+IP_UDP_HEADERS = 28
+
+# the lengths the value of an option can have, a segment with any other is malformed.
+# OPT_SACK holds whole SACK_BLOCKs, kinds that arent here are ignored
+OPTION_SIZES = {
+    OPT_MSS: (MSS.size,),
+    OPT_WIDE: (ISN.size, 0), # empty in the ACK
+    OPT_SACK_PERMITTED: (0,),
+    OPT_STRIPE: (STRIPE.size,),
+    OPT_WINDOW: (0, WINDOW.size), # empty in the SYN
+    OPT_OBJECTS: (0,),
+    OPT_FEC: (FEC.size,),
+    OPT_COMPRESS: (COMPRESS.size,)
+}
+
+# raises ValueError for an option that cant be unpacked as its kind, or one no peer sends
+def check_options(options):
+    for kind, value in options.items():
+        if kind == OPT_SACK:
+            ok = len(value) % SACK_BLOCK.size == 0
+        else:
+            ok = kind not in OPTION_SIZES or len(value) in OPTION_SIZES[kind]
+        if not ok:
+            raise ValueError(f"option {kind} of {len(value)} bytes")
+        if kind == OPT_MSS and MSS.unpack(value)[0] < MIN_MSS:
+            raise ValueError(f"mss of {MSS.unpack(value)[0]}")
+        if kind == OPT_STRIPE:
+            _, index, count, _ = STRIPE.unpack(value)
+            if index >= count:
+                raise ValueError(f"stripe {index} of {count}")
+
+# linux socket options for the path mtu, the socket module doesnt have them
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_DO = 2
+IP_MTU = 14
+
+# largest mss that reaches addr in one unfragmented datagram, from the path mtu the
+# kernel has for the route (64KB on loopback, the interface mtu elsewhere unless an
+# icmp message lowered it). None where the kernel wont say
+def probe_mss(addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        sock.connect(addr)
+        mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    return max(MIN_MSS, min(mtu - IP_UDP_HEADERS - MAX_HEADER_SIZE - MAX_OPTIONS_SIZE, MAX_MSS))
+
+# seqno arithmetic modulo the sequence space (rfc 1982 serial numbers). a seqno is
+# only ahead of another while the diff is less than half the space
+class SeqSpace:
+    def __init__(self, bits):
+        self.bits = bits
+        self.wide = bits > 16 # segments need the 32 bit header
+        self.size = 2**bits
+        self.half = 2**(bits - 1)
+
+    def add(self, seqno, n):
+        return (seqno + n) % self.size
+
+    # how far b is ahead of a
+    def diff(self, b, a):
+        return (b - a) % self.size
+
+NARROW = SeqSpace(16) # what every peer understands
+WIDE = SeqSpace(32)
+
+def pack_sack(blocks):
+    return b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks[:MAX_SACK_BLOCKS])
+
+def unpack_sack(value):
+    return [SACK_BLOCK.unpack_from(value, i) for i in range(0, len(value), SACK_BLOCK.size)]
 
 class STPSegment:
-    def __init__(self, seg_type, seqno, data = None):
+    __slots__ = ('seg_type', 'seqno', 'data', 'options', 'wide', 'window')
+
+    def __init__(self, seg_type, seqno, data = None, options = None, wide = False, window = None):
 
         self.seg_type = seg_type # DATA, ACK, SYN, FIN
-        self.seqno = seqno 
+        self.seqno = seqno
         self.data = data
+        self.options = options # option kind -> value bytes
+        self.wide = wide # 32 bit seqno
+        self.window = window # advertised receive window, None when there is none
 
     # for debugging
     def print_segment_info(self, s):
         print(f'({s}) seg type: {str(self.seg_type)}  /  seqno: {str(self.seqno)}  /  data size = {str(len(self.data))}')
 
+    # a segment that cant be packed (a field out of range) raises struct.error
+    def header(self):
+        if self.wide:
+            fixed, seg_type = WIDE_HEADER, self.seg_type | FLAG_WIDE
+        else:
+            fixed, seg_type = HEADER, self.seg_type
+        window = b""
+        if self.window != None:
+            seg_type |= FLAG_WINDOW
+            window = WINDOW.pack(self.window)
+        if not self.options:
+            return fixed.pack(seg_type, self.seqno) + window
+        opts = b"".join(bytes((kind, len(value))) + value for kind, value in self.options.items())
+        return fixed.pack(seg_type | FLAG_OPTIONS, self.seqno) + window + bytes((len(opts),)) + opts
+
+    # header and payload as separate buffers, for scatter/gather sends (sock.sendmsg)
+    def buffers(self):
+        if self.data:
+            return [self.header(), self.data]
+        return [self.header()]
+
     def serialise(self):
         # turns stp segments into bytes to be encapsulated and sent
-        try:
-            seg_type_bytes = self.seg_type.to_bytes(2, byteorder="big")
-            seqno_bytes = self.seqno.to_bytes(2, byteorder="big")
-            data_bytes = self.data if self.data else b""
-        except Exception as e:
-            sys.exit(f"failed to serialise")
-
-        return seg_type_bytes + seqno_bytes + data_bytes
-    
+        data_bytes = self.data if self.data else b""
+        return self.header() + bytes(data_bytes)
+
+    # writes the segment into a caller supplied buffer, returns the number of bytes written
+    def serialise_into(self, buf, offset = 0):
+        if self.options:
+            header = self.header()
+            buf[offset:offset + len(header)] = header
+            header_size = len(header)
+        else:
+            if self.wide:
+                fixed, seg_type = WIDE_HEADER, self.seg_type | FLAG_WIDE
+            else:
+                fixed, seg_type = HEADER, self.seg_type
+            header_size = fixed.size
+            if self.window != None:
+                seg_type |= FLAG_WINDOW
+                WINDOW.pack_into(buf, offset + header_size, self.window)
+                header_size += WINDOW.size
+            fixed.pack_into(buf, offset, seg_type, self.seqno)
+        size = len(self.data) if self.data else 0
+        start = offset + header_size
+        if size:
+            buf[start:start + size] = self.data
+        return header_size + size
+
+    # raises ValueError for a datagram that isnt a segment, whoever reads the socket drops it
     @classmethod
     def deserialise(cls, data):
+        # data is only viewed, not copied, so the segment is only valid while data is
         try:
-            seg_type = int.from_bytes(data[:2], byteorder="big")
-            seqno = int.from_bytes(data[2:4], byteorder="big")
-            seg_data = data[4:]
-        except Exception as e:
-            sys.exit(f"failed to deserialise")
-        
-        return cls(seg_type, seqno, seg_data)
+            view = memoryview(data)
+            wide = bool(view[0] << 8 & FLAG_WIDE)
+            fixed = WIDE_HEADER if wide else HEADER
+            seg_type, seqno = fixed.unpack_from(view)
+            start = fixed.size
+            window = None
+            if seg_type & FLAG_WINDOW:
+                window = WINDOW.unpack_from(view, start)[0]
+                start += WINDOW.size
+            options = None
+            if seg_type & FLAG_OPTIONS:
+                end = start + 1 + view[start]
+                options = {}
+                i = start + 1
+                while i < end:
+                    kind, size = view[i], view[i + 1]
+                    if i + 2 + size > end:
+                        raise ValueError("option runs past the options block")
+                    options[kind] = bytes(view[i + 2:i + 2 + size])
+                    i += 2 + size
+                start = end
+                check_options(options)
+            if start > len(view): # the options ran past the end
+                raise ValueError("truncated options")
+            seg_data = view[start:]
+        except (IndexError, struct.error, ValueError) as e:
+            raise ValueError(f"malformed segment: {e}") from None
+
+        return cls(seg_type & TYPE_MASK, seqno, seg_data, options, wide, window)
+
+# a small ring of reusable receive buffers so recvfrom_into doesnt allocate per datagram,
+# a received segment stays valid until the ring comes back round to its buffer
+class BufferPool:
+    def __init__(self, size, count = 4):
+        self.size = size
+        self.views = [memoryview(bytearray(size)) for _ in range(count)]
+        self.next = 0
+
+    def recvfrom(self, sock):
+        view = self.views[self.next]
+        self.next = (self.next + 1) % len(self.views)
+        nbytes, addr = sock.recvfrom_into(view)
+        return view[:nbytes], addr
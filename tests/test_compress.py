@@ -0,0 +1,46 @@
+import os
+import pytest
+import compress
+import filewriter
+
+class Owner:
+    def __init__(self):
+        self.queued = 0
+        self.written = 0
+
+    def on_written(self):
+        pass
+
+def decompress(tmp_path, codec, raw, size):
+    c = compress.compressor(codec)
+    data = c.compress(raw) + c.flush()
+    writes = filewriter.WriterThread()
+    with open(tmp_path / "out", "wb") as f:
+        d = compress.Decompressor(codec, filewriter.FileWriter(f, writes))
+        owner = Owner()
+        backlog = 0
+        for i in range(0, len(data), size):
+            d.write(i, data[i:i + size], owner)
+            backlog = max(backlog, d.queued - d.written)
+        d.close()
+    writes.close()
+    return (tmp_path / "out").read_bytes(), owner, len(data), backlog
+
+@pytest.mark.parametrize("codec", compress.available())
+def test_round_trip(tmp_path, codec):
+    raw = os.urandom(5000) * 200
+    out, owner, size, backlog = decompress(tmp_path, codec, raw, 1000)
+    assert out == raw
+    assert owner.queued == owner.written == size # every span counted, empty ones too
+
+@pytest.mark.parametrize("codec", compress.available())
+def test_output_is_bounded(tmp_path, codec):
+    raw = bytes(50 * 1024 * 1024) # a few kilobytes compressed
+    out, owner, size, backlog = decompress(tmp_path, codec, raw, 1000)
+    assert out == raw
+    assert backlog < compress.MAX_BACKLOG + compress.MAX_OUT
+    assert owner.written == size
+
+def test_empty_stream(tmp_path):
+    out, owner, size, backlog = decompress(tmp_path, compress.ZLIB, b"", 1000)
+    assert out == b"" and owner.written == size
@@ -0,0 +1,72 @@
+import pytest
+import congestion
+
+MAX_WIN = 1000
+
+def test_none_is_a_fixed_window():
+    cc = congestion.make("none", 50)
+    cc.on_ack(10, 10, 0, 0.1)
+    cc.on_timeout(50, 0)
+    assert cc.window() == 50
+
+@pytest.mark.parametrize("name", ["reno", "newreno", "cubic"])
+def test_slow_start_doubles_every_window(name):
+    cc = congestion.make(name, MAX_WIN)
+    assert cc.window() == congestion.INIT_CWND
+    cc.on_ack(congestion.INIT_CWND, 4, 0, 0.1)
+    assert cc.window() == 2 * congestion.INIT_CWND
+
+@pytest.mark.parametrize("name", ["reno", "newreno", "cubic"])
+def test_never_grows_past_max_win(name):
+    cc = congestion.make(name, 10)
+    for i in range(100):
+        cc.on_ack(1, i, i * 0.1, 0.1)
+    assert cc.window() == 10
+
+def test_reno_fast_recovery():
+    cc = congestion.make("reno", MAX_WIN)
+    cc.cwnd = cc.ssthresh = 20
+    cc.on_fast_retransmit(20, 100, 0)
+    assert cc.ssthresh == 10 and cc.cwnd == 13 and cc.in_recovery
+    cc.on_dupack()
+    assert cc.cwnd == 14
+    assert cc.recovery_window() == 10
+    assert not cc.on_ack(1, 80, 0, 0.1) # reno leaves recovery on any new ack
+    assert not cc.in_recovery and cc.cwnd == 10
+
+def test_newreno_stays_in_recovery_on_a_partial_ack():
+    cc = congestion.make("newreno", MAX_WIN)
+    cc.cwnd = cc.ssthresh = 20
+    cc.on_fast_retransmit(20, 100, 0)
+    assert cc.on_ack(5, 80, 0, 0.1) # partial, resend the next hole
+    assert cc.in_recovery
+    assert not cc.on_ack(20, 100, 0, 0.1) # recover acked
+    assert not cc.in_recovery and cc.cwnd == 10
+
+@pytest.mark.parametrize("name", ["reno", "newreno", "cubic"])
+def test_timeout_goes_back_to_one_segment(name):
+    cc = congestion.make(name, MAX_WIN)
+    cc.cwnd = 40
+    cc.on_timeout(40, 0)
+    assert cc.window() == 1
+    assert not cc.in_recovery
+    assert cc.ssthresh >= congestion.MIN_SSTHRESH
+
+def test_cubic_backs_off_less_than_reno():
+    cubic = congestion.make("cubic", MAX_WIN)
+    reno = congestion.make("reno", MAX_WIN)
+    for cc in (cubic, reno):
+        cc.cwnd = cc.ssthresh = 100
+        cc.on_fast_retransmit(100, 0, 0)
+    assert cubic.ssthresh == 70 and reno.ssthresh == 50
+
+def test_cubic_grows_back_towards_w_max():
+    cc = congestion.make("cubic", MAX_WIN)
+    cc.cwnd = cc.ssthresh = 100
+    cc.on_fast_retransmit(100, 0, 0)
+    cc.on_ack(1, 1, 0, 0.1) # leaves recovery at ssthresh
+    now = 0
+    while now < 10:
+        now += 0.1
+        cc.on_ack(int(cc.cwnd), 1, now, 0.1)
+    assert cc.cwnd > 100 # past the old w_max by now
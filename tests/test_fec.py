@@ -0,0 +1,73 @@
+import os
+import pytest
+import fec
+
+MSS = 100
+
+def encode(segments, k):
+    enc = fec.Encoder(k, MSS)
+    parities = []
+    for i, data in enumerate(segments):
+        parity = enc.add(i, data)
+        if parity != None:
+            parities.append(parity)
+    parity = enc.flush()
+    if parity != None:
+        parities.append(parity)
+    return parities
+
+@pytest.mark.parametrize("lost", range(4))
+def test_rebuilds_any_one_lost_segment(lost):
+    segments = [os.urandom(MSS) for _ in range(4)]
+    (first, parity), = encode(segments, 4)
+    dec = fec.Decoder(4, MSS)
+    for i, data in enumerate(segments):
+        if i != lost:
+            assert dec.add(i * MSS, data) == None
+    assert dec.parity(first * MSS, parity) == (lost * MSS, segments[lost])
+
+def test_rebuilds_a_short_last_segment():
+    segments = [os.urandom(MSS), os.urandom(MSS), os.urandom(37)] # the end of the stream
+    (first, parity), = encode(segments, 4) # a short group too
+    dec = fec.Decoder(4, MSS)
+    assert dec.parity(first * MSS, parity) == None
+    dec.add(0, segments[0])
+    assert dec.add(MSS, segments[1]) == (2 * MSS, segments[2])
+
+def test_parity_first_then_the_data():
+    segments = [os.urandom(MSS) for _ in range(3)]
+    (first, parity), = encode(segments, 3)
+    dec = fec.Decoder(3, MSS)
+    assert dec.parity(first * MSS, parity) == None
+    assert dec.add(0, segments[0]) == None
+    assert dec.add(2 * MSS, segments[2]) == (MSS, segments[1])
+
+def test_two_losses_cant_be_rebuilt():
+    segments = [os.urandom(MSS) for _ in range(4)]
+    (first, parity), = encode(segments, 4)
+    dec = fec.Decoder(4, MSS)
+    dec.add(0, segments[0])
+    dec.add(MSS, segments[1])
+    assert dec.parity(first * MSS, parity) == None
+
+def test_complete_group_needs_no_parity():
+    segments = [os.urandom(MSS) for _ in range(4)]
+    dec = fec.Decoder(4, MSS)
+    for i, data in enumerate(segments):
+        assert dec.add(i * MSS, data) == None
+    assert dec.groups == {}
+
+def test_released_groups_are_forgotten():
+    segments = [os.urandom(MSS) for _ in range(2)]
+    (first, parity), = encode(segments, 2)
+    dec = fec.Decoder(2, MSS)
+    dec.add(0, segments[0])
+    dec.release(2 * MSS)
+    assert dec.parity(first * MSS, parity) == None
+
+@pytest.mark.parametrize("k", [0, 1, fec.MAX_K + 1])
+def test_group_size_out_of_range(k):
+    with pytest.raises(AssertionError):
+        fec.Decoder(k, MSS)
+    with pytest.raises(AssertionError):
+        fec.Encoder(k, MSS)
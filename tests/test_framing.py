@@ -0,0 +1,46 @@
+import framing
+
+class Owner:
+    def __init__(self):
+        self.queued = 0
+        self.written = 0
+
+    def on_written(self):
+        pass
+
+def stream(*objects):
+    return b"".join(framing.header(name, len(data)) + data for name, data in objects)
+
+def parse(chunks):
+    sink = framing.QueueSink()
+    writer = framing.ObjectWriter(sink)
+    owner = Owner()
+    for offset, data in chunks:
+        writer.write(offset, data, owner)
+    writer.close()
+    return list(sink), writer, owner
+
+def test_objects_split_anywhere():
+    objects = [("a.txt", b"hello"), ("empty", b""), ("b/c", bytes(range(256)) * 10)]
+    data = stream(*objects) + b"\0" * 50 # padding at the end
+    for size in (1, 3, 7, 1000, len(data)):
+        got, writer, owner = parse((i, data[i:i + size]) for i in range(0, len(data), size))
+        assert got == [framing.Received(name, body) for name, body in objects]
+        assert writer.objects == 3 and not writer.incomplete and writer.error == None
+        assert owner.queued == owner.written == len(data)
+
+def test_out_of_order_segments_wait_for_the_gap():
+    data = stream(("x", b"12345678"))
+    chunks = [(i, data[i:i + 4]) for i in range(0, len(data), 4)]
+    got, writer, owner = parse(reversed(chunks))
+    assert got == [framing.Received("x", b"12345678")]
+
+def test_stream_ending_inside_an_object():
+    data = stream(("x", b"12345678"))[:-3]
+    got, writer, owner = parse([(0, data)])
+    assert got == [] and writer.incomplete
+
+def test_bad_frame_kind():
+    data = framing.FRAME.pack(7, 1, 0) + b"x"
+    got, writer, owner = parse([(0, data)])
+    assert isinstance(writer.error, ValueError)
@@ -0,0 +1,76 @@
+from intervals import IntervalSet
+
+def ranges(s):
+    return list(s)
+
+def test_add_keeps_ranges_sorted_and_apart():
+    s = IntervalSet()
+    s.add(20, 30)
+    s.add(0, 10)
+    s.add(40, 50)
+    assert ranges(s) == [(0, 10), (20, 30), (40, 50)]
+
+def test_adjacent_ranges_merge():
+    s = IntervalSet()
+    s.add(0, 10)
+    s.add(10, 20) # touching on the right
+    s.add(-5, 0) # and on the left
+    assert ranges(s) == [(-5, 20)]
+
+def test_add_spanning_several_ranges_merges_them():
+    s = IntervalSet()
+    for start in (0, 20, 40, 60):
+        s.add(start, start + 5)
+    s.add(3, 42)
+    assert ranges(s) == [(0, 45), (60, 65)]
+
+def test_add_inside_a_range_changes_nothing():
+    s = IntervalSet()
+    s.add(0, 100)
+    s.add(10, 20)
+    assert ranges(s) == [(0, 100)]
+
+def test_empty_range_is_ignored():
+    s = IntervalSet()
+    s.add(5, 5)
+    s.add(9, 3)
+    assert len(s) == 0
+
+def test_covers():
+    s = IntervalSet()
+    s.add(10, 20)
+    assert s.covers(10, 20)
+    assert s.covers(12, 15)
+    assert not s.covers(5, 15)
+    assert not s.covers(15, 25)
+    assert not s.covers(0, 5)
+
+def test_gaps():
+    s = IntervalSet()
+    s.add(10, 20)
+    s.add(30, 40)
+    assert s.gaps(0, 50) == [(0, 10), (20, 30), (40, 50)]
+    assert s.gaps(10, 20) == []
+    assert s.gaps(15, 35) == [(20, 30)]
+    assert s.gaps(40, 45) == [(40, 45)]
+    assert IntervalSet().gaps(0, 5) == [(0, 5)]
+
+def test_pop_from_jumps_over_the_contiguous_run():
+    s = IntervalSet()
+    s.add(0, 10)
+    s.add(10, 20)
+    s.add(30, 40)
+    assert s.pop_from(5) == 20
+    assert ranges(s) == [(30, 40)]
+    assert s.pop_from(25) == 25 # a hole before the next range, nothing popped
+    assert ranges(s) == [(30, 40)]
+    assert s.pop_from(30) == 40
+    assert len(s) == 0
+
+def test_size_and_clear():
+    s = IntervalSet()
+    s.add(0, 10)
+    s.add(20, 25)
+    assert s.size() == 15
+    s.clear()
+    assert s.size() == 0 and len(s) == 0
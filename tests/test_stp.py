@@ -0,0 +1,63 @@
+import pytest
+import stp
+from stp import STPSegment, NARROW, WIDE
+
+DATA = 1 # any type, the codec doesnt look at it
+
+@pytest.mark.parametrize("seq", [NARROW, WIDE])
+def test_add_wraps(seq):
+    assert seq.add(seq.size - 1, 1) == 0
+    assert seq.add(seq.size - 10, 25) == 15
+
+@pytest.mark.parametrize("seq", [NARROW, WIDE])
+def test_diff_across_the_wrap(seq):
+    top = seq.size - 5
+    assert seq.diff(3, top) == 8 # 3 is ahead of top
+    assert seq.diff(top, 3) == seq.size - 8 # top is behind 3
+    assert seq.diff(top, 3) >= seq.half
+
+@pytest.mark.parametrize("seq", [NARROW, WIDE])
+def test_ahead_only_within_half_the_space(seq):
+    a = seq.size - 1
+    assert seq.diff(seq.add(a, seq.half - 1), a) < seq.half
+    assert seq.diff(seq.add(a, seq.half), a) >= seq.half
+    assert seq.diff(a, a) == 0
+
+def test_wide_space():
+    assert WIDE.size == 2**32 and WIDE.wide
+    assert NARROW.size == 2**16 and not NARROW.wide
+
+@pytest.mark.parametrize("wide", [False, True])
+def test_round_trip(wide):
+    seqno = 2**32 - 3 if wide else 2**16 - 3
+    options = {stp.OPT_MSS: stp.MSS.pack(1400), stp.OPT_SACK: stp.pack_sack([(1, 2), (5, 9)])}
+    seg = STPSegment(DATA, seqno, b"payload", options, wide, window=12345)
+    buf = bytearray(200)
+    size = seg.serialise_into(buf)
+    assert bytes(buf[:size]) == seg.serialise()
+    got = STPSegment.deserialise(bytes(buf[:size]))
+    assert (got.seg_type, got.seqno, bytes(got.data), got.wide, got.window) == (DATA, seqno, b"payload", wide, 12345)
+    assert got.options == options
+    assert stp.unpack_sack(got.options[stp.OPT_SACK]) == [(1, 2), (5, 9)]
+
+def with_options(opts):
+    return stp.HEADER.pack(DATA | stp.FLAG_OPTIONS, 0) + bytes((len(opts),)) + opts
+
+@pytest.mark.parametrize("datagram", [
+    b"\x00", # shorter than a header
+    with_options(bytes((stp.OPT_MSS, 1, 0))), # truncated mss
+    with_options(bytes((stp.OPT_MSS, 2)) + stp.MSS.pack(stp.MIN_MSS - 1)),
+    with_options(bytes((stp.OPT_WIDE, 2, 0, 0))),
+    with_options(bytes((stp.OPT_SACK, 3, 0, 0, 0))),
+    with_options(bytes((stp.OPT_STRIPE, stp.STRIPE.size)) + stp.STRIPE.pack(1, 2, 2, 0)), # index past count
+    with_options(bytes((stp.OPT_STRIPE, stp.STRIPE.size)) + stp.STRIPE.pack(1, 0, 0, 0)),
+    with_options(bytes((stp.OPT_FEC, 5, 0))), # runs past the block
+    stp.HEADER.pack(DATA | stp.FLAG_OPTIONS, 0) + bytes((10,)), # block past the datagram
+])
+def test_malformed(datagram):
+    with pytest.raises(ValueError):
+        STPSegment.deserialise(datagram)
+
+def test_unknown_options_are_kept():
+    got = STPSegment.deserialise(with_options(bytes((99, 3, 1, 2, 3))))
+    assert got.options == {99: b"\x01\x02\x03"}
@@ -0,0 +1,107 @@
+# timers for the sender and receiver, anything with call_later(delay, fn)
+# returning a handle with cancel() can be plugged in (asyncio loops included)
+import threading
+import time
+import math
+
+RESOLUTION = 0.001 # seconds per tick
+WHEEL_SLOTS = 512
+
+class TimerHandle:
+    __slots__ = ('wheel', 'tick', 'fn', 'args', 'done')
+
+    def __init__(self, wheel, tick, fn, args):
+        self.wheel = wheel
+        self.tick = tick # absolute tick it expires on
+        self.fn = fn
+        self.args = args
+        self.done = False # fired or cancelled
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+# hashed timer wheel driven by one thread. arming and cancelling are constant time
+# (a set add / remove in the slot for the deadline), deadlines are rounded up to the
+# resolution and everything due in the same tick fires together. the thread sleeps
+# until the earliest deadline (or until a timer is armed that expires before it)
+class TimerWheel:
+    def __init__(self, resolution = RESOLUTION, slots = WHEEL_SLOTS):
+        self.resolution = resolution
+        self.wheel = [set() for _ in range(slots)]
+        self.cond = threading.Condition()
+        self.start = time.monotonic()
+        self.current_tick = 0 # next tick to be processed
+        self.pending = 0
+        self.wake_tick = None # tick the thread is sleeping until, None if it isnt
+        self.stopped = False
+        self.thread = None # started with the first timer
+
+    def now_tick(self):
+        return int((time.monotonic() - self.start) / self.resolution)
+
+    def call_later(self, delay, fn, *args):
+        with self.cond:
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            now = self.now_tick()
+            if self.pending == 0: # nothing was waiting, no need to walk the idle ticks
+                self.current_tick = now
+            handle = TimerHandle(self, now + max(1, math.ceil(delay / self.resolution)), fn, args)
+            self.wheel[handle.tick % len(self.wheel)].add(handle)
+            self.pending += 1
+            if self.pending == 1 or (self.wake_tick != None and handle.tick < self.wake_tick):
+                self.cond.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self.cond:
+            if not handle.done:
+                handle.done = True
+                self.wheel[handle.tick % len(self.wheel)].discard(handle)
+                self.pending -= 1
+
+    # tick of the earliest pending timer, the first slot from current_tick on holding
+    # one for this time around, or failing that the earliest on a later time around
+    def next_deadline(self):
+        slots = len(self.wheel)
+        for tick in range(self.current_tick, self.current_tick + slots):
+            if any(handle.tick == tick for handle in self.wheel[tick % slots]):
+                return tick
+        return min(handle.tick for slot in self.wheel for handle in slot)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            while not self.stopped:
+                if self.pending == 0:
+                    self.cond.wait()
+                    continue
+
+                expired = []
+                now = self.now_tick()
+                while self.current_tick <= now and self.pending > len(expired):
+                    slot = self.wheel[self.current_tick % len(self.wheel)]
+                    for handle in [h for h in slot if h.tick <= self.current_tick]:
+                        slot.remove(handle)
+                        handle.done = True
+                        expired.append(handle)
+                    self.current_tick += 1
+                self.pending -= len(expired)
+
+                if len(expired) > 0:
+                    # callbacks may arm or cancel timers, so run them without the lock
+                    self.cond.release()
+                    try:
+                        for handle in expired:
+                            handle.fn(*handle.args)
+                    finally:
+                        self.cond.acquire()
+                else:
+                    self.wake_tick = self.next_deadline()
+                    self.cond.wait(self.start + self.wake_tick * self.resolution - time.monotonic())
+                    self.wake_tick = None